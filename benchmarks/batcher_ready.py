@@ -0,0 +1,78 @@
+"""
+Микробенчмарк SessionBatcher.get_ready_batches при большом числе открытых диалогов.
+
+Сравнивает прежний алгоритм (полный обход всех диалогов на каждом вызове) с кучей
+сроков и набором полных батчей. Между вызовами в случайные активные диалоги добавляется
+несколько сообщений, как в цикле consumer, который опрашивает батчер каждые ~10 мс;
+остальные диалоги простаивают с неполными батчами.
+
+Запуск из корня репозитория:
+    python -m benchmarks.batcher_ready --dialogs 10000 100000 --calls 1000
+"""
+import argparse
+import random
+import time
+
+from utils.batching import SessionBatcher
+
+
+class ScanSessionBatcher(SessionBatcher):
+    """Прежняя реализация get_ready_batches: обход всех диалогов на каждом вызове"""
+
+    def get_ready_batches(self):
+        now = time.time()
+        ready_batches = []
+        for key, messages in list(self.batches.items()):
+            if len(messages) >= self.max_batch_size or (now - self.timestamps[key]) > self.max_wait:
+                ready_batches.append((key, messages))
+                del self.batches[key]
+                del self.timestamps[key]
+        return ready_batches
+
+
+def run(batcher_class, dialogs: int, active: int, batch_size: int, calls: int, messages_per_call: int, seed: int):
+    """
+    Открывает dialogs диалогов по одному сообщению и замеряет calls вызовов get_ready_batches
+
+    Returns:
+        (мкс на вызов, число отданных батчей)
+    """
+    rng = random.Random(seed)
+    batcher = batcher_class(max_batch_size=batch_size, max_wait=3600)
+    message = {"SenderId": 1, "MessageText": "привет"}
+    for dialog in range(dialogs):
+        batcher.add_message(dialog, dialog, message)
+
+    ready = 0
+    elapsed = 0.0
+    for _ in range(calls):
+        for _ in range(messages_per_call):
+            dialog = rng.randrange(min(active, dialogs))
+            batcher.add_message(dialog, dialog, message)
+        start = time.perf_counter()
+        ready += len(batcher.get_ready_batches())
+        elapsed += time.perf_counter() - start
+    return elapsed / calls * 1e6, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dialogs", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--active", type=int, default=100, help="Сколько диалогов получают новые сообщения")
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--messages-per-call", type=int, default=10, help="Сообщений между вызовами")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'диалогов':>10}{'обход, мкс':>14}{'куча, мкс':>12}{'ускорение':>11}{'батчей':>9}")
+    for dialogs in args.dialogs:
+        params = (dialogs, args.active, args.batch_size, args.calls, args.messages_per_call, args.seed)
+        scan_us, scan_ready = run(ScanSessionBatcher, *params)
+        heap_us, heap_ready = run(SessionBatcher, *params)
+        assert scan_ready == heap_ready, "реализации отдали разное число батчей"
+        print(f"{dialogs:>10}{scan_us:>14.1f}{heap_us:>12.1f}{scan_us / heap_us:>10.0f}x{heap_ready:>9}")
+
+
+if __name__ == "__main__":
+    main()
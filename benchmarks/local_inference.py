@@ -0,0 +1,95 @@
+"""
+Бенчмарк вариантов инференса локальной модели на CPU: скорость генерации (токенов/с)
+и пиковый RSS для каждой точности и torch.compile на стандартных промптах local_prompts.
+
+Каждая конфигурация запускается в отдельном процессе, чтобы пиковая память одной
+не влияла на другую. Нужна локально доступная модель (по умолчанию LOCAL_MODEL_NAME),
+для int4 — пакет optimum-quanto.
+
+Запуск из корня репозитория:
+    python -m benchmarks.local_inference --configs fp32,bf16,int8,int4,int8+compile --threads 8
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def run_config(model_name: str, config: str, threads: int, max_new_tokens: int, chat_messages: int) -> dict:
+    """Загружает модель в заданной конфигурации и прогоняет по разу каждый стандартный промпт"""
+    import torch
+    from benchmarks.prefix_cache import sample_prompts
+    from processor.local_backends import load_local_model
+
+    precision, _, option = config.partition("+")
+    start = time.perf_counter()
+    tokenizer, model = load_local_model(model_name, precision, option == "compile", threads)
+    load_s = time.perf_counter() - start
+
+    def generate(prompt: str, new_tokens: int) -> int:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        with torch.inference_mode():
+            outputs = model.generate(
+                **inputs, max_new_tokens=new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id
+            )
+        return outputs.shape[1] - inputs["input_ids"].shape[1]
+
+    prompts = sample_prompts(chat_messages)
+    # Прогрев: ленивая инициализация ядер и компиляция не входят в скорость генерации
+    start = time.perf_counter()
+    generate(prompts["compliments"], 4)
+    warmup_s = time.perf_counter() - start
+
+    tokens = 0
+    start = time.perf_counter()
+    for prompt in prompts.values():
+        tokens += generate(prompt, max_new_tokens)
+    elapsed = time.perf_counter() - start
+    return {
+        "load_s": load_s,
+        "warmup_s": warmup_s,
+        "tokens": tokens,
+        "tokens_per_s": tokens / elapsed if elapsed else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("LOCAL_MODEL_NAME", "models/mistral-instruct"))
+    parser.add_argument("--configs", default="fp32,bf16,int8,int4,int8+compile",
+                        help="Через запятую: точность из PRECISIONS, с суффиксом +compile для torch.compile")
+    parser.add_argument("--threads", type=int, default=0, help="Потоков torch (0 — по умолчанию)")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--chat-messages", type=int, default=20, help="Число сообщений в синтетическом чате")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_config(args.model, args.child, args.threads, args.max_new_tokens, args.chat_messages)
+        print(json.dumps(result))
+        return
+
+    print(f"Модель: {args.model}, потоков: {args.threads or 'по умолчанию'}, новых токенов на промпт: {args.max_new_tokens}")
+    print(f"{'конфигурация':<16}{'загрузка, с':>13}{'прогрев, с':>12}{'токенов/с':>11}{'пик RSS, МБ':>13}")
+    for config in args.configs.split(","):
+        command = [
+            sys.executable, "-m", "benchmarks.local_inference", "--child", config, "--model", args.model,
+            "--threads", str(args.threads), "--max-new-tokens", str(args.max_new_tokens),
+            "--chat-messages", str(args.chat_messages)
+        ]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else completed.returncode
+            print(f"{config:<16}ошибка: {error}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"{config:<16}{result['load_s']:>13.1f}{result['warmup_s']:>12.1f}"
+              f"{result['tokens_per_s']:>11.2f}{result['peak_rss_mb']:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
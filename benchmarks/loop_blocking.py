@@ -0,0 +1,181 @@
+"""
+Регрессионный бенчмарк: сколько времени event loop блокируется при обработке одного батча.
+
+LLM и БД заменены заглушками с фиксированной задержкой: асинхронные вызовы ждут через
+asyncio.sleep, синхронные — через time.sleep. Если AnalysisService где-то вызывает
+синхронный метод LLM прямо в event loop, это сразу видно по росту блокировки.
+
+Запуск из корня репозитория:
+    python -m benchmarks.loop_blocking --batches 20 --llm-latency 0.2
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import time
+import types
+
+TICK_SECONDS = 0.005
+
+
+def install_stubs(llm_latency: float):
+    """Подменяет processor.llm_handler и services.db_service заглушками"""
+    def compliments(messages, *args, **kwargs):
+        return {str(m["SenderId"]): 1 for m in messages}
+
+    def engagement(messages, *args, **kwargs):
+        return {str(m["SenderId"]): 50.0 for m in messages}
+
+    def attachment(messages, *args, **kwargs):
+        return {str(m["SenderId"]): {"type": "secure", "confidence": 60} for m in messages}
+
+    def all_metrics(messages, *args, **kwargs):
+        return {
+            "compliments": compliments(messages),
+            "engagement": engagement(messages),
+            "attachment": attachment(messages)
+        }
+
+    def blocking(func):
+        def wrapper(*args, **kwargs):
+            time.sleep(llm_latency)
+            return func(*args, **kwargs)
+        return wrapper
+
+    def non_blocking(func):
+        async def wrapper(*args, **kwargs):
+            await asyncio.sleep(llm_latency)
+            return func(*args, **kwargs)
+        return wrapper
+
+    handler = types.ModuleType("processor.llm_handler")
+    for name, func in (
+        ("count_compliments", compliments),
+        ("calculate_engagement", engagement),
+        ("calculate_attachment", attachment),
+        ("calculate_all_metrics", all_metrics),
+        ("generate_recommendations", lambda *args, **kwargs: "Задай уточняющий вопрос"),
+        ("update_summary", lambda *args, **kwargs: "Краткое саммери"),
+        ("compact_summary", lambda *args, **kwargs: "Краткое саммери"),
+    ):
+        setattr(handler, name, blocking(func))
+        setattr(handler, f"{name}_async", non_blocking(func))
+    handler.count_tokens = lambda text: len(text) // 3
+    sys.modules["processor.llm_handler"] = handler
+    import processor
+    processor.llm_handler = handler
+
+    class StubUnitOfWork:
+        def __init__(self):
+            self.summaries, self.metrics, self.recommendations, self.callbacks = [], [], [], []
+
+        def add_summary(self, *args):
+            self.summaries.append(args)
+
+        def add_metrics(self, row):
+            self.metrics.append(row)
+
+        def add_recommendation(self, *args):
+            self.recommendations.append(args)
+
+        def after_commit(self, callback):
+            self.callbacks.append(callback)
+
+        def __len__(self):
+            return len(self.summaries) + len(self.metrics) + len(self.recommendations)
+
+        async def commit(self):
+            for callback in self.callbacks:
+                callback()
+            return True
+
+    class StubDBService:
+        def unit_of_work(self):
+            return StubUnitOfWork()
+
+        async def get_historical_summary(self, *args, **kwargs):
+            return "Саммери"
+
+        async def get_latest_metrics(self, *args, **kwargs):
+            return {"total_compliments": 3, "engagement_score": 55.0,
+                    "attachment_type": "secure", "attachment_confidence": 0.6}
+
+        def __getattr__(self, name):
+            async def noop(*args, **kwargs):
+                return True
+            return noop
+
+    db_module = types.ModuleType("services.db_service")
+    db_module.db_service = StubDBService()
+    db_module.DBService = StubDBService
+    db_module.UnitOfWork = StubUnitOfWork
+    sys.modules["services.db_service"] = db_module
+
+
+async def monitor_loop(stop: asyncio.Event, lags: list):
+    """Периодически просыпается и записывает, на сколько опоздал таймер"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK_SECONDS)
+        lag = time.perf_counter() - start - TICK_SECONDS
+        if lag > 0:
+            lags.append(lag)
+
+
+async def run(batches: int, batch_size: int):
+    from services.analysis_service import AnalysisService
+
+    service = AnalysisService()
+    messages = [
+        {"SenderId": 100 if i % 2 else 200, "MessageText": f"Сообщение {i}", "TelegramUserId": 100}
+        for i in range(batch_size)
+    ]
+
+    per_batch = []
+    for _ in range(batches):
+        lags = []
+        stop = asyncio.Event()
+        monitor = asyncio.create_task(monitor_loop(stop, lags))
+        start = time.perf_counter()
+        await service.process_batch("session", 100, 200, messages)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await monitor
+        # Мелкие задержки таймера считаем шумом планировщика
+        blocked = sum(lag for lag in lags if lag > TICK_SECONDS)
+        per_batch.append((elapsed, blocked, max(lags, default=0.0)))
+    return per_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Задержка одного вызова LLM, сек")
+    parser.add_argument("--max-blocked", type=float, default=0.05,
+                        help="Допустимая блокировка event loop на батч, сек (иначе код выхода 1)")
+    args = parser.parse_args()
+
+    install_stubs(args.llm_latency)
+    # Печать AnalysisService не должна влиять на замер
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run(args.batches, args.batch_size))
+
+    blocked = sorted(r[1] for r in results)
+    elapsed = sorted(r[0] for r in results)
+    worst_lag = max(r[2] for r in results)
+    print(f"Батчей: {len(results)}, размер батча: {args.batch_size}, задержка LLM: {args.llm_latency:.3f} сек")
+    print(f"Время обработки батча, медиана: {elapsed[len(elapsed) // 2]:.3f} сек")
+    print(f"Блокировка event loop на батч: медиана {blocked[len(blocked) // 2] * 1000:.1f} мс, "
+          f"максимум {blocked[-1] * 1000:.1f} мс")
+    print(f"Самая длинная единичная блокировка: {worst_lag * 1000:.1f} мс")
+
+    if blocked[-1] > args.max_blocked:
+        print(f"❌ Блокировка превышает порог {args.max_blocked * 1000:.0f} мс")
+        sys.exit(1)
+    print("✅ Блокировка в пределах порога")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Бенчмарк памяти буфера сообщений: сколько занимает 1M сообщений в SessionBatcher
+в виде полного JSON-словаря из Kafka, TelegramMessage и компактного MessageRecord.
+
+Память считается через tracemalloc (только аллокации Python). Тексты у каждого
+сообщения свои, как после декодирования записи Kafka.
+
+Запуск из корня репозитория:
+    python -m benchmarks.message_memory --messages 1000000 --dialogs 10000
+"""
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from consumer.deserializer import create_deserializer
+from utils.batching import SessionBatcher
+from utils.messages import MessageRecord
+
+DECODE_BATCH = 500
+
+
+class _KafkaRecord:
+    """Минимальная замена ConsumerRecord для десериализатора"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: bytes):
+        self.value = value
+
+
+def make_payloads(count: int, dialogs: int, seed: int):
+    """Генерирует JSON-записи Kafka в формате продюсера"""
+    rng = random.Random(seed)
+    words = ["привет", "как", "дела", "сегодня", "вечером", "кино", "работа", "отлично", "спасибо", "увидимся"]
+    payloads = []
+    for index in range(count):
+        dialog = index % dialogs
+        user_id = 100000000 + dialog // 10
+        interlocutor_id = 500000000 + dialog
+        payloads.append(_KafkaRecord(json.dumps({
+            "SessionId": f"3f0c2a4e-{dialog:04x}-4b7d-9c1e-{user_id:012x}",
+            "TelegramUserId": user_id,
+            "TelegramInterlocutorId": interlocutor_id,
+            "SenderId": user_id if rng.random() < 0.5 else interlocutor_id,
+            "MessageId": index,
+            "MessageText": " ".join(rng.choice(words) for _ in range(rng.randint(3, 12))),
+            "Timestamp": "2025-05-01T12:00:00.000Z",
+            "IsOutgoing": rng.random() < 0.5,
+            "ReplyToMessageId": None
+        }, ensure_ascii=False).encode("utf-8")))
+    return payloads
+
+
+def as_dicts(records):
+    for record in records:
+        message = json.loads(record.value)
+        yield (message["SessionId"], message["TelegramInterlocutorId"]), message
+
+
+def as_telegram_messages(records):
+    deserializer = create_deserializer()
+    for start in range(0, len(records), DECODE_BATCH):
+        for _, message, _ in deserializer.decode_batch(records[start:start + DECODE_BATCH]):
+            yield (message.SessionId, message.TelegramInterlocutorId), message
+
+
+def as_message_records(records):
+    for key, message in as_telegram_messages(records):
+        yield key, MessageRecord.from_mapping(message)
+
+
+def measure(records, convert):
+    """
+    Заполняет батчер сообщениями в заданном представлении
+
+    Returns:
+        (байт на буфер, секунд на заполнение)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    batcher = SessionBatcher(max_batch_size=len(records) + 1, max_wait=3600)
+    for (session_id, interlocutor_id), message in convert(records):
+        batcher.add_message(session_id, interlocutor_id, message)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del batcher
+    return current, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--dialogs", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    records = make_payloads(args.messages, args.dialogs, args.seed)
+    print(f"Сообщений: {args.messages}, диалогов: {args.dialogs}, десериализатор: {create_deserializer().name}")
+    print(f"{'представление':<16}{'МБ':>10}{'байт/сообщ.':>14}{'заполнение, с':>16}")
+    baseline = None
+    for name, convert in (("dict", as_dicts), ("TelegramMessage", as_telegram_messages),
+                          ("MessageRecord", as_message_records)):
+        memory, elapsed = measure(records, convert)
+        baseline = baseline or memory
+        print(f"{name:<16}{memory / 2 ** 20:>10.1f}{memory / args.messages:>14.0f}{elapsed:>16.2f}"
+              f"   ({memory / baseline:.0%} от dict)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Бенчмарк кэша префиксов KV локальной модели: время до первого токена (TTFT)
+для каждого типа промпта с кэшем статического префикса и без него.
+
+Нужна локально доступная модель (по умолчанию LOCAL_MODEL_NAME из config).
+
+Запуск из корня репозитория:
+    python -m benchmarks.prefix_cache --model models/mistral-instruct --repeats 5
+"""
+import argparse
+import os
+import statistics
+import time
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from processor import local_prompts
+from processor.prefix_cache import PrefixKVCache
+
+
+def sample_prompts(chat_messages: int):
+    """Строит по одному промпту каждого типа на синтетическом чате"""
+    chat_text = "\n".join(
+        f"{100 if i % 2 else 200}: Сообщение номер {i}, как прошёл твой день?" for i in range(chat_messages)
+    )
+    user_ids = ["100", "200"]
+    summary = "Собеседники обсуждают планы на выходные и делятся впечатлениями."
+    return {
+        "compliments": local_prompts.compliments_prompt(chat_text),
+        "engagement": local_prompts.engagement_prompt(chat_text, user_ids, summary, {"100": 60.0, "200": 45.0}),
+        "attachment": local_prompts.attachment_prompt(
+            chat_text, user_ids, summary, {"100": {"type": "secure", "confidence": 60}}
+        ),
+        "all_metrics": local_prompts.all_metrics_prompt(chat_text, user_ids, summary),
+        "recommendations": local_prompts.recommendations_prompt(chat_text, summary, "100"),
+        "summary": local_prompts.summary_prompt(chat_text, summary)
+    }
+
+
+def time_to_first_token(model, inputs, past_key_values=None) -> float:
+    """Время генерации одного токена, то есть prefill + первый шаг декодирования"""
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.inference_mode():
+        model.generate(**inputs, past_key_values=past_key_values, max_new_tokens=1, do_sample=False)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("LOCAL_MODEL_NAME", "models/mistral-instruct"))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--chat-messages", type=int, default=20, help="Число сообщений в синтетическом чате")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model,
+        torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
+        device_map="auto"
+    )
+    prefix_cache = PrefixKVCache(model, tokenizer)
+    for name, prefix_text in local_prompts.STATIC_PREFIXES.items():
+        prefix_cache.register(name, prefix_text)
+
+    print(f"{'промпт':<16}{'токенов':>9}{'префикс':>9}{'без кэша, мс':>15}{'с кэшем, мс':>14}{'ускорение':>11}")
+    for name, prompt in sample_prompts(args.chat_messages).items():
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        input_ids = inputs["input_ids"][0].tolist()
+        prefix_tokens = len(tokenizer(local_prompts.STATIC_PREFIXES[name])["input_ids"])
+
+        # Прогрев, чтобы не мерить ленивую инициализацию ядер
+        time_to_first_token(model, inputs)
+
+        baseline = [time_to_first_token(model, inputs) for _ in range(args.repeats)]
+        cached = []
+        for _ in range(args.repeats):
+            # Копирование кэша префикса входит в TTFT так же, как в LocalLLM
+            start = time.perf_counter()
+            past_key_values = prefix_cache.lookup(prompt, input_ids)
+            lookup_time = time.perf_counter() - start
+            if past_key_values is None:
+                break
+            cached.append(lookup_time + time_to_first_token(model, inputs, past_key_values))
+
+        baseline_ms = statistics.median(baseline) * 1000
+        if not cached:
+            print(f"{name:<16}{len(input_ids):>9}{prefix_tokens:>9}{baseline_ms:>15.1f}{'—':>14}{'нет совпадения':>11}")
+            continue
+        cached_ms = statistics.median(cached) * 1000
+        print(f"{name:<16}{len(input_ids):>9}{prefix_tokens:>9}{baseline_ms:>15.1f}{cached_ms:>14.1f}"
+              f"{baseline_ms / cached_ms:>10.2f}x")
+
+    print(f"Кэш префиксов: {prefix_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
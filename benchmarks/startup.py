@@ -0,0 +1,76 @@
+"""
+Бенчмарк запуска: время импорта точки входа и пиковый RSS процесса для каждого LLM_TYPE.
+
+Каждый замер идёт в отдельном процессе с чистым кэшем модулей. Кроме времени и памяти
+печатается, какие тяжёлые зависимости оказались загружены: в режиме yandex среди них
+не должно быть torch и transformers, до первого запроса — и SDK Yandex Cloud.
+
+Запуск из корня репозитория:
+    python -m benchmarks.startup --module main --repeat 5
+    python -m benchmarks.startup --first-call   # плюс создание LLM и подсчёт токенов
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ("torch", "transformers", "yandex_cloud_ml_sdk", "psycopg2", "aiohttp", "asyncpg", "aiokafka")
+
+CHILD = """
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+importlib.import_module({module!r})
+imported = time.perf_counter() - start
+first_call = None
+if {first_call!r}:
+    from processor import llm_handler
+    llm_handler.count_tokens("Привет! Как дела?")
+    first_call = time.perf_counter() - start
+print(json.dumps({{
+    "import_s": imported,
+    "first_call_s": first_call,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "loaded": [name for name in {heavy!r} if name in sys.modules]
+}}))
+"""
+
+
+def run_once(module: str, llm_type: str, first_call: bool) -> dict:
+    """Запускает замер в новом интерпретаторе и возвращает его результат"""
+    env = dict(os.environ, LLM_TYPE=llm_type)
+    # Для создания клиента Yandex достаточно непустых значений, сеть не используется
+    env.setdefault("API_KEY", "benchmark")
+    env.setdefault("FOLDER_ID", "benchmark")
+    code = CHILD.format(module=module, first_call=first_call, heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{llm_type}: {result.stderr.strip().splitlines()[-1] if result.stderr else result.returncode}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main", help="Импортируемый модуль (точка входа)")
+    parser.add_argument("--llm-types", default="yandex,local")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--first-call", action="store_true", help="Замерять и первое обращение к LLM")
+    args = parser.parse_args()
+
+    print(f"Модуль: {args.module}, повторов: {args.repeat}")
+    print(f"{'LLM_TYPE':<10}{'импорт, с':>12}{'1-й вызов, с':>14}{'RSS, МБ':>10}   загружены")
+    for llm_type in args.llm_types.split(","):
+        try:
+            runs = [run_once(args.module, llm_type, args.first_call) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{llm_type:<10}ошибка: {e}")
+            continue
+        import_s = statistics.median(run["import_s"] for run in runs)
+        first_call = f"{statistics.median(run['first_call_s'] for run in runs):.3f}" if args.first_call else "-"
+        rss_mb = max(run["rss_mb"] for run in runs)
+        print(f"{llm_type:<10}{import_s:>12.3f}{first_call:>14}{rss_mb:>10.1f}   {', '.join(runs[-1]['loaded']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
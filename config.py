@@ -6,9 +6,30 @@ load_dotenv()
 
 KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:29092")
 KAFKA_TOPIC = os.getenv("KAFKA_TOPIC", "telegram-messages")
+KAFKA_GROUP_ID = os.getenv("KAFKA_GROUP_ID", "telegram-metrics-group")
+KAFKA_DLQ_TOPIC = os.getenv("KAFKA_DLQ_TOPIC", "telegram-messages-dlq") # Топик для битых сообщений; пусто — только логировать
+KAFKA_DESERIALIZER = os.getenv("KAFKA_DESERIALIZER", "auto") # "auto", "msgspec", "orjson" или "json"
+REBALANCE_FLUSH_ON_REVOKE = os.getenv("REBALANCE_FLUSH_ON_REVOKE", "true").lower() == "true" # Дообрабатывать неполные батчи отзываемых партиций; иначе их перечитает новый владелец
+REBALANCE_REVOKE_TIMEOUT_SECONDS = float(os.getenv("REBALANCE_REVOKE_TIMEOUT_SECONDS", "30")) # Сколько ждать обработки при отзыве партиций
 
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "20"))
 BATCH_TIMEOUT_SECONDS = int(os.getenv("BATCH_TIMEOUT_SECONDS", "30"))
+BATCH_ADAPTIVE = os.getenv("BATCH_ADAPTIVE", "false").lower() == "true" # Подбирать размер батча и ожидание по нагрузке вместо BATCH_SIZE/BATCH_TIMEOUT_SECONDS
+BATCH_SIZE_MIN = int(os.getenv("BATCH_SIZE_MIN", "5"))
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", "50"))
+BATCH_TIMEOUT_MIN_SECONDS = float(os.getenv("BATCH_TIMEOUT_MIN_SECONDS", "2"))
+BATCH_TIMEOUT_MAX_SECONDS = float(os.getenv("BATCH_TIMEOUT_MAX_SECONDS", "60"))
+BATCH_TARGET_LATENCY_SECONDS = float(os.getenv("BATCH_TARGET_LATENCY_SECONDS", "10")) # Время обработки батча, выше которого батчи укрупняются
+BATCHER_BACKEND = os.getenv("BATCHER_BACKEND", "memory") # "memory" или "sqlite" — буферы переживают перезапуск
+BATCHER_DB_PATH = os.getenv("BATCHER_DB_PATH", "data/batcher.sqlite3")
+BATCHER_MEMORY_CAP_MESSAGES = int(os.getenv("BATCHER_MEMORY_CAP_MESSAGES", "50000")) # Сверх лимита давние диалоги держатся только на диске
+
+# Дорожки анализа между Kafka consumer и AnalysisService: батчи одного диалога идут в одну дорожку по очереди
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", "100")) # Суммарная ёмкость дорожек; при заполнении чтение из Kafka приостанавливается
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "10")) # Число дорожек (параллельно обрабатываемых диалогов)
+OFFSET_COMMIT_INTERVAL_SECONDS = float(os.getenv("OFFSET_COMMIT_INTERVAL_SECONDS", "1"))
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3")) # Попыток обработать батч перед отправкой в dead-letter топик; пока батч не записан в DLQ, попытки продолжаются
+ANALYSIS_RETRY_BACKOFF_SECONDS = float(os.getenv("ANALYSIS_RETRY_BACKOFF_SECONDS", "5")) # Пауза перед повтором, удваивается с каждой попыткой
 
 API_KEY = os.getenv("API_KEY", "")
 FOLDER_ID = os.getenv("FOLDER_ID", "")
@@ -16,9 +37,61 @@ FOLDER_ID = os.getenv("FOLDER_ID", "")
 # Настройки выбора LLM
 LLM_TYPE = os.getenv("LLM_TYPE", "yandex") # "yandex" или "local"
 LOCAL_MODEL_NAME = os.getenv("LOCAL_MODEL_NAME", "models/mistral-instruct") # Имя или путь к локальной модели, если LLM_TYPE="local"
+LOCAL_BATCH_SIZE = int(os.getenv("LOCAL_BATCH_SIZE", "4")) # Максимум промптов в одном вызове generate локальной модели
+LOCAL_BATCH_MAX_WAIT_MS = float(os.getenv("LOCAL_BATCH_MAX_WAIT_MS", "20")) # Окно сбора батча локальной модели
+LOCAL_PREFIX_CACHE = os.getenv("LOCAL_PREFIX_CACHE", "true").lower() == "true" # Кэшировать KV статических префиксов промптов
+LOCAL_PRECISION = os.getenv("LOCAL_PRECISION", "auto") # "auto", "fp32", "bf16", "fp16", "int8" (динамическая квантизация, CPU) или "int4" (optimum-quanto)
+LOCAL_COMPILE = os.getenv("LOCAL_COMPILE", "false").lower() == "true" # Компилировать модель через torch.compile
+LOCAL_NUM_THREADS = int(os.getenv("LOCAL_NUM_THREADS", "0")) # Потоков torch на CPU; 0 — по умолчанию torch
+METRICS_MODE = os.getenv("METRICS_MODE", "separate") # "separate" — три запроса метрик на чанк, "combined" — один общий запрос
+
+# Разбиение больших батчей на части по бюджету токенов одного запроса
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "4000")) # Токенов на запрос: сообщения + саммери + инструкции
+CHUNK_CONCURRENCY = int(os.getenv("CHUNK_CONCURRENCY", "4")) # Сколько частей одного батча обрабатываются одновременно
+PROMPT_OVERHEAD_TOKENS = int(os.getenv("PROMPT_OVERHEAD_TOKENS", "1000")) # Резерв на инструкции, прошлые метрики и ответ
+
+# Обновление исторического саммери
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "full") # "full" — на каждом батче, "incremental" — раз в N батчей с бюджетом токенов
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "800")) # Максимальный размер саммери в токенах
+SUMMARY_UPDATE_EVERY_N_BATCHES = int(os.getenv("SUMMARY_UPDATE_EVERY_N_BATCHES", "3"))
+SUMMARY_PENDING_TOKEN_BUDGET = int(os.getenv("SUMMARY_PENDING_TOKEN_BUDGET", "800")) # Сколько токенов новых сообщений копить до внеочередного обновления саммери (incremental)
+SUMMARY_PENDING_IDLE_SECONDS = float(os.getenv("SUMMARY_PENDING_IDLE_SECONDS", "600")) # Отложенное саммери диалога без новых батчей сохраняется досрочно через столько секунд
+SUMMARY_PENDING_MAX_DIALOGS = int(os.getenv("SUMMARY_PENDING_MAX_DIALOGS", "10000")) # Максимум диалогов с отложенным саммери в памяти; сверх него досрочно сохраняются самые давние
+
+# Настройки асинхронного клиента LLM
+LLM_HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", "100")) # Максимум одновременных HTTP-соединений к YandexGPT
+LLM_HTTP_TIMEOUT_SECONDS = float(os.getenv("LLM_HTTP_TIMEOUT_SECONDS", "60"))
+LLM_EXECUTOR_WORKERS = int(os.getenv("LLM_EXECUTOR_WORKERS", str(max(3, LOCAL_BATCH_SIZE)))) # Размер общего пула потоков для синхронных LLM (local); не меньше LOCAL_BATCH_SIZE, иначе батчи не заполнятся
+
+# Квоты исходящих запросов к LLM (0 — без ограничения)
+YANDEX_RPS = float(os.getenv("YANDEX_RPS", "10"))
+YANDEX_MAX_IN_FLIGHT = int(os.getenv("YANDEX_MAX_IN_FLIGHT", "10"))
+LOCAL_RPS = float(os.getenv("LOCAL_RPS", "0"))
+LOCAL_MAX_IN_FLIGHT = int(os.getenv("LOCAL_MAX_IN_FLIGHT", str(LLM_EXECUTOR_WORKERS)))
+
+# Кэш ответов LLM по хэшу запроса
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory") # "none", "memory" или "sqlite"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/llm_cache.sqlite3") # Файл кэша для бэкенда "sqlite"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400")) # 0 — без ограничения
 
 DB_HOST = os.getenv("POSTGRES_HOST", "localhost")
 DB_PORT = os.getenv("POSTGRES_PORT", "5432")
 DB_NAME = os.getenv("POSTGRES_DB", "talklens")
 DB_USER = os.getenv("POSTGRES_USER", "postgres")
 DB_PASS = os.getenv("POSTGRES_PASSWORD", "postgres")
+DB_MIGRATE_ON_START = os.getenv("DB_MIGRATE_ON_START", "true").lower() == "true" # Миграция схемы при создании пула
+DB_HISTORY_PARTITION_MONTHS_AHEAD = int(os.getenv("DB_HISTORY_PARTITION_MONTHS_AHEAD", "3")) # Секции истории вперёд (если она секционирована)
+
+# Пул соединений PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10")) # Держать не меньше ANALYSIS_WORKERS: каждая дорожка сохраняет батч своим соединением
+DB_POOL_MAX_QUERIES = int(os.getenv("DB_POOL_MAX_QUERIES", "50000")) # После стольких запросов соединение пересоздается
+DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS = float(os.getenv("DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS", "300")) # 0 — не закрывать простаивающие
+DB_POOL_STATEMENT_CACHE_SIZE = int(os.getenv("DB_POOL_STATEMENT_CACHE_SIZE", "100")) # 0 — без подготовленных запросов (pgbouncer в режиме transaction)
+DB_POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT_SECONDS", "0")) # Ожидание свободного соединения; 0 — без ограничения
+
+# Кэш последних метрик и саммери диалогов
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000")) # Максимум записей каждого типа
+STATE_CACHE_TTL_SECONDS = float(os.getenv("STATE_CACHE_TTL_SECONDS", "600"))
+STATE_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("STATE_CACHE_NEGATIVE_TTL_SECONDS", "30")) # Сколько помнить, что строки в БД нет
@@ -0,0 +1,103 @@
+import json
+from typing import Any, Dict, Hashable, List, Tuple
+
+from aiokafka import AIOKafkaProducer
+
+
+class DeadLetterPublisher:
+    """
+    Отправляет записи, которые не удалось разобрать, и батчи, которые не удалось обработать,
+    в отдельный топик (dead-letter queue) вместе с причиной и исходной позицией,
+    чтобы их можно было разобрать и переиграть вручную
+    """
+
+    def __init__(self, bootstrap_servers: str, topic: str):
+        """
+        Args:
+            bootstrap_servers: Адрес Kafka
+            topic: Топик для битых записей; пустая строка — только логировать
+        """
+        self.topic = topic
+        self.producer = AIOKafkaProducer(bootstrap_servers=bootstrap_servers) if topic else None
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+
+    async def start(self):
+        """Подключает producer dead-letter топика"""
+        if self.producer is not None:
+            await self.producer.start()
+
+    async def stop(self):
+        """Отправляет оставшееся и отключает producer"""
+        if self.producer is not None:
+            await self.producer.stop()
+
+    async def publish(self, record, error: str):
+        """
+        Отправляет битую запись в dead-letter топик
+
+        Args:
+            record: Запись Kafka (ConsumerRecord)
+            error: Причина, по которой запись не прошла разбор
+        """
+        print(f"⚠️ Битое сообщение {record.topic}[{record.partition}]@{record.offset}: {error}")
+        if self.producer is None:
+            self.dropped += 1
+            return
+        headers = [
+            ("error", error.encode("utf-8")),
+            ("source_topic", record.topic.encode("utf-8")),
+            ("source_partition", str(record.partition).encode("utf-8")),
+            ("source_offset", str(record.offset).encode("utf-8"))
+        ]
+        try:
+            await self.producer.send_and_wait(self.topic, value=record.value, key=record.key, headers=headers)
+            self.published += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"❌ Не удалось отправить сообщение в {self.topic}: {e}")
+
+    async def publish_batch(self, key: Hashable, messages: List, positions: List[Tuple[Any, int]], error: str) -> bool:
+        """
+        Отправляет в dead-letter топик батч, анализ которого не удался за все попытки
+
+        Args:
+            key: Ключ диалога (session_id, interlocutor_id)
+            messages: Сообщения батча
+            positions: Позиции сообщений батча: (TopicPartition, offset)
+            error: Причина последней неудачи
+
+        Returns:
+            True, только если батч записан в топик; без топика или при ошибке отправки — False,
+            и оффсеты батча коммитить нельзя
+        """
+        session_id, interlocutor_id = key
+        print(f"⚠️ Батч сессии {session_id}, чата {interlocutor_id} ({len(messages)} сообщений) не обработан: {error}")
+        if self.producer is None:
+            self.dropped += 1
+            return False
+        value = json.dumps({
+            "SessionId": str(session_id),
+            "TelegramInterlocutorId": interlocutor_id,
+            "Messages": [message.to_dict() if hasattr(message, "to_dict") else dict(message) for message in messages],
+            "Positions": [[tp.topic, tp.partition, offset] for tp, offset in positions]
+        }, ensure_ascii=False).encode("utf-8")
+        headers = [("error", error.encode("utf-8")), ("kind", b"batch")]
+        try:
+            await self.producer.send_and_wait(self.topic, value=value, key=str(session_id).encode("utf-8"), headers=headers)
+            self.published += 1
+            return True
+        except Exception as e:
+            self.failed += 1
+            print(f"❌ Не удалось отправить батч в {self.topic}: {e}")
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики dead-letter очереди"""
+        return {
+            "topic": self.topic or None,
+            "published": self.published,
+            "failed": self.failed,
+            "dropped": self.dropped
+        }
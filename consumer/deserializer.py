@@ -0,0 +1,244 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+MESSAGE_FIELDS = ("SessionId", "TelegramInterlocutorId", "TelegramUserId", "SenderId", "MessageText")
+
+
+class _MessageAccess:
+    """Доступ к полям сообщения как к словарю: остальной код работает с m['SenderId'] и m.get(...)"""
+
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in MESSAGE_FIELDS}
+
+
+if msgspec is not None:
+    class TelegramMessage(msgspec.Struct, _MessageAccess, gc=False):
+        """Сообщение из Kafka: только поля, нужные анализу; остальные поля записи отбрасываются"""
+
+        SessionId: Union[str, int]
+        TelegramInterlocutorId: int
+        TelegramUserId: int
+        SenderId: int
+        MessageText: Optional[str] = ""
+
+        def __post_init__(self):
+            if self.MessageText is None:
+                self.MessageText = ""
+else:
+    class TelegramMessage(_MessageAccess):
+        """Сообщение из Kafka: только поля, нужные анализу; остальные поля записи отбрасываются"""
+
+        __slots__ = MESSAGE_FIELDS
+
+        def __init__(self, SessionId, TelegramInterlocutorId, TelegramUserId, SenderId, MessageText=""):
+            self.SessionId = SessionId
+            self.TelegramInterlocutorId = TelegramInterlocutorId
+            self.TelegramUserId = TelegramUserId
+            self.SenderId = SenderId
+            self.MessageText = MessageText if MessageText is not None else ""
+
+
+def _to_int(value: Any, field: str) -> int:
+    if isinstance(value, bool):
+        raise ValueError(f"поле {field}: ожидалось целое число")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.lstrip("-").isdigit():
+        return int(value)
+    raise ValueError(f"поле {field}: ожидалось целое число, получено {type(value).__name__}")
+
+
+def message_from_dict(data: Any) -> TelegramMessage:
+    """
+    Проверяет декодированную запись и собирает из неё TelegramMessage
+
+    Args:
+        data: Результат json.loads
+
+    Returns:
+        TelegramMessage
+
+    Raises:
+        ValueError: Если запись не соответствует схеме
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"ожидался JSON-объект, получено {type(data).__name__}")
+    missing = [field for field in MESSAGE_FIELDS[:4] if field not in data]
+    if missing:
+        raise ValueError(f"нет обязательных полей: {', '.join(missing)}")
+    session_id = data["SessionId"]
+    if not isinstance(session_id, (str, int)) or isinstance(session_id, bool):
+        raise ValueError("поле SessionId: ожидалась строка или целое число")
+    text = data.get("MessageText")
+    if text is not None and not isinstance(text, str):
+        raise ValueError("поле MessageText: ожидалась строка")
+    return TelegramMessage(
+        SessionId=session_id,
+        TelegramInterlocutorId=_to_int(data["TelegramInterlocutorId"], "TelegramInterlocutorId"),
+        TelegramUserId=_to_int(data["TelegramUserId"], "TelegramUserId"),
+        SenderId=_to_int(data["SenderId"], "SenderId"),
+        MessageText=text
+    )
+
+
+# Результат декодирования одной записи: (запись Kafka, сообщение или None, ошибка или None)
+DecodedRecord = Tuple[Any, Optional[TelegramMessage], Optional[str]]
+
+
+def _join_values(records) -> bytes:
+    """Склеивает значения записей в один JSON-массив, чтобы декодировать пачку одним вызовом"""
+    return b"[" + b",".join(record.value for record in records) + b"]"
+
+
+class JsonDeserializer:
+    """Декодирование через orjson (или стандартный json) с проверкой схемы на Python"""
+
+    def __init__(self, use_orjson: bool = True):
+        """
+        Args:
+            use_orjson: Использовать orjson, если он установлен
+        """
+        self.name = "orjson" if use_orjson and orjson is not None else "json"
+        self._loads = orjson.loads if self.name == "orjson" else json.loads
+        self.decoded = 0
+        self.malformed = 0
+        self.batch_fallbacks = 0
+
+    def decode_batch(self, records: List[Any]) -> List[DecodedRecord]:
+        """
+        Декодирует записи одного getmany. Пачка разбирается одним вызовом; если в ней
+        есть битая запись, пачка разбирается по одной, чтобы найти виновную.
+
+        Args:
+            records: Записи Kafka (ConsumerRecord)
+
+        Returns:
+            Список (запись, TelegramMessage или None, текст ошибки или None) в исходном порядке
+        """
+        if not records:
+            return []
+        values = None
+        if all(record.value is not None for record in records):
+            try:
+                values = self._loads(_join_values(records))
+            except ValueError:
+                pass
+        # Значение записи могло содержать несколько JSON-значений через запятую
+        if values is not None and len(values) != len(records):
+            values = None
+        if values is None:
+            self.batch_fallbacks += 1
+
+        results = []
+        for index, record in enumerate(records):
+            try:
+                data = values[index] if values is not None else self._loads_one(record)
+                results.append((record, message_from_dict(data), None))
+                self.decoded += 1
+            except ValueError as e:
+                results.append((record, None, str(e)))
+                self.malformed += 1
+        return results
+
+    def _loads_one(self, record):
+        if record.value is None:
+            raise ValueError("пустое значение записи")
+        try:
+            return self._loads(record.value)
+        except ValueError as e:
+            # UnicodeDecodeError и JSONDecodeError (в том числе orjson) — подклассы ValueError
+            raise ValueError(f"некорректный JSON: {e}") from None
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики десериализатора"""
+        return {
+            "deserializer": self.name,
+            "decoded": self.decoded,
+            "malformed": self.malformed,
+            "batch_fallbacks": self.batch_fallbacks
+        }
+
+
+class MsgspecDeserializer(JsonDeserializer):
+    """Декодирование и проверка схемы за один проход через msgspec прямо в TelegramMessage"""
+
+    def __init__(self):
+        super().__init__(use_orjson=False)
+        self.name = "msgspec"
+        # strict=False разрешает числа в строках ("123"), как и проверка на Python
+        self._batch_decoder = msgspec.json.Decoder(List[TelegramMessage], strict=False)
+        self._decoder = msgspec.json.Decoder(TelegramMessage, strict=False)
+
+    def decode_batch(self, records: List[Any]) -> List[DecodedRecord]:
+        if not records:
+            return []
+        if all(record.value is not None for record in records):
+            try:
+                messages = self._batch_decoder.decode(_join_values(records))
+                if len(messages) == len(records):
+                    self.decoded += len(messages)
+                    return [(record, message, None) for record, message in zip(records, messages)]
+            except msgspec.DecodeError:
+                pass
+        self.batch_fallbacks += 1
+
+        results = []
+        for record in records:
+            if record.value is None:
+                results.append((record, None, "пустое значение записи"))
+                self.malformed += 1
+                continue
+            try:
+                results.append((record, self._decoder.decode(record.value), None))
+                self.decoded += 1
+            except msgspec.DecodeError as e:
+                results.append((record, None, str(e)))
+                self.malformed += 1
+        return results
+
+
+def create_deserializer(name: str = "auto"):
+    """
+    Создаёт десериализатор сообщений Kafka
+
+    Args:
+        name: "auto" (msgspec, затем orjson, затем json), "msgspec", "orjson" или "json"
+
+    Returns:
+        Десериализатор с методами decode_batch и stats
+    """
+    if name == "auto":
+        name = "msgspec" if msgspec is not None else "orjson" if orjson is not None else "json"
+    if name == "msgspec":
+        if msgspec is None:
+            raise ValueError("Десериализатор 'msgspec' недоступен: пакет msgspec не установлен")
+        return MsgspecDeserializer()
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("Десериализатор 'orjson' недоступен: пакет orjson не установлен")
+        return JsonDeserializer(use_orjson=True)
+    if name == "json":
+        return JsonDeserializer(use_orjson=False)
+    raise ValueError(f"Неизвестный десериализатор: {name}. Доступные: 'auto', 'msgspec', 'orjson', 'json'")
@@ -1,12 +1,31 @@
 import socket
 import asyncio
 from aiokafka import AIOKafkaConsumer
-import json
 import time
 import threading
-from utils.batching import SessionBatcher
-from config import KAFKA_BOOTSTRAP_SERVERS, KAFKA_TOPIC, BATCH_SIZE, BATCH_TIMEOUT_SECONDS
+from collections import deque
+from utils.batching import SessionBatcher, PersistentSessionBatcher
+from consumer.offsets import OffsetTracker
+from utils.keyed_executor import KeyedExecutor
+from utils.adaptive_batching import AdaptiveBatchController
+from utils.messages import MessageRecord
+from consumer.rebalance import ConsumerState, BatcherRebalanceListener
+from consumer.deserializer import create_deserializer
+from consumer.dead_letter import DeadLetterPublisher
+from config import (
+    KAFKA_BOOTSTRAP_SERVERS, KAFKA_TOPIC, KAFKA_GROUP_ID, KAFKA_DLQ_TOPIC, KAFKA_DESERIALIZER,
+    BATCH_SIZE, BATCH_TIMEOUT_SECONDS,
+    ANALYSIS_QUEUE_SIZE, ANALYSIS_WORKERS, OFFSET_COMMIT_INTERVAL_SECONDS,
+    ANALYSIS_MAX_ATTEMPTS, ANALYSIS_RETRY_BACKOFF_SECONDS,
+    BATCHER_BACKEND, BATCHER_DB_PATH, BATCHER_MEMORY_CAP_MESSAGES,
+    BATCH_ADAPTIVE, BATCH_SIZE_MIN, BATCH_SIZE_MAX, BATCH_TIMEOUT_MIN_SECONDS, BATCH_TIMEOUT_MAX_SECONDS,
+    BATCH_TARGET_LATENCY_SECONDS,
+    REBALANCE_FLUSH_ON_REVOKE, REBALANCE_REVOKE_TIMEOUT_SECONDS, LLM_TYPE
+)
 from services.analysis_service import analysis_service
+from services.db_service import db_service
+from processor.response_cache import get_response_cache
+from processor import llm_handler
 
 async def start_consumer():
     """Асинхронный обработчик сообщений Kafka"""
@@ -25,52 +44,137 @@ async def start_consumer():
         bootstrap_servers = KAFKA_BOOTSTRAP_SERVERS
     
     print(f"🔄 Итоговый адрес для подключения: {bootstrap_servers}")
+    
+    # Без БД и актуальной схемы батчи не сохранить: не начинаем читать Kafka
+    await db_service.start()
+    # LLM создается лениво; в режиме local это загрузка модели на десятки секунд.
+    # Загружаем её в потоке до подключения к группе, иначе первый батч заблокировал бы
+    # event loop вместе с heartbeat-ами Kafka
+    start_time = time.time()
+    await asyncio.to_thread(llm_handler.get_async_llm)
+    print(f"✅ LLM ({LLM_TYPE}) готова за {time.time() - start_time:.2f} сек")
     consumer = AIOKafkaConsumer(
-        KAFKA_TOPIC,
         bootstrap_servers=bootstrap_servers,
-        group_id='telegram-metrics-group',
-        auto_offset_reset='earliest'
+        group_id=KAFKA_GROUP_ID,
+        auto_offset_reset='earliest',
+        enable_auto_commit=False
     )
     
+    controller = None
+    if BATCH_ADAPTIVE:
+        controller = AdaptiveBatchController(
+            size_min=BATCH_SIZE_MIN,
+            size_max=BATCH_SIZE_MAX,
+            wait_min=BATCH_TIMEOUT_MIN_SECONDS,
+            wait_max=BATCH_TIMEOUT_MAX_SECONDS,
+            target_latency=BATCH_TARGET_LATENCY_SECONDS
+        )
+    
+    if BATCHER_BACKEND == "sqlite":
+        batcher = PersistentSessionBatcher(
+            BATCHER_DB_PATH,
+            max_batch_size=BATCH_SIZE,
+            max_wait=BATCH_TIMEOUT_SECONDS,
+            memory_cap_messages=BATCHER_MEMORY_CAP_MESSAGES,
+            controller=controller
+        )
+    else:
+        batcher = SessionBatcher(max_batch_size=BATCH_SIZE, max_wait=BATCH_TIMEOUT_SECONDS, controller=controller)
+    tracker = OffsetTracker()
+    dead_letters = DeadLetterPublisher(bootstrap_servers, KAFKA_DLQ_TOPIC)
+    
+    # Батчи одного диалога обрабатываются строго по очереди в своей дорожке,
+    # разные диалоги — параллельно в разных дорожках
+    async def handle_batch(item):
+        await analysis_worker(item, tracker, dead_letters, controller, state)
+    
+    executor = KeyedExecutor(
+        handle_batch,
+        lanes=ANALYSIS_WORKERS,
+        lane_capacity=max(1, ANALYSIS_QUEUE_SIZE // ANALYSIS_WORKERS)
+    )
+    # Готовые батчи, которые пока не поместились в дорожки, и флаг паузы чтения
+    state = ConsumerState()
+    executor.start()
+    backlog = state.backlog
+    
+    # Реплики делят партиции топика; при ребалансировке диалоги отзываемых партиций
+    # дообрабатываются и коммитятся до передачи новому владельцу
+    listener = BatcherRebalanceListener(
+        consumer, batcher, tracker, executor, state,
+        flush_on_revoke=REBALANCE_FLUSH_ON_REVOKE,
+        revoke_timeout=REBALANCE_REVOKE_TIMEOUT_SECONDS,
+        flush_summaries=analysis_service.flush_summaries,
+        state_cache=db_service.state_cache
+    )
+    consumer.subscribe([KAFKA_TOPIC], listener=listener)
     await consumer.start()
     
-    batcher = SessionBatcher(max_batch_size=BATCH_SIZE, max_wait=BATCH_TIMEOUT_SECONDS)
+    deserializer = create_deserializer(KAFKA_DESERIALIZER)
+    await dead_letters.start()
+    last_commit = time.time()
     
-    metrics_flush_task = asyncio.create_task(metrics_flusher())
+    flusher_task = asyncio.create_task(
+        state_flusher(executor, batcher, state, controller, deserializer, dead_letters)
+    )
     
-    print("Kafka consumer started...")
+    print(f"Kafka consumer started (группа: {KAFKA_GROUP_ID}, дорожек: {executor.lanes}, "
+          f"ёмкость дорожки: {executor.lane_capacity}, десериализатор: {deserializer.name})...")
     
     try:
         while True:
             try:
 
-                batch = await consumer.getmany(timeout_ms=1000)
+                batch = await consumer.getmany(timeout_ms=100 if state.paused else 1000)
                 
-                for tp, messages in batch.items():
-                    for msg in messages:
-                        try:
-                            message = json.loads(msg.value.decode('utf-8'))
-                            session_id = message["SessionId"]
-                            interlocutor_id = message["TelegramInterlocutorId"]
-                            telegram_user_id = message["TelegramUserId"]
-                            
-                            batcher.add_message(session_id, interlocutor_id, message)
-                        except Exception as e:
-                            print(f"Error parsing message: {e}")
+                for tp, records in batch.items():
+                    # Сообщения, уже восстановленные из накопителя, повторно не разбираются
+                    records = [msg for msg in records if not tracker.redelivered(tp, msg.offset)]
+                    for msg, message, error in deserializer.decode_batch(records):
+                        if error is not None:
+                            await dead_letters.publish(msg, error)
+                            tracker.skip(tp, msg.offset)
+                            continue
+                        session_id = message.SessionId
+                        interlocutor_id = message.TelegramInterlocutorId
+                        
+                        # В буфере хранится только то, что нужно анализу
+                        record = MessageRecord.from_mapping(message)
+                        batcher.add_message(session_id, interlocutor_id, record, (tp, msg.offset))
+                        tracker.track((session_id, interlocutor_id), tp, msg.offset)
+                batcher.sync()
                 
 
-                for (session_id, interlocutor_id), batch in batcher.get_ready_batches():
-                    print(f"Processing batch for session {session_id}, chat {interlocutor_id}, size={len(batch)}")
-                    
-
-                    telegram_user_id = batch[0].get("TelegramUserId", 0)
-                    
+                if state.rebalancing:
+                    await asyncio.sleep(0.01)
+                    continue
+                
+                if controller is not None:
+                    controller.update(executor.total_depth() + len(backlog), executor.capacity)
+                
+                if not backlog:
+                    for key, ready_batch in batcher.get_ready_batches():
+                        backlog.append((key, ready_batch, tracker.take(key)))
+                
+                dispatch_backlog(executor, backlog)
+                
 
-                    asyncio.create_task(
-                        process_batch(session_id, telegram_user_id, interlocutor_id, batch)
-                    )
+                overloaded = bool(backlog)
+                if overloaded and not state.paused:
+                    partitions = consumer.assignment()
+                    consumer.pause(*partitions)
+                    state.paused = True
+                    print(f"⏸️ Дорожки анализа заполнены ({executor.total_depth()}), приостанавливаем чтение из Kafka")
+                elif state.paused and not backlog and executor.total_depth() <= executor.capacity // 2:
+                    consumer.resume(*consumer.assignment())
+                    state.paused = False
+                    print(f"▶️ Дорожки анализа разгружены ({executor.total_depth()}), возобновляем чтение из Kafka")
                 
 
+                if time.time() - last_commit >= OFFSET_COMMIT_INTERVAL_SECONDS:
+                    await commit_offsets(consumer, tracker)
+                    last_commit = time.time()
+                
                 await asyncio.sleep(0.01)
                 
             except Exception as e:
@@ -79,8 +183,94 @@ async def start_consumer():
     
     finally:
 
-        metrics_flush_task.cancel()
+        await executor.stop()
+        flusher_task.cancel()
+        await asyncio.gather(flusher_task, return_exceptions=True)
+        # Сообщения отложенных саммери уже закоммичены: после остановки их никто не перечитает
+        try:
+            await analysis_service.flush_summaries()
+        except Exception as e:
+            print(f"Error saving pending summaries on shutdown: {e}")
+        try:
+            await commit_offsets(consumer, tracker)
+        except Exception as e:
+            print(f"Error committing offsets on shutdown: {e}")
         await consumer.stop()
+        await dead_letters.stop()
+        batcher.close()
+
+def dispatch_backlog(executor: KeyedExecutor, backlog: deque):
+    """
+    Раздаёт готовые батчи по дорожкам. Если дорожка заполнена, её батчи остаются
+    в backlog, но батчи других дорожек проходят; порядок внутри диалога сохраняется,
+    потому что все его батчи идут в одну дорожку.
+    """
+    blocked_lanes = set()
+    remaining = deque()
+    while backlog:
+        key, ready_batch, positions = backlog.popleft()
+        lane = executor.lane_for(key)
+        if lane in blocked_lanes or not executor.try_submit(key, (key, ready_batch, positions)):
+            blocked_lanes.add(lane)
+            remaining.append((key, ready_batch, positions))
+            continue
+        session_id, interlocutor_id = key
+        print(f"Processing batch for session {session_id}, chat {interlocutor_id}, size={len(ready_batch)}, lane={lane}")
+    backlog.extend(remaining)
+
+async def analysis_worker(item, tracker: OffsetTracker, dead_letters: DeadLetterPublisher,
+                          controller: AdaptiveBatchController = None, state: ConsumerState = None):
+    """
+    Обрабатывает готовый батч и отмечает его сообщения обработанными только после того,
+    как результаты сохранены. Неудачный батч повторяется в той же дорожке (следующие
+    батчи диалога ждут); после каждых ANALYSIS_MAX_ATTEMPTS неудач он отправляется
+    в dead-letter топик. Если отправить не удалось или топик не задан, попытки
+    продолжаются: пока батч не обработан и не записан в DLQ, его оффсеты остаются
+    незавершенными и коммит партиции не проходит дальше них, а заполненные дорожки
+    приостанавливают чтение из Kafka.
+    """
+    key, messages, positions = item
+    session_id, interlocutor_id = key
+    start_time = time.monotonic()
+    try:
+        telegram_user_id = messages[0].get("TelegramUserId", 0)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await process_batch(session_id, telegram_user_id, interlocutor_id, messages)
+                if state is not None:
+                    remember_summary_partitions(state, key, positions)
+                break
+            except Exception as e:
+                round_attempt = (attempt - 1) % ANALYSIS_MAX_ATTEMPTS + 1
+                if round_attempt == ANALYSIS_MAX_ATTEMPTS:
+                    if await dead_letters.publish_batch(key, messages, positions, f"{type(e).__name__}: {e}"):
+                        break
+                    print(f"❌ Батч сессии {session_id}, чата {interlocutor_id} не обработан и не записан в DLQ: "
+                          f"оффсеты не коммитятся, продолжаем попытки")
+                delay = ANALYSIS_RETRY_BACKOFF_SECONDS * 2 ** (round_attempt - 1)
+                print(f"🔁 Батч сессии {session_id}, чата {interlocutor_id} не обработан (попытка "
+                      f"{attempt}), повтор через {delay:.0f} сек: {e}")
+                await asyncio.sleep(delay)
+        tracker.complete(positions)
+    finally:
+        if controller is not None:
+            controller.observe_latency(time.monotonic() - start_time)
+
+def remember_summary_partitions(state: ConsumerState, key, positions):
+    """Запоминает партиции диалога, пока его саммери отложено, чтобы сохранить его при отзыве партиций"""
+    if key in analysis_service.summary_pending:
+        state.summary_partitions.setdefault(key, set()).update(tp for tp, _ in positions)
+    else:
+        state.summary_partitions.pop(key, None)
+
+async def commit_offsets(consumer, tracker: OffsetTracker):
+    """Коммитит оффсеты сообщений, обработка которых полностью завершена"""
+    offsets = tracker.committable()
+    if offsets:
+        await consumer.commit(offsets)
+        tracker.mark_committed(offsets)
 
 async def process_batch(session_id, telegram_user_id, interlocutor_id, messages):
     """Асинхронно обрабатывает готовый батч сообщений"""
@@ -89,17 +279,35 @@ async def process_batch(session_id, telegram_user_id, interlocutor_id, messages)
 
     await analysis_service.process_batch(session_id, telegram_user_id, interlocutor_id, messages)
 
-async def metrics_flusher():
-    """Периодически сохраняет накопленные метрики в БД"""
+async def state_flusher(executor: KeyedExecutor, batcher: SessionBatcher, state: ConsumerState,
+                        controller: AdaptiveBatchController = None, deserializer=None,
+                        dead_letters: DeadLetterPublisher = None):
+    """Сохраняет отложенные саммери давно молчащих диалогов и раз в минуту печатает статистику"""
+    last_stats = time.time()
     while True:
         try:
-            await asyncio.sleep(60)
-            await analysis_service.flush_metrics()
-        except asyncio.CancelledError:
-
-            break
+            await asyncio.sleep(1)
+            await analysis_service.flush_idle_summaries()
+            if time.time() - last_stats >= 60:
+                print(f"📈 Дорожки анализа: {executor.stats()}")
+                print(f"📈 Накопитель батчей: {batcher.stats()}")
+                if deserializer is not None:
+                    print(f"📈 Разбор сообщений: {deserializer.stats()}, DLQ: {dead_letters.stats()}")
+                if controller is not None:
+                    controller.forget_idle(time.time())
+                    print(f"📈 Адаптивный батчинг: {controller.stats()}")
+                for key in [key for key in state.summary_partitions if key not in analysis_service.summary_pending]:
+                    del state.summary_partitions[key]
+                print(f"📈 Кэш состояния диалогов: {db_service.state_cache.stats()}, "
+                      f"отложенных саммери: {len(analysis_service.summary_pending)}")
+                if db_service.pool is not None:
+                    print(f"📈 Пул БД: {db_service.pool.stats()}")
+                response_cache = get_response_cache()
+                if response_cache is not None:
+                    print(f"📈 Кэш ответов LLM: {response_cache.stats()}")
+                last_stats = time.time()
         except Exception as e:
-            print(f"Error in metrics flusher: {e}")
+            print(f"Error in state flusher: {e}")
             await asyncio.sleep(10)
 
 def run():
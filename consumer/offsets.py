@@ -0,0 +1,138 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple, Hashable, Any
+
+
+class OffsetTracker:
+    """
+    Отслеживает, какие сообщения Kafka ещё не обработаны, и вычисляет
+    безопасные для коммита оффсеты: коммитится только то, что уже прошло
+    через AnalysisService.process_batch (at-least-once).
+    """
+
+    def __init__(self):
+        self.pending = defaultdict(set)
+        self.highest: Dict[Any, int] = {}
+        self.committed: Dict[Any, int] = {}
+        self.positions_by_key = defaultdict(list)
+        # Позиции сообщений, восстановленных из накопителя: Kafka доставит их повторно
+        self.restored = set()
+
+    def _see(self, tp, offset: int):
+        if offset > self.highest.get(tp, -1):
+            self.highest[tp] = offset
+
+    def track(self, key: Hashable, tp, offset: int):
+        """
+        Регистрирует сообщение, которое попало в батч диалога key
+
+        Args:
+            key: Ключ диалога (session_id, interlocutor_id)
+            tp: TopicPartition сообщения
+            offset: Оффсет сообщения
+        """
+        self._see(tp, offset)
+        self.pending[tp].add(offset)
+        self.positions_by_key[key].append((tp, offset))
+
+    def restore(self, key: Hashable, tp, offset: int):
+        """Регистрирует сообщение, восстановленное из персистентного накопителя"""
+        self.track(key, tp, offset)
+        self.restored.add((tp, offset))
+
+    def redelivered(self, tp, offset: int) -> bool:
+        """
+        Проверяет, что сообщение уже восстановлено из накопителя и его повторную доставку нужно пропустить
+
+        Args:
+            tp: TopicPartition сообщения
+            offset: Оффсет сообщения
+
+        Returns:
+            True, если сообщение уже учтено
+        """
+        if (tp, offset) in self.restored:
+            self.restored.discard((tp, offset))
+            return True
+        return False
+
+    def skip(self, tp, offset: int):
+        """Отмечает сообщение, которое не требует обработки (например, битое)"""
+        self._see(tp, offset)
+
+    def take(self, key: Hashable) -> List[Tuple[Any, int]]:
+        """
+        Забирает позиции всех сообщений диалога, ушедших в обработку вместе с батчем
+
+        Args:
+            key: Ключ диалога
+
+        Returns:
+            Список пар (TopicPartition, offset)
+        """
+        return self.positions_by_key.pop(key, [])
+
+    def complete(self, positions: List[Tuple[Any, int]]):
+        """Отмечает сообщения как полностью обработанные"""
+        for tp, offset in positions:
+            self.pending[tp].discard(offset)
+
+    def committable(self, partitions: Iterable = None) -> Dict[Any, int]:
+        """
+        Возвращает оффсеты, которые можно закоммитить и которые ещё не закоммичены
+
+        Args:
+            partitions: Ограничить результат этими партициями (по умолчанию — все)
+
+        Returns:
+            Dict {TopicPartition: следующий оффсет для чтения}
+        """
+        partitions = set(partitions) if partitions is not None else None
+        offsets = {}
+        for tp, highest in self.highest.items():
+            if partitions is not None and tp not in partitions:
+                continue
+            pending = self.pending.get(tp)
+            next_offset = min(pending) if pending else highest + 1
+            if next_offset > self.committed.get(tp, -1):
+                offsets[tp] = next_offset
+        return offsets
+
+    def mark_committed(self, offsets: Dict[Any, int]):
+        """Запоминает успешно закоммиченные оффсеты"""
+        self.committed.update(offsets)
+
+    def pending_count(self) -> int:
+        """Количество сообщений, ещё не прошедших обработку"""
+        return sum(len(offsets) for offsets in self.pending.values())
+
+    def keys_for_partitions(self, partitions: Iterable) -> Set[Hashable]:
+        """Диалоги, у которых есть ещё не отданные в обработку сообщения из указанных партиций"""
+        partitions = set(partitions)
+        return {
+            key for key, positions in self.positions_by_key.items()
+            if any(tp in partitions for tp, _ in positions)
+        }
+
+    def pending_in(self, partitions: Iterable) -> int:
+        """Количество необработанных сообщений в указанных партициях"""
+        return sum(len(self.pending.get(tp, ())) for tp in partitions)
+
+    def forget(self, partitions: Iterable):
+        """
+        Сбрасывает всё состояние по партициям (после отзыва или перед повторным назначением)
+
+        Args:
+            partitions: Список TopicPartition
+        """
+        partitions = set(partitions)
+        for tp in partitions:
+            self.pending.pop(tp, None)
+            self.highest.pop(tp, None)
+            self.committed.pop(tp, None)
+        self.restored = {(tp, offset) for tp, offset in self.restored if tp not in partitions}
+        for key in list(self.positions_by_key):
+            positions = [(tp, offset) for tp, offset in self.positions_by_key[key] if tp not in partitions]
+            if positions:
+                self.positions_by_key[key] = positions
+            else:
+                del self.positions_by_key[key]
@@ -0,0 +1,201 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, Set
+
+from aiokafka import ConsumerRebalanceListener, TopicPartition
+
+from consumer.offsets import OffsetTracker
+from services.state_cache import LatestStateCache
+from utils.batching import SessionBatcher
+from utils.keyed_executor import KeyedExecutor
+
+
+class ConsumerState:
+    """Изменяемое состояние цикла чтения, общее для consumer и обработчика ребалансировки"""
+
+    def __init__(self):
+        self.paused = False
+        # Во время ребалансировки основной цикл не раздаёт батчи, чтобы не нарушить порядок в диалоге
+        self.rebalancing = False
+        self.backlog = deque()
+        # Диалоги с отложенным саммери -> партиции их сообщений: при отзыве партиции саммери сохраняется
+        self.summary_partitions = {}
+
+
+class BatcherRebalanceListener(ConsumerRebalanceListener):
+    """
+    Передаёт диалоги между репликами при ребалансировке группы.
+
+    При отзыве партиций накопленные батчи их диалогов отправляются в обработку,
+    обработчик ждёт их завершения (не дольше revoke_timeout), коммитит обработанное
+    и забывает остальное: незакоммиченные сообщения новый владелец партиции
+    прочитает заново с последнего коммита. Отложенные саммери диалогов отзываемых партиций
+    сохраняются досрочно: их сообщения уже закоммичены и новому владельцу не достанутся.
+    При назначении партиций состояние
+    по ним начинается с чистого листа — буферы восстанавливаются повторным чтением
+    с закоммиченного оффсета, а после перезапуска — из персистентного накопителя.
+    Кэш последнего состояния диалогов тоже сбрасывается: пока партиция была у другой
+    реплики, тот записывал в БД более свежие метрики и саммери.
+    """
+
+    def __init__(self, consumer, batcher: SessionBatcher, tracker: OffsetTracker, executor: KeyedExecutor,
+                 state: ConsumerState, flush_on_revoke: bool = True, revoke_timeout: float = 30.0,
+                 flush_summaries: Optional[Callable[[List], Awaitable]] = None,
+                 state_cache: Optional[LatestStateCache] = None):
+        """
+        Args:
+            consumer: AIOKafkaConsumer
+            batcher: Накопитель батчей по диалогам
+            tracker: Трекер оффсетов
+            executor: Дорожки анализа
+            state: Общее состояние цикла чтения
+            flush_on_revoke: Обрабатывать неполные батчи отзываемых партиций (иначе — отдать новому владельцу)
+            revoke_timeout: Сколько секунд ждать завершения обработки при отзыве
+            flush_summaries: Сохраняет отложенные саммери переданных диалогов
+            state_cache: Кэш последнего состояния диалогов, сбрасываемый при назначении партиций
+        """
+        self.consumer = consumer
+        self.batcher = batcher
+        self.tracker = tracker
+        self.executor = executor
+        self.state = state
+        self.flush_on_revoke = flush_on_revoke
+        self.revoke_timeout = revoke_timeout
+        self.flush_summaries = flush_summaries
+        self.state_cache = state_cache
+
+    async def on_partitions_revoked(self, revoked):
+        revoked = set(revoked)
+        if not revoked:
+            return
+        print(f"🔀 Отзываются партиции: {sorted(str(tp) for tp in revoked)}")
+        self.state.rebalancing = True
+        try:
+            if self.flush_on_revoke:
+                await self._flush(self.tracker.keys_for_partitions(revoked))
+            dropped = self._drop_undispatched(revoked)
+
+            await self._wait_processed(revoked, dropped)
+            await self._flush_summaries(revoked)
+
+            offsets = self.tracker.committable(revoked)
+            if offsets:
+                try:
+                    await self.consumer.commit(offsets)
+                    self.tracker.mark_committed(offsets)
+                    print(f"✅ Закоммичены оффсеты отзываемых партиций: {len(offsets)}")
+                except Exception as e:
+                    print(f"❌ Не удалось закоммитить оффсеты при отзыве партиций: {e}")
+
+            self.tracker.forget(revoked)
+        finally:
+            self.batcher.sync()
+            self.state.rebalancing = False
+
+    async def on_partitions_assigned(self, assigned):
+        assigned = set(assigned)
+        print(f"🔀 Назначены партиции: {sorted(str(tp) for tp in assigned)}")
+        # Старое состояние по этим партициям (если они уже были нашими) неактуально:
+        # чтение продолжится с закоммиченного оффсета, а буферы после перезапуска
+        # поднимает персистентный накопитель
+        self.tracker.forget(assigned)
+        # Ребалансировка отзывает и назначает партиции целиком, поэтому проще забыть всё:
+        # диалог, вернувшийся к реплике, иначе прочитал бы метрики до переезда
+        if self.state_cache is not None:
+            self.state_cache.clear()
+        if self.batcher.restorable:
+            # Накопитель не должен вернуть то, что группа уже закоммитила
+            committed = {tp: await self.consumer.committed(tp) for tp in assigned}
+            for key, (topic, partition), offset in self.batcher.restore(assigned, committed):
+                self.tracker.restore(key, TopicPartition(topic, partition), offset)
+        if self.state.paused and assigned:
+            self.consumer.pause(*assigned)
+
+    async def _flush(self, keys: Set):
+        """Отправляет в дорожки отложенные батчи и неполные батчи указанных диалогов по порядку"""
+        deadline = time.monotonic() + self.revoke_timeout
+        # Сначала то, что уже стоит в очереди: внутри диалога важен порядок
+        pending = list(self.state.backlog)
+        self.state.backlog.clear()
+        for key in keys:
+            messages = self.batcher.pop_batch(key)
+            if messages:
+                pending.append((key, messages, self.tracker.take(key)))
+        if pending:
+            print(f"🔄 Досрочно обрабатываем {len(pending)} батчей перед передачей партиций")
+
+        for index, (key, messages, positions) in enumerate(pending):
+            timeout = deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(self.executor.submit(key, (key, messages, positions)), max(timeout, 0.001))
+            except asyncio.TimeoutError:
+                # Неотправленное вернётся в очередь; сообщения отзываемых партиций будут забыты
+                self.state.backlog.extend(pending[index:])
+                print(f"⚠️ Не хватило времени на отправку {len(pending) - index} батчей при ребалансировке")
+                return
+
+    async def _flush_summaries(self, partitions: Set):
+        """Сохраняет отложенные саммери диалогов, чьи сообщения пришли из отзываемых партиций"""
+        keys = [key for key, tps in self.state.summary_partitions.items() if tps & partitions]
+        for key in keys:
+            del self.state.summary_partitions[key]
+        if not keys or self.flush_summaries is None:
+            return
+        try:
+            await asyncio.wait_for(self.flush_summaries(keys), self.revoke_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Не хватило времени сохранить отложенные саммери {len(keys)} диалогов при ребалансировке")
+        except Exception as e:
+            print(f"❌ Ошибка при сохранении отложенных саммери при ребалансировке: {e}")
+
+    def _drop_undispatched(self, partitions: Set) -> Set:
+        """
+        Убирает из буферов и очереди сообщения отзываемых партиций, которые ещё не ушли в дорожки:
+        их прочитает заново новый владелец
+
+        Returns:
+            Множество позиций (TopicPartition, offset) убранных сообщений
+        """
+        dropped = set()
+        for key in self.tracker.keys_for_partitions(partitions):
+            received_at = self.batcher.timestamps.get(key)
+            messages = self.batcher.pop_batch(key)
+            positions = self.tracker.take(key)
+            kept_messages, kept_positions = [], []
+            # Сообщения и позиции диалога добавляются парами, поэтому идут в одном порядке
+            for message, (tp, offset) in zip(messages, positions):
+                if tp in partitions:
+                    dropped.add((tp, offset))
+                else:
+                    kept_messages.append(message)
+                    kept_positions.append((tp, offset))
+            # Оставшиеся сообщения возвращаются в буфер с прежним сроком, а не как только что прочитанные
+            self.batcher.requeue(key, kept_messages, kept_positions, received_at)
+            for tp, offset in kept_positions:
+                self.tracker.track(key, tp, offset)
+
+        kept = deque()
+        for key, messages, positions in self.state.backlog:
+            if positions and all(tp in partitions for tp, _ in positions):
+                dropped.update(positions)
+            else:
+                kept.append((key, messages, positions))
+        self.state.backlog.clear()
+        self.state.backlog.extend(kept)
+        return dropped
+
+    async def _wait_processed(self, partitions: Set, dropped: Set):
+        """Ждёт, пока обработаются все отданные в дорожки сообщения указанных партиций"""
+        def in_flight():
+            return sum(
+                1 for tp in partitions for offset in self.tracker.pending.get(tp, ())
+                if (tp, offset) not in dropped
+            )
+
+        deadline = time.monotonic() + self.revoke_timeout
+        while in_flight() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        remaining = in_flight()
+        if remaining:
+            print(f"⚠️ При отзыве партиций не дождались обработки {remaining} сообщений, их обработает новый владелец")
@@ -2,6 +2,8 @@ import asyncio
 import signal
 import platform
 from consumer.kafka_consumer import start_consumer
+from processor import llm_handler
+from services.db_service import db_service
 
 async def main():
     """Главная точка входа в приложение"""
@@ -36,6 +38,8 @@ async def shutdown():
     
     await asyncio.gather(*tasks, return_exceptions=True)
     
+    await llm_handler.close()
+    await db_service.close_pool()
 
 
     if platform.system() != 'Windows':
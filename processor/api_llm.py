@@ -2,19 +2,33 @@ import json
 import re
 import time
 from typing import List, Dict, Any, Optional
-from yandex_cloud_ml_sdk import YCloudML
 
-from .llm_interface import LLMInterface
+from .llm_interface import LLMInterface, split_all_metrics
+from .response_cache import ResponseCache, make_cache_key
+from utils.messages import Message
 from .yandex_prompts import (
     compliments_messages,
     engagement_messages,
     attachment_messages,
+    all_metrics_messages,
     recommendations_messages,
-    summary_messages
+    summary_messages,
+    compact_summary_messages,
+    json_repair_prompt,
+    COMPLIMENTS_SCHEMA,
+    ENGAGEMENT_SCHEMA,
+    ATTACHMENT_SCHEMA,
+    ALL_METRICS_SCHEMA
 )
 
 class ApiLLM(LLMInterface):
-    def __init__(self, api_url: str = None, api_key: str = None, folder_id: str = None):
+    def __init__(
+        self,
+        api_url: str = None,
+        api_key: str = None,
+        folder_id: str = None,
+        response_cache: Optional[ResponseCache] = None
+    ):
         """
         Инициализирует клиент для работы с YandexGPT API
         
@@ -22,10 +36,12 @@ class ApiLLM(LLMInterface):
             api_url: Не используется для YandexGPT, оставлен для совместимости
             api_key: API ключ для YandexGPT
             folder_id: Идентификатор каталога Yandex Cloud
+            response_cache: Кэш ответов по хэшу запроса (если не указан, ответы не кэшируются)
         """
         self.api_url = api_url
         self.api_key = api_key
         self.folder_id = folder_id
+        self.response_cache = response_cache
         self.sdk = None
         
         print("🔄 Инициализация API-клиента без проверки сети")
@@ -33,6 +49,8 @@ class ApiLLM(LLMInterface):
         if folder_id and api_key:
             try:
                 print(f"🔄 Инициализация YCloudML SDK с folder_id={folder_id[:5]}...")
+                # SDK нужен только синхронному клиенту; AsyncApiLLM берет отсюда лишь разбор ответов
+                from yandex_cloud_ml_sdk import YCloudML
                 self.sdk = YCloudML(
                     folder_id=folder_id,
                     auth=api_key
@@ -47,12 +65,12 @@ class ApiLLM(LLMInterface):
         else:
             print("⚠️ Предупреждение: API не сконфигурирован должным образом")
 
-    def _format_messages(self, messages: List[Dict[str, Any]]) -> str:
+    def _format_messages(self, messages: List[Message]) -> str:
         """
         Форматирует список сообщений в текст для чата
         
         Args:
-            messages: Список сообщений для форматирования
+            messages: Список сообщений (словари или MessageRecord)
             
         Returns:
             Отформатированный текст чата
@@ -62,7 +80,31 @@ class ApiLLM(LLMInterface):
 
     def _make_request(self, messages: List[Dict[str, str]], max_retries: int = 3) -> str:
         """
-        Выполняет запрос к YandexGPT API
+        Выполняет запрос к YandexGPT API, используя кэш ответов для повторяющихся запросов
+        
+        Args:
+            messages: Список сообщений в формате YandexGPT
+            max_retries: Максимальное количество попыток
+            
+        Returns:
+            Текст ответа от API
+        """
+        if self.response_cache is None:
+            return self._send_request(messages, max_retries)
+
+        key = make_cache_key("yandexgpt", 0.0, messages)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            print(f"🗄️ Ответ YandexGPT взят из кэша, длина: {len(cached)} символов")
+            return cached
+
+        text = self._send_request(messages, max_retries)
+        self.response_cache.set(key, text)
+        return text
+
+    def _send_request(self, messages: List[Dict[str, str]], max_retries: int = 3) -> str:
+        """
+        Отправляет запрос к YandexGPT API
         
         Args:
             messages: Список сообщений в формате YandexGPT
@@ -226,6 +268,10 @@ class ApiLLM(LLMInterface):
 
             print("🔄 Ищем JSON в тексте с помощью регулярного выражения...")
             json_matches = re.findall(r'{[\s\S]*?}', cleaned_text)
+            # Вложенный JSON (например, комбинированный ответ метрик) нежадное выражение не захватит целиком
+            outer_start, outer_end = cleaned_text.find('{'), cleaned_text.rfind('}')
+            if outer_start != -1 and outer_end > outer_start:
+                json_matches.insert(0, cleaned_text[outer_start:outer_end + 1])
             if json_matches:
                 for json_text in json_matches:
                     for attempt in range(max_fix_attempts):
@@ -316,7 +362,7 @@ class ApiLLM(LLMInterface):
         chat_text = self._format_messages(messages)
         yandex_messages = compliments_messages(chat_text)
         response = self._make_request(yandex_messages, max_retries)
-        result = self._extract_json_with_retries(response, max_retries)
+        result = self._extract_json_with_retries(response, COMPLIMENTS_SCHEMA, max_retries)
         print(f"✅ Результат подсчета комплиментов: {result}")
         return result
 
@@ -350,7 +396,7 @@ class ApiLLM(LLMInterface):
         user_ids = list({str(m['SenderId']) for m in messages})
         yandex_messages = engagement_messages(chat_text, user_ids, historical_summary, previous_engagement)
         response = self._make_request(yandex_messages, max_retries)
-        result = self._extract_json_with_retries(response, max_retries)
+        result = self._extract_json_with_retries(response, ENGAGEMENT_SCHEMA, max_retries)
         print(f"✅ Результат расчета вовлеченности: {result}")
         return result
 
@@ -384,10 +430,45 @@ class ApiLLM(LLMInterface):
         user_ids = list({str(m['SenderId']) for m in messages})
         yandex_messages = attachment_messages(chat_text, user_ids, historical_summary, previous_attachments)
         response = self._make_request(yandex_messages, max_retries)
-        result = self._extract_json_with_retries(response, max_retries)
+        result = self._extract_json_with_retries(response, ATTACHMENT_SCHEMA, max_retries)
         print(f"✅ Результат определения привязанности: {result}")
         return result
 
+    def calculate_all_metrics(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: dict = None,
+        previous_attachments: dict = None,
+        max_retries: int = 3
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Определяет комплименты, вовлеченность и привязанность одним запросом
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери
+            previous_engagement: Предыдущие значения вовлечённости
+            previous_attachments: Предыдущие прогнозы привязанности
+            max_retries: Максимальное количество попыток
+            
+        Returns:
+            Dict с ключами compliments, engagement и attachment
+        """
+        print(f"🔄 Комбинированный запрос метрик для {len(messages)} сообщений")
+        
+        if not messages:
+            print("⚠️ Пустой список сообщений для анализа метрик")
+            return split_all_metrics({})
+            
+        chat_text = self._format_messages(messages)
+        user_ids = list({str(m['SenderId']) for m in messages})
+        yandex_messages = all_metrics_messages(chat_text, user_ids, historical_summary, previous_engagement, previous_attachments)
+        response = self._make_request(yandex_messages, max_retries)
+        result = split_all_metrics(self._extract_json_with_retries(response, ALL_METRICS_SCHEMA, max_retries))
+        print(f"✅ Результат комбинированного расчета метрик: {result}")
+        return result
+
     def generate_recommendations(
         self, 
         messages: List[Dict[str, Any]], 
@@ -505,6 +586,21 @@ class ApiLLM(LLMInterface):
         response = self._make_request(yandex_messages, max_retries)
         return response
 
+    def compact_summary(self, summary: str, token_budget: int, max_retries: int = 3) -> str:
+        """
+        Сжимает историческое саммери, чтобы оно укладывалось в бюджет токенов
+        
+        Args:
+            summary: Текущее саммери
+            token_budget: Целевой размер саммери в токенах
+            max_retries: Максимальное количество попыток
+            
+        Returns:
+            Сжатое саммери или пустая строка в случае ошибки
+        """
+        yandex_messages = compact_summary_messages(summary, token_budget)
+        return self._make_request(yandex_messages, max_retries)
+
     def get_llm_response(self, prompt: str, max_retries: int = 3) -> str:
         """
         Получает ответ от LLM на основе простого текстового промпта
@@ -521,12 +617,13 @@ class ApiLLM(LLMInterface):
         ]
         return self._make_request(messages, max_retries)
     
-    def _extract_json_with_retries(self, text: str, max_retries: int = 3) -> Dict[str, Any]:
+    def _extract_json_with_retries(self, text: str, schema: str, max_retries: int = 3) -> Dict[str, Any]:
         """
         Пытается извлечь JSON с несколькими попытками, включая повторные запросы к LLM
         
         Args:
             text: Текст ответа
+            schema: Ожидаемая структура ответа для промпта исправления
             max_retries: Максимальное число повторных попыток
             
         Returns:
@@ -541,31 +638,7 @@ class ApiLLM(LLMInterface):
         for attempt in range(max_retries):
             try:
                 print(f"🔄 Повторная попытка #{attempt + 1} получения JSON")
-                
-
-                repair_prompt = f"""Проанализируй следующий текст и верни его как валидный JSON.
-                
-                    ТЕКСТ:
-                    {text}
-
-                    ВАЖНЫЕ ПРАВИЛА:
-                    1. Верни ТОЛЬКО валидный JSON, без дополнительного текста
-                    2. В качестве ключей используй только числовые ID без кавычек
-                    3. НЕ ИСПОЛЬЗУЙ 'SenderId' или 'user' в ключах
-                    4. Все текстовые значения должны быть строками в двойных кавычках
-                    5. Числовые значения НЕ должны быть в кавычках
-
-                    Пример правильного формата:
-                    {{"123": 5, "456": {"type": "secure", "confidence": 70}}}
-
-                    Пример НЕПРАВИЛЬНОГО формата:
-                    {{"SenderId_123": 5, "user": {"type": "secure", "confidence": "70"}}}
-
-                    Верни ТОЛЬКО исправленный JSON:
-                """
-                
-
-                new_response = self.get_llm_response(repair_prompt)
+                new_response = self.get_llm_response(json_repair_prompt(text, schema))
                 result = self._extract_json(new_response)
                 
                 if result:
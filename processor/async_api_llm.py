@@ -0,0 +1,534 @@
+import asyncio
+import contextlib
+import time
+from typing import List, Dict, Any, Optional
+
+import aiohttp
+
+from .llm_interface import AsyncLLMInterface, split_all_metrics
+from .api_llm import ApiLLM
+from .rate_limiter import LLMScheduler
+from .response_cache import ResponseCache, make_cache_key
+from .yandex_prompts import (
+    compliments_messages,
+    engagement_messages,
+    attachment_messages,
+    all_metrics_messages,
+    recommendations_messages,
+    summary_messages,
+    compact_summary_messages,
+    json_repair_prompt,
+    COMPLIMENTS_SCHEMA,
+    ENGAGEMENT_SCHEMA,
+    ATTACHMENT_SCHEMA,
+    ALL_METRICS_SCHEMA
+)
+
+YANDEX_COMPLETION_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+
+# Коды ответа, при которых имеет смысл повторить запрос
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AsyncApiLLM(AsyncLLMInterface):
+    # Разбор ответов не зависит от транспорта, поэтому переиспользуем его из ApiLLM
+    _format_messages = ApiLLM._format_messages
+    _clean_markdown = ApiLLM._clean_markdown
+    _extract_json = ApiLLM._extract_json
+    _fix_json = ApiLLM._fix_json
+    _contains_prohibited_content = ApiLLM._contains_prohibited_content
+
+    def __init__(
+        self,
+        api_url: str = None,
+        api_key: str = None,
+        folder_id: str = None,
+        model_name: str = "yandexgpt",
+        pool_size: int = 100,
+        request_timeout: float = 60.0,
+        scheduler: Optional[LLMScheduler] = None,
+        response_cache: Optional[ResponseCache] = None
+    ):
+        """
+        Инициализирует асинхронный клиент для работы с YandexGPT API
+
+        Args:
+            api_url: Альтернативный URL API (если не указан, используется REST API YandexGPT)
+            api_key: API ключ для YandexGPT
+            folder_id: Идентификатор каталога Yandex Cloud
+            model_name: Имя модели в Yandex Cloud
+            pool_size: Максимальное число одновременных HTTP-соединений в пуле
+            request_timeout: Таймаут одного HTTP-запроса в секундах
+            scheduler: Общий планировщик квот запросов (если не указан, запросы не ограничиваются)
+            response_cache: Кэш ответов по хэшу запроса (если не указан, ответы не кэшируются)
+        """
+        self.api_url = api_url
+        self.api_key = api_key
+        self.folder_id = folder_id
+        self.model_name = model_name
+        self.pool_size = pool_size
+        self.request_timeout = request_timeout
+        self.scheduler = scheduler
+        self.response_cache = response_cache
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        if folder_id and api_key:
+            print(f"🔄 Инициализация асинхронного клиента YandexGPT с folder_id={folder_id[:5]}...")
+        elif api_url:
+            print(f"🔄 Асинхронный клиент использует обычный API URL: {api_url}")
+        else:
+            print("⚠️ Предупреждение: асинхронный API не сконфигурирован должным образом")
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Возвращает общую HTTP-сессию с пулом соединений, создавая её при первом обращении
+
+        Returns:
+            Экземпляр aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+            print(f"✅ Создана HTTP-сессия для YandexGPT, размер пула: {self.pool_size}")
+        return self._session
+
+    async def close(self):
+        """Закрывает общую HTTP-сессию"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            print("✅ HTTP-сессия YandexGPT закрыта")
+        self._session = None
+
+    def _build_request(self, messages: List[Dict[str, str]]):
+        """
+        Формирует URL, заголовки и тело запроса
+
+        Args:
+            messages: Список сообщений в формате YandexGPT
+
+        Returns:
+            Tuple из (url, headers, payload)
+        """
+        if self.folder_id and self.api_key and not self.api_url:
+            headers = {
+                "Authorization": f"Api-Key {self.api_key}",
+                "x-folder-id": self.folder_id,
+                "Content-Type": "application/json"
+            }
+            payload = {
+                "modelUri": f"gpt://{self.folder_id}/{self.model_name}/latest",
+                "completionOptions": {
+                    "stream": False,
+                    "temperature": 0.0
+                },
+                "messages": messages
+            }
+            return YANDEX_COMPLETION_URL, headers, payload
+
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "messages": messages,
+            "temperature": 0.0
+        }
+        return self.api_url, headers, payload
+
+    def _extract_text(self, result: Dict[str, Any]) -> str:
+        """
+        Достаёт текст ответа из JSON-ответа API
+
+        Args:
+            result: Разобранный JSON-ответ
+
+        Returns:
+            Текст ответа или пустая строка
+        """
+        alternatives = result.get("result", {}).get("alternatives", [])
+        if alternatives:
+            return alternatives[0].get("message", {}).get("text", "").strip()
+        if "choices" in result and len(result["choices"]) > 0:
+            return result["choices"][0].get("message", {}).get("content", "").strip()
+        print(f"⚠️ Неожиданный формат ответа API: {result}")
+        return ""
+
+    async def _make_request(self, messages: List[Dict[str, str]], max_retries: int = 3) -> str:
+        """
+        Асинхронно выполняет запрос к YandexGPT API, используя кэш ответов для повторяющихся запросов
+
+        Args:
+            messages: Список сообщений в формате YandexGPT
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Текст ответа от API
+        """
+        if self.response_cache is None:
+            return await self._send_request(messages, max_retries)
+
+        key = make_cache_key(self.model_name, 0.0, messages)
+        cached = await self.response_cache.aget(key)
+        if cached is not None:
+            print(f"🗄️ Ответ YandexGPT взят из кэша, длина: {len(cached)} символов")
+            return cached
+
+        text = await self._send_request(messages, max_retries)
+        await self.response_cache.aset(key, text)
+        return text
+
+    async def _send_request(self, messages: List[Dict[str, str]], max_retries: int = 3) -> str:
+        """
+        Асинхронно отправляет запрос к YandexGPT API
+
+        Args:
+            messages: Список сообщений в формате YandexGPT
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Текст ответа от API
+        """
+        if not (self.folder_id and self.api_key) and not self.api_url:
+            print("❌ API не сконфигурирован: нужны api_key и folder_id или API URL")
+            return ""
+
+        url, headers, payload = self._build_request(messages)
+        session = self._get_session()
+
+        for attempt in range(max_retries):
+            try:
+                async with self._slot():
+                    start_time = time.time()
+                    async with session.post(url, headers=headers, json=payload) as response:
+                        if response.status == 429:
+                            retry_after = self._retry_after(response, attempt)
+                            print(f"⚠️ API вернул статус 429 (попытка {attempt + 1}/{max_retries})")
+                            if self.scheduler is not None:
+                                self.scheduler.throttle(retry_after)
+                            else:
+                                await asyncio.sleep(retry_after)
+                            continue
+                        if response.status in RETRYABLE_STATUSES:
+                            body = await response.text()
+                            print(f"⚠️ API вернул статус {response.status} (попытка {attempt + 1}/{max_retries}): {body[:200]}")
+                            if attempt < max_retries - 1:
+                                await asyncio.sleep(1 + attempt)
+                            continue
+                        response.raise_for_status()
+                        result = await response.json()
+
+                text = self._extract_text(result)
+                elapsed_time = time.time() - start_time
+                print(f"🧠 Yandex GPT ответ получен за {elapsed_time:.2f} сек., длина: {len(text)} символов")
+                return text
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Ошибка API запроса (попытка {attempt + 1}/{max_retries}): {e}")
+                if attempt == max_retries - 1:
+                    return ""
+                await asyncio.sleep(1 + attempt)
+
+        return ""
+
+    def _slot(self):
+        """Возвращает слот планировщика или пустой контекст, если планировщик не задан"""
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot()
+
+    def _retry_after(self, response: aiohttp.ClientResponse, attempt: int) -> float:
+        """
+        Определяет паузу после ответа 429 по заголовку Retry-After
+
+        Args:
+            response: HTTP-ответ
+            attempt: Номер текущей попытки
+
+        Returns:
+            Пауза в секундах
+        """
+        try:
+            return float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            return float(1 + attempt)
+
+    async def get_llm_response(self, prompt: str, max_retries: int = 3) -> str:
+        """
+        Получает ответ от LLM на основе простого текстового промпта
+
+        Args:
+            prompt: Текстовый промпт
+            max_retries: Максимальное число повторных попыток
+
+        Returns:
+            Текстовый ответ от LLM
+        """
+        messages = [
+            {"role": "user", "text": prompt}
+        ]
+        return await self._make_request(messages, max_retries)
+
+    async def _extract_json_with_retries(self, text: str, schema: str, max_retries: int = 3) -> Dict[str, Any]:
+        """
+        Пытается извлечь JSON с несколькими попытками, включая повторные запросы к LLM
+
+        Args:
+            text: Текст ответа
+            schema: Ожидаемая структура ответа для промпта исправления
+            max_retries: Максимальное число повторных попыток
+
+        Returns:
+            Извлеченный JSON или пустой словарь
+        """
+        result = self._extract_json(text)
+        if result:
+            return result
+
+        for attempt in range(max_retries):
+            try:
+                print(f"🔄 Повторная попытка #{attempt + 1} получения JSON")
+                new_response = await self.get_llm_response(json_repair_prompt(text, schema))
+                result = self._extract_json(new_response)
+                if result:
+                    print(f"✅ Успешно получен JSON после повторного запроса (попытка {attempt + 1}/{max_retries})")
+                    return result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Ошибка при повторной попытке получить JSON: {e}")
+
+            await asyncio.sleep(1 + attempt)
+
+        print("❌ Не удалось получить валидный JSON после всех попыток")
+        return {}
+
+    async def count_compliments(self, messages: List[Dict[str, Any]], max_retries: int = 3) -> Dict[str, Any]:
+        """
+        Подсчитывает количество комплиментов в диалоге
+
+        Args:
+            messages: Список сообщений для анализа
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Dict с количеством комплиментов или пустой словарь в случае ошибки
+        """
+        if not messages:
+            print("⚠️ Пустой список сообщений для анализа комплиментов")
+            return {}
+
+        chat_text = self._format_messages(messages)
+        yandex_messages = compliments_messages(chat_text)
+        response = await self._make_request(yandex_messages, max_retries)
+        result = await self._extract_json_with_retries(response, COMPLIMENTS_SCHEMA, max_retries)
+        print(f"✅ Результат подсчета комплиментов: {result}")
+        return result
+
+    async def calculate_engagement(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: dict = None,
+        max_retries: int = 3
+    ) -> Dict[str, Any]:
+        """
+        Рассчитывает уровень вовлеченности участников
+
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери
+            previous_engagement: Предыдущие значения вовлечённости
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Dict с уровнем вовлеченности или пустой словарь в случае ошибки
+        """
+        if not messages:
+            print("⚠️ Пустой список сообщений для анализа вовлеченности")
+            return {}
+
+        chat_text = self._format_messages(messages)
+        user_ids = list({str(m['SenderId']) for m in messages})
+        yandex_messages = engagement_messages(chat_text, user_ids, historical_summary, previous_engagement)
+        response = await self._make_request(yandex_messages, max_retries)
+        result = await self._extract_json_with_retries(response, ENGAGEMENT_SCHEMA, max_retries)
+        print(f"✅ Результат расчета вовлеченности: {result}")
+        return result
+
+    async def calculate_attachment(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_attachments: dict = None,
+        max_retries: int = 3
+    ) -> Dict[str, Any]:
+        """
+        Определяет тип привязанности участников диалога
+
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери
+            previous_attachments: Предыдущие прогнозы привязанности
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Dict с типом привязанности или пустой словарь в случае ошибки
+        """
+        if not messages:
+            print("⚠️ Пустой список сообщений для анализа привязанности")
+            return {}
+
+        chat_text = self._format_messages(messages)
+        user_ids = list({str(m['SenderId']) for m in messages})
+        yandex_messages = attachment_messages(chat_text, user_ids, historical_summary, previous_attachments)
+        response = await self._make_request(yandex_messages, max_retries)
+        result = await self._extract_json_with_retries(response, ATTACHMENT_SCHEMA, max_retries)
+        print(f"✅ Результат определения привязанности: {result}")
+        return result
+
+    async def calculate_all_metrics(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: dict = None,
+        previous_attachments: dict = None,
+        max_retries: int = 3
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Определяет комплименты, вовлеченность и привязанность одним запросом
+
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери
+            previous_engagement: Предыдущие значения вовлечённости
+            previous_attachments: Предыдущие прогнозы привязанности
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Dict с ключами compliments, engagement и attachment
+        """
+        if not messages:
+            print("⚠️ Пустой список сообщений для анализа метрик")
+            return split_all_metrics({})
+
+        chat_text = self._format_messages(messages)
+        user_ids = list({str(m['SenderId']) for m in messages})
+        yandex_messages = all_metrics_messages(chat_text, user_ids, historical_summary, previous_engagement, previous_attachments)
+        response = await self._make_request(yandex_messages, max_retries)
+        result = split_all_metrics(await self._extract_json_with_retries(response, ALL_METRICS_SCHEMA, max_retries))
+        print(f"✅ Результат комбинированного расчета метрик: {result}")
+        return result
+
+    async def generate_recommendations(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        user_id: str,
+        max_retries: int = 3
+    ) -> str:
+        """
+        Генерирует рекомендации для пользователя
+
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери
+            user_id: ID пользователя
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Текст с рекомендациями
+        """
+        if not messages:
+            print("⚠️ Пустой список сообщений для генерации рекомендаций")
+            return ""
+
+        chat_text = self._format_messages(messages)
+        yandex_messages = recommendations_messages(chat_text, historical_summary, user_id)
+
+        for attempt in range(max_retries):
+            response = await self._make_request(yandex_messages, max_retries=1)
+
+            if not response:
+                print(f"⚠️ Пустой ответ при генерации рекомендаций (попытка {attempt+1}/{max_retries})")
+                await asyncio.sleep(1 + attempt)
+                continue
+
+            clean_response = self._clean_markdown(response)
+
+            if self._contains_prohibited_content(clean_response):
+                print(f"⚠️ Обнаружен запрещенный контент в рекомендациях (попытка {attempt+1}/{max_retries})")
+                if attempt == max_retries - 1:
+                    print("⚠️ Не удалось получить рекомендации без запрещенного контента")
+                    return "Проанализируйте диалог и подумайте, как можно улучшить коммуникацию."
+
+                repair_prompt = f"""Дай конкретные рекомендации по общению для пользователя {user_id} на основе анализа диалога.
+
+Диалог:
+{chat_text}
+
+Историческое саммери:
+{historical_summary}
+
+СТРОГО запрещено в твоем ответе:
+1. Любые ссылки, особенно на ya.ru, yandex.ru, google.com и др.
+2. Фразы типа "посмотрите в поиске", "в интернете есть информация" и подобные
+3. Упоминание поисковых систем или интернета
+4. Любые HTML или Markdown ссылки
+5. Упоминание, что ты не можешь помочь
+
+Твой предыдущий ответ содержал запрещенный контент (ссылки или упоминания поиска).
+Дай 3-5 конкретных, практических рекомендаций, основанных ТОЛЬКО на этом диалоге.
+Рекомендации должны быть короткими, понятными и действенными."""
+
+                yandex_messages = [
+                    {"role": "system", "text": "Ты коммуникационный консультант, дающий практические советы."},
+                    {"role": "user", "text": repair_prompt}
+                ]
+                await asyncio.sleep(1 + attempt)
+                continue
+
+            print(f"✅ Сгенерированы рекомендации длиной {len(clean_response)} символов")
+            return clean_response
+
+        print("⚠️ Не удалось сгенерировать рекомендации после всех попыток")
+        return ""
+
+    async def update_summary(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: Optional[str] = None,
+        max_retries: int = 3
+    ) -> str:
+        """
+        Обновляет историческое саммери на основе нового батча сообщений
+
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Предыдущее историческое саммери диалога (если есть)
+            max_retries: Максимальное количество попыток анализа
+
+        Returns:
+            Строка с обновленным саммери или пустая строка в случае ошибки
+        """
+        chat_text = self._format_messages(messages)
+        yandex_messages = summary_messages(chat_text, historical_summary)
+        return await self._make_request(yandex_messages, max_retries)
+
+    async def compact_summary(self, summary: str, token_budget: int, max_retries: int = 3) -> str:
+        """
+        Сжимает историческое саммери, чтобы оно укладывалось в бюджет токенов
+
+        Args:
+            summary: Текущее саммери
+            token_budget: Целевой размер саммери в токенах
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Сжатое саммери или пустая строка в случае ошибки
+        """
+        yandex_messages = compact_summary_messages(summary, token_budget)
+        return await self._make_request(yandex_messages, max_retries)
@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import contextlib
+from typing import List, Dict, Any, Optional
+
+from .llm_interface import LLMInterface, AsyncLLMInterface
+from .rate_limiter import LLMScheduler
+
+
+class ExecutorAsyncLLM(AsyncLLMInterface):
+    """
+    Асинхронная обёртка над синхронной LLM (например, LocalLLM).
+    Все вызовы выполняются в одном общем пуле потоков фиксированного размера,
+    а не в новом пуле на каждый батч.
+    """
+
+    def __init__(self, llm: LLMInterface, max_workers: int = 3, scheduler: Optional[LLMScheduler] = None):
+        """
+        Args:
+            llm: Синхронная реализация LLMInterface
+            max_workers: Размер общего пула потоков
+            scheduler: Общий планировщик квот запросов
+        """
+        self.llm = llm
+        self.max_workers = max_workers
+        self.scheduler = scheduler
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="llm"
+        )
+
+    async def _run(self, func, *args):
+        slot = self.scheduler.slot() if self.scheduler is not None else contextlib.nullcontext()
+        async with slot:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, lambda: func(*args))
+
+    async def count_compliments(self, messages: List[Dict[str, Any]], max_retries: int = 3) -> Dict[str, Any]:
+        return await self._run(self.llm.count_compliments, messages, max_retries) or {}
+
+    async def calculate_engagement(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Any]:
+        return await self._run(
+            self.llm.calculate_engagement, messages, historical_summary, previous_engagement, max_retries
+        ) or {}
+
+    async def calculate_attachment(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_attachments: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Any]:
+        return await self._run(
+            self.llm.calculate_attachment, messages, historical_summary, previous_attachments, max_retries
+        ) or {}
+
+    async def calculate_all_metrics(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: Optional[dict] = None,
+        previous_attachments: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Dict[str, Any]]:
+        return await self._run(
+            self.llm.calculate_all_metrics, messages, historical_summary,
+            previous_engagement, previous_attachments, max_retries
+        )
+
+    async def generate_recommendations(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        user_id: str,
+        max_retries: int = 3
+    ) -> str:
+        return await self._run(
+            self.llm.generate_recommendations, messages, historical_summary, user_id, max_retries
+        ) or ""
+
+    async def update_summary(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: Optional[str] = None,
+        max_retries: int = 3
+    ) -> str:
+        return await self._run(self.llm.update_summary, messages, historical_summary, max_retries) or ""
+
+    async def compact_summary(self, summary: str, token_budget: int, max_retries: int = 3) -> str:
+        return await self._run(self.llm.compact_summary, summary, token_budget, max_retries) or ""
+
+    def count_tokens(self, text: str) -> int:
+        return self.llm.count_tokens(text)
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+        self.llm.close()
@@ -1,15 +1,26 @@
 from typing import Optional
-from .llm_interface import LLMInterface
-from .api_llm import ApiLLM
-from .local_llm import LocalLLM
+from .llm_interface import LLMInterface, AsyncLLMInterface
+from .rate_limiter import get_scheduler
+from .response_cache import get_response_cache
 
 class LLMFactory:
+    """
+    Создает LLM нужного типа. Модули бэкендов импортируются только при создании:
+    режиму yandex не нужны torch и transformers, режиму local — SDK Yandex Cloud.
+    """
+
     @staticmethod
     def create_llm(
         llm_type: str,
         api_key: Optional[str] = None,
         folder_id: Optional[str] = None,
-        local_model_name: Optional[str] = "models/mistral-instruct"
+        local_model_name: Optional[str] = "models/mistral-instruct",
+        local_batch_size: int = 4,
+        local_batch_max_wait_ms: float = 20.0,
+        local_prefix_cache: bool = True,
+        local_precision: str = "auto",
+        local_compile: bool = False,
+        local_num_threads: int = 0
     ) -> LLMInterface:
         """
         Создает экземпляр LLM.
@@ -19,6 +30,12 @@ class LLMFactory:
             api_key: API ключ для доступа к YandexGPT (если llm_type="yandex").
             folder_id: Идентификатор каталога Yandex Cloud (если llm_type="yandex").
             local_model_name: Имя или путь к локальной модели (если llm_type="local").
+            local_batch_size: Максимум промптов в одном батче генерации (если llm_type="local").
+            local_batch_max_wait_ms: Окно сбора батча в мс (если llm_type="local").
+            local_prefix_cache: Кэшировать KV статических префиксов промптов (если llm_type="local").
+            local_precision: Точность локальной модели: "auto", "fp32", "bf16", "fp16", "int8" или "int4" (если llm_type="local").
+            local_compile: Компилировать модель через torch.compile (если llm_type="local").
+            local_num_threads: Потоков torch на CPU, 0 — по умолчанию (если llm_type="local").
             
         Returns:
             Экземпляр LLMInterface.
@@ -30,9 +47,70 @@ class LLMFactory:
             if not api_key or not folder_id:
                 raise ValueError("Для использования YandexGPT API необходимо указать api_key и folder_id")
             print(f"🏭 Создание Yandex LLM (ApiLLM) с folder_id: {folder_id[:5]}...")
-            return ApiLLM(api_key=api_key, folder_id=folder_id)
+            from .api_llm import ApiLLM
+            return ApiLLM(api_key=api_key, folder_id=folder_id, response_cache=get_response_cache())
+        elif llm_type == "local":
+            print(f"🏭 Создание Local LLM (LocalLLM) с моделью: {local_model_name}, точность: {local_precision}")
+            from .local_llm import LocalLLM
+            return LocalLLM(
+                model_name=local_model_name,
+                response_cache=get_response_cache(),
+                batch_size=local_batch_size,
+                batch_max_wait_ms=local_batch_max_wait_ms,
+                prefix_cache=local_prefix_cache,
+                precision=local_precision,
+                compile_model=local_compile,
+                num_threads=local_num_threads
+            )
+        else:
+            raise ValueError(f"Неизвестный тип LLM: {llm_type}. Доступные типы: 'yandex', 'local'")
+
+    @staticmethod
+    def create_async_llm(
+        llm_type: str,
+        api_key: Optional[str] = None,
+        folder_id: Optional[str] = None,
+        sync_llm: Optional[LLMInterface] = None,
+        pool_size: int = 100,
+        request_timeout: float = 60.0,
+        executor_workers: int = 3
+    ) -> AsyncLLMInterface:
+        """
+        Создает асинхронный экземпляр LLM.
+        
+        Args:
+            llm_type: Тип LLM для создания ("yandex" или "local").
+            api_key: API ключ для доступа к YandexGPT (если llm_type="yandex").
+            folder_id: Идентификатор каталога Yandex Cloud (если llm_type="yandex").
+            sync_llm: Уже созданная синхронная LLM (если llm_type="local").
+            pool_size: Размер пула HTTP-соединений (если llm_type="yandex").
+            request_timeout: Таймаут HTTP-запроса в секундах (если llm_type="yandex").
+            executor_workers: Размер общего пула потоков (если llm_type="local").
+            
+        Returns:
+            Экземпляр AsyncLLMInterface.
+            
+        Raises:
+            ValueError: Если указан неизвестный тип LLM или отсутствуют необходимые параметры.
+        """
+        if llm_type == "yandex":
+            if not api_key or not folder_id:
+                raise ValueError("Для использования YandexGPT API необходимо указать api_key и folder_id")
+            print(f"🏭 Создание асинхронного Yandex LLM (AsyncApiLLM), размер пула: {pool_size}")
+            from .async_api_llm import AsyncApiLLM
+            return AsyncApiLLM(
+                api_key=api_key,
+                folder_id=folder_id,
+                pool_size=pool_size,
+                request_timeout=request_timeout,
+                scheduler=get_scheduler("yandex"),
+                response_cache=get_response_cache()
+            )
         elif llm_type == "local":
-            print(f"🏭 Создание Local LLM (LocalLLM) с моделью: {local_model_name}")
-            return LocalLLM(model_name=local_model_name)
+            if sync_llm is None:
+                raise ValueError("Для асинхронной локальной LLM необходимо передать sync_llm")
+            print(f"🏭 Создание асинхронной обёртки над Local LLM, потоков: {executor_workers}")
+            from .executor_llm import ExecutorAsyncLLM
+            return ExecutorAsyncLLM(sync_llm, max_workers=executor_workers, scheduler=get_scheduler("local"))
         else:
-            raise ValueError(f"Неизвестный тип LLM: {llm_type}. Доступные типы: 'yandex', 'local'") 
\ No newline at end of file
+            raise ValueError(f"Неизвестный тип LLM: {llm_type}. Доступные типы: 'yandex', 'local'")
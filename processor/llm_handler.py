@@ -1,27 +1,99 @@
 from .llm_factory import LLMFactory
-from config import API_KEY, FOLDER_ID, LLM_TYPE, LOCAL_MODEL_NAME
+from config import (
+    API_KEY, FOLDER_ID, LLM_TYPE, LOCAL_MODEL_NAME, LOCAL_BATCH_SIZE, LOCAL_BATCH_MAX_WAIT_MS, LOCAL_PREFIX_CACHE,
+    LOCAL_PRECISION, LOCAL_COMPILE, LOCAL_NUM_THREADS,
+    LLM_HTTP_POOL_SIZE, LLM_HTTP_TIMEOUT_SECONDS, LLM_EXECUTOR_WORKERS
+)
 
 
-llm = LLMFactory.create_llm(
-    llm_type=LLM_TYPE,
-    api_key=API_KEY,
-    folder_id=FOLDER_ID,
-    local_model_name=LOCAL_MODEL_NAME
-)
+_llm = None
+_async_llm = None
+
+
+def get_llm():
+    """Возвращает синхронную LLM, создавая её при первом обращении"""
+    global _llm
+    if _llm is None:
+        _llm = LLMFactory.create_llm(
+            llm_type=LLM_TYPE,
+            api_key=API_KEY,
+            folder_id=FOLDER_ID,
+            local_model_name=LOCAL_MODEL_NAME,
+            local_batch_size=LOCAL_BATCH_SIZE,
+            local_batch_max_wait_ms=LOCAL_BATCH_MAX_WAIT_MS,
+            local_prefix_cache=LOCAL_PREFIX_CACHE,
+            local_precision=LOCAL_PRECISION,
+            local_compile=LOCAL_COMPILE,
+            local_num_threads=LOCAL_NUM_THREADS
+        )
+    return _llm
+
+
+def get_async_llm():
+    """
+    Возвращает асинхронную LLM, создавая её при первом обращении.
+    В режиме yandex синхронная LLM (и SDK Yandex Cloud) при этом не создается.
+    """
+    global _async_llm
+    if _async_llm is None:
+        _async_llm = LLMFactory.create_async_llm(
+            llm_type=LLM_TYPE,
+            api_key=API_KEY,
+            folder_id=FOLDER_ID,
+            sync_llm=get_llm() if LLM_TYPE == "local" else None,
+            pool_size=LLM_HTTP_POOL_SIZE,
+            request_timeout=LLM_HTTP_TIMEOUT_SECONDS,
+            executor_workers=LLM_EXECUTOR_WORKERS
+        )
+    return _async_llm
 
 
 def count_compliments(messages, max_retries=3):
-    return llm.count_compliments(messages, max_retries)
+    return get_llm().count_compliments(messages, max_retries)
 
 def calculate_engagement(messages, historical_summary="", previous_engagement=None, max_retries=3):
-    return llm.calculate_engagement(messages, historical_summary, previous_engagement, max_retries)
+    return get_llm().calculate_engagement(messages, historical_summary, previous_engagement, max_retries)
 
 def calculate_attachment(messages, historical_summary="", previous_attachments=None, max_retries=3):
-    return llm.calculate_attachment(messages, historical_summary, previous_attachments, max_retries)
+    return get_llm().calculate_attachment(messages, historical_summary, previous_attachments, max_retries)
+
+def calculate_all_metrics(messages, historical_summary="", previous_engagement=None, previous_attachments=None, max_retries=3):
+    return get_llm().calculate_all_metrics(messages, historical_summary, previous_engagement, previous_attachments, max_retries)
 
 def generate_recommendations(messages, historical_summary="", user_id="", max_retries=3):
-    return llm.generate_recommendations(messages, historical_summary, user_id, max_retries)
+    return get_llm().generate_recommendations(messages, historical_summary, user_id, max_retries)
 
 def update_summary(messages, historical_summary=None, max_retries=3):
-    return llm.update_summary(messages, historical_summary, max_retries)
+    return get_llm().update_summary(messages, historical_summary, max_retries)
+
+def compact_summary(summary, token_budget, max_retries=3):
+    return get_llm().compact_summary(summary, token_budget, max_retries)
+
+def count_tokens(text):
+    return get_async_llm().count_tokens(text)
+
+
+async def count_compliments_async(messages, max_retries=3):
+    return await get_async_llm().count_compliments(messages, max_retries)
+
+async def calculate_engagement_async(messages, historical_summary="", previous_engagement=None, max_retries=3):
+    return await get_async_llm().calculate_engagement(messages, historical_summary, previous_engagement, max_retries)
+
+async def calculate_attachment_async(messages, historical_summary="", previous_attachments=None, max_retries=3):
+    return await get_async_llm().calculate_attachment(messages, historical_summary, previous_attachments, max_retries)
+
+async def calculate_all_metrics_async(messages, historical_summary="", previous_engagement=None, previous_attachments=None, max_retries=3):
+    return await get_async_llm().calculate_all_metrics(messages, historical_summary, previous_engagement, previous_attachments, max_retries)
+
+async def generate_recommendations_async(messages, historical_summary="", user_id="", max_retries=3):
+    return await get_async_llm().generate_recommendations(messages, historical_summary, user_id, max_retries)
+
+async def update_summary_async(messages, historical_summary=None, max_retries=3):
+    return await get_async_llm().update_summary(messages, historical_summary, max_retries)
+
+async def compact_summary_async(summary, token_budget, max_retries=3):
+    return await get_async_llm().compact_summary(summary, token_budget, max_retries)
 
+async def close():
+    if _async_llm is not None:
+        await _async_llm.close()
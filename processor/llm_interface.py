@@ -1,6 +1,49 @@
+import asyncio
+import math
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any, Optional
 
+METRIC_KEYS = ("compliments", "engagement", "attachment")
+
+# Грубая оценка для бэкендов без доступного токенизатора (YandexGPT): русский текст
+# занимает примерно 3 символа на токен, оценка намеренно с запасом
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценивает число токенов в тексте по длине
+
+    Args:
+        text: Текст
+
+    Returns:
+        Примерное число токенов
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def split_all_metrics(result: Optional[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Разбирает ответ комбинированного запроса метрик на три словаря
+
+    Args:
+        result: JSON-ответ модели с ключами compliments, engagement и attachment
+
+    Returns:
+        Dict с ключами compliments, engagement и attachment; в каждом — словарь по ID пользователей
+    """
+    metrics = {}
+    for metric in METRIC_KEYS:
+        values = (result or {}).get(metric)
+        if not isinstance(values, dict):
+            values = {}
+        metrics[metric] = {
+            str(key): value for key, value in values.items()
+            if value is not None and 'SenderId' not in str(key) and 'user' not in str(key) and 'пользователь' not in str(key)
+        }
+    return metrics
+
 class LLMInterface(ABC):
     @abstractmethod
     def count_compliments(self, messages: List[Dict[str, Any]], max_retries: int = 3) -> Dict[str, Any]:
@@ -56,6 +99,35 @@ class LLMInterface(ABC):
         """
         pass
         
+    def calculate_all_metrics(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: Optional[dict] = None,
+        previous_attachments: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Определяет комплименты, вовлеченность и привязанность одним запросом.
+        По умолчанию выполняет три отдельных запроса; реализации переопределяют метод
+        комбинированным промптом.
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери диалога
+            previous_engagement: Предыдущие значения вовлечённости
+            previous_attachments: Предыдущие прогнозы привязанности
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Dict с ключами compliments, engagement и attachment
+        """
+        return {
+            "compliments": self.count_compliments(messages, max_retries) or {},
+            "engagement": self.calculate_engagement(messages, historical_summary, previous_engagement, max_retries) or {},
+            "attachment": self.calculate_attachment(messages, historical_summary, previous_attachments, max_retries) or {}
+        }
+        
     @abstractmethod
     def generate_recommendations(
         self, 
@@ -96,4 +168,206 @@ class LLMInterface(ABC):
         Returns:
             Строка с обновленным саммери или None в случае ошибки
         """
-        pass 
\ No newline at end of file
+        pass 
+
+    @abstractmethod
+    def compact_summary(self, summary: str, token_budget: int, max_retries: int = 3) -> str:
+        """
+        Сжимает историческое саммери, чтобы оно укладывалось в бюджет токенов
+        
+        Args:
+            summary: Текущее саммери
+            token_budget: Целевой размер саммери в токенах
+            max_retries: Максимальное количество попыток
+            
+        Returns:
+            Сжатое саммери или пустая строка в случае ошибки
+        """
+        pass
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Считает токены текста; по умолчанию — оценка по длине
+        
+        Args:
+            text: Текст
+            
+        Returns:
+            Число токенов
+        """
+        return estimate_tokens(text)
+
+    def close(self):
+        """Освобождает ресурсы реализации (фоновые потоки и т.п.)"""
+        pass
+
+class AsyncLLMInterface(ABC):
+    """
+    Асинхронный вариант LLMInterface: все методы — корутины,
+    поэтому один event loop может держать много запросов одновременно
+    без отдельного потока на каждый вызов.
+    """
+
+    @abstractmethod
+    async def count_compliments(self, messages: List[Dict[str, Any]], max_retries: int = 3) -> Dict[str, Any]:
+        """
+        Подсчитывает количество комплиментов в сообщениях
+        
+        Args:
+            messages: Список сообщений для анализа
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Dict с количеством комплиментов для каждого отправителя или пустой словарь в случае ошибки
+        """
+        pass
+
+    @abstractmethod
+    async def calculate_engagement(
+        self, 
+        messages: List[Dict[str, Any]], 
+        historical_summary: str,
+        previous_engagement: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Any]:
+        """
+        Определяет уровень вовлеченности на основе истории и нового батча
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери диалога
+            previous_engagement: Предыдущие значения вовлечённости
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Dict с уровнем вовлеченности для каждого отправителя или пустой словарь в случае ошибки
+        """
+        pass
+
+    @abstractmethod
+    async def calculate_attachment(
+        self, 
+        messages: List[Dict[str, Any]], 
+        historical_summary: str,
+        previous_attachments: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Any]:
+        """
+        Определяет тип привязанности и уверенность на основе истории и нового батча
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери диалога
+            previous_attachments: Предыдущие прогнозы привязанности
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Dict с типом привязанности и уверенностью или пустой словарь в случае ошибки
+        """
+        pass
+
+    async def calculate_all_metrics(
+        self,
+        messages: List[Dict[str, Any]],
+        historical_summary: str,
+        previous_engagement: Optional[dict] = None,
+        previous_attachments: Optional[dict] = None,
+        max_retries: int = 3
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Определяет комплименты, вовлеченность и привязанность одним запросом.
+        По умолчанию выполняет три отдельных запроса параллельно.
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери диалога
+            previous_engagement: Предыдущие значения вовлечённости
+            previous_attachments: Предыдущие прогнозы привязанности
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Dict с ключами compliments, engagement и attachment
+        """
+        compliments, engagement, attachment = await asyncio.gather(
+            self.count_compliments(messages, max_retries),
+            self.calculate_engagement(messages, historical_summary, previous_engagement, max_retries),
+            self.calculate_attachment(messages, historical_summary, previous_attachments, max_retries)
+        )
+        return {
+            "compliments": compliments or {},
+            "engagement": engagement or {},
+            "attachment": attachment or {}
+        }
+
+    @abstractmethod
+    async def generate_recommendations(
+        self, 
+        messages: List[Dict[str, Any]], 
+        historical_summary: str,
+        user_id: str,
+        max_retries: int = 3
+    ) -> str:
+        """
+        Генерирует рекомендации по общению для пользователя
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери диалога
+            user_id: ID пользователя, которому нужны рекомендации
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Строка с рекомендациями или пустая строка в случае ошибки
+        """
+        pass
+
+    @abstractmethod
+    async def update_summary(
+        self, 
+        messages: List[Dict[str, Any]], 
+        historical_summary: Optional[str] = None,
+        max_retries: int = 3
+    ) -> str:
+        """
+        Обновляет историческое саммери на основе нового батча сообщений
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Предыдущее историческое саммери диалога (если есть)
+            max_retries: Максимальное количество попыток анализа
+            
+        Returns:
+            Строка с обновленным саммери или пустая строка в случае ошибки
+        """
+        pass
+
+    @abstractmethod
+    async def compact_summary(self, summary: str, token_budget: int, max_retries: int = 3) -> str:
+        """
+        Сжимает историческое саммери, чтобы оно укладывалось в бюджет токенов
+
+        Args:
+            summary: Текущее саммери
+            token_budget: Целевой размер саммери в токенах
+            max_retries: Максимальное количество попыток
+
+        Returns:
+            Сжатое саммери или пустая строка в случае ошибки
+        """
+        pass
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Считает токены текста; по умолчанию — оценка по длине
+
+        Args:
+            text: Текст
+
+        Returns:
+            Число токенов
+        """
+        return estimate_tokens(text)
+
+    async def close(self):
+        """Освобождает сетевые ресурсы клиента"""
+        pass
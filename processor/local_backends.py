@@ -0,0 +1,77 @@
+from typing import Any, Tuple
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+try:
+    import optimum.quanto as quanto
+except ImportError:
+    quanto = None
+
+# "auto" — float16 на GPU и float32 на CPU, как раньше
+PRECISIONS = ("auto", "fp32", "bf16", "fp16", "int8", "int4")
+
+_FLOAT_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def load_local_model(model_name: str, precision: str = "auto", compile_model: bool = False,
+                     num_threads: int = 0) -> Tuple[Any, Any]:
+    """
+    Загружает токенизатор и модель локальной LLM в заданной точности.
+
+    int8 — динамическая квантизация Linear-слоёв средствами torch (веса int8, активации
+    квантуются на лету), только на CPU. int4 — квантизация весов через optimum-quanto.
+
+    Args:
+        model_name: Имя или путь к модели
+        precision: Одна из PRECISIONS
+        compile_model: Компилировать forward модели через torch.compile
+        num_threads: Потоков для вычислений torch на CPU (0 — по умолчанию torch)
+
+    Returns:
+        Tuple из (tokenizer, model)
+
+    Raises:
+        ValueError: Если точность неизвестна или недоступна в этом окружении
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Неизвестная точность локальной модели: {precision}. Доступные: {', '.join(PRECISIONS)}")
+    cuda = torch.cuda.is_available()
+    if precision == "int8" and cuda:
+        raise ValueError("Точность 'int8' (динамическая квантизация torch) доступна только на CPU")
+    if precision == "int4" and quanto is None:
+        raise ValueError("Точность 'int4' недоступна: пакет optimum-quanto не установлен")
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    if precision in _FLOAT_DTYPES:
+        dtype = _FLOAT_DTYPES[precision]
+    elif precision == "int8":
+        # Динамическая квантизация работает с float32-моделью
+        dtype = torch.float32
+    else:
+        dtype = torch.float16 if cuda else torch.float32
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=dtype,
+        device_map="auto" if precision != "int8" else "cpu"
+    )
+    model.eval()
+
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif precision == "int4":
+        quanto.quantize(model, weights=quanto.qint4)
+        quanto.freeze(model)
+
+    if compile_model:
+        # Компилируется forward, а не весь модуль: generate вызывает именно его.
+        # dynamic=True — длина промпта и размер батча меняются от вызова к вызову
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    print(f"✅ Локальная модель: точность {precision} ({dtype}), torch.compile: {'да' if compile_model else 'нет'}, "
+          f"потоков: {torch.get_num_threads()}")
+    return tokenizer, model
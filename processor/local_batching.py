@@ -0,0 +1,164 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Dict, Any, Optional
+
+import torch
+
+from .prefix_cache import PrefixKVCache
+
+
+class _GenerationRequest:
+    __slots__ = ("prompt", "max_new_tokens", "future")
+
+    def __init__(self, prompt: str, max_new_tokens: int):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future: Future = Future()
+
+
+class MicroBatchGenerator:
+    """
+    Движок микробатчинга для локальной модели.
+    Промпты из разных потоков собираются в очередь в течение короткого окна,
+    выравниваются паддингом слева и прогоняются одним вызовом model.generate.
+    Результаты раздаются ожидающим вызывающим через Future.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 4,
+        max_wait_ms: float = 20.0,
+        prefix_cache: Optional[PrefixKVCache] = None
+    ):
+        """
+        Args:
+            model: Загруженная модель transformers
+            tokenizer: Токенизатор модели
+            max_batch_size: Максимум промптов в одном вызове generate
+            max_wait_ms: Сколько ждать остальных промптов после первого в батче, мс
+            prefix_cache: Кэш KV статических префиксов (используется для батчей из одного промпта)
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+
+        # Для декодер-моделей генерация продолжает последний токен, поэтому паддинг только слева
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self._queue: "queue.Queue[Optional[_GenerationRequest]]" = queue.Queue()
+        self._stopped = False
+        self.total_batches = 0
+        self.total_requests = 0
+        self._thread = threading.Thread(target=self._worker, name="local-llm-batcher", daemon=True)
+        self._thread.start()
+
+    def generate(self, prompt: str, max_new_tokens: int = 256) -> str:
+        """
+        Ставит промпт в очередь и ждёт результат
+
+        Args:
+            prompt: Текст промпта
+            max_new_tokens: Максимум новых токенов ответа
+
+        Returns:
+            Сгенерированный текст (без промпта)
+        """
+        if self._stopped:
+            raise RuntimeError("Движок микробатчинга остановлен")
+        request = _GenerationRequest(prompt, max_new_tokens)
+        self._queue.put(request)
+        return request.future.result()
+
+    def close(self):
+        """Останавливает фоновый поток"""
+        self._stopped = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики движка"""
+        return {
+            "batches": self.total_batches,
+            "requests": self.total_requests,
+            "avg_batch_size": self.total_requests / self.total_batches if self.total_batches else 0.0,
+            "queued": self._queue.qsize()
+        }
+
+    def _collect(self) -> Optional[List[_GenerationRequest]]:
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            try:
+                texts = self._generate_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, text in zip(batch, texts):
+                request.future.set_result(text)
+
+    def _generate_batch(self, batch: List[_GenerationRequest]) -> List[str]:
+        inputs = self.tokenizer(
+            [request.prompt for request in batch],
+            return_tensors="pt",
+            padding=True,
+            return_attention_mask=True
+        ).to(self.model.device)
+        max_new_tokens = max(request.max_new_tokens for request in batch)
+
+        # Кэш префикса посчитан без паддинга, поэтому применим только к одиночному промпту;
+        # под нагрузкой выигрыш даёт сам батч
+        past_key_values = None
+        if self.prefix_cache is not None and len(batch) == 1:
+            past_key_values = self.prefix_cache.lookup(batch[0].prompt, inputs["input_ids"][0].tolist())
+
+        start_time = time.time()
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id
+            )
+        self.total_batches += 1
+        self.total_requests += len(batch)
+        print(f"🧠 Локальная модель: батч из {len(batch)} промптов за {time.time() - start_time:.2f} сек.")
+
+        # После паддинга слева все промпты занимают одинаковую длину, новые токены идут следом
+        prompt_length = inputs["input_ids"].shape[1]
+        texts = []
+        for request, output in zip(batch, outputs):
+            new_tokens = output[prompt_length:prompt_length + request.max_new_tokens]
+            texts.append(self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip())
+        return texts
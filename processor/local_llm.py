@@ -1,53 +1,80 @@
 from typing import List, Dict, Any, Optional
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
 import json
 import re
 
-from .llm_interface import LLMInterface
+from .llm_interface import LLMInterface, split_all_metrics
+from .response_cache import ResponseCache, make_cache_key
+from utils.messages import Message
+from .local_batching import MicroBatchGenerator
+from .prefix_cache import PrefixKVCache
+from .local_backends import load_local_model
 from . import local_prompts
 
 class LocalLLM(LLMInterface):
-    def __init__(self, model_name: str = "models/mistral-instruct"):
+    def __init__(
+        self,
+        model_name: str = "models/mistral-instruct",
+        response_cache: Optional[ResponseCache] = None,
+        batch_size: int = 4,
+        batch_max_wait_ms: float = 20.0,
+        prefix_cache: bool = True,
+        precision: str = "auto",
+        compile_model: bool = False,
+        num_threads: int = 0
+    ):
+        self.model_name = model_name
+        self.response_cache = response_cache
+        self.precision = precision
         print("🔁 Загружаем локальную модель...")
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
-            trust_remote_code=True
-        )
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-            device_map="auto"
-        )
+        self.tokenizer, self.model = load_local_model(model_name, precision, compile_model, num_threads)
         print("✅ Локальная модель загружена.")
+        self.prefix_cache = None
+        if prefix_cache:
+            self.prefix_cache = PrefixKVCache(self.model, self.tokenizer)
+            for name, prefix_text in local_prompts.STATIC_PREFIXES.items():
+                self.prefix_cache.register(name, prefix_text)
+        self.batcher = MicroBatchGenerator(
+            self.model, self.tokenizer, batch_size, batch_max_wait_ms, prefix_cache=self.prefix_cache
+        )
+        print(f"✅ Микробатчинг локальной модели: до {batch_size} промптов, окно {batch_max_wait_ms:.0f} мс")
 
-    def _format_chat_history(self, messages: List[Dict[str, Any]]) -> str:
+    def close(self):
+        """Останавливает движок микробатчинга"""
+        self.batcher.close()
+
+    def _format_chat_history(self, messages: List[Message]) -> str:
         """
         Форматирует историю чата в строку.
         """
         return "\\n".join([f"{m['SenderId']}: {m['MessageText']}" for m in messages])
 
-    def _make_request(self, prompt_text: str, max_retries: int = 3) -> str:
+    def _make_request(self, prompt_text: str, max_retries: int = 3, max_new_tokens: int = 256) -> str:
         """
-        Выполняет запрос к локальной модели.
+        Выполняет запрос к локальной модели, используя кэш ответов для повторяющихся промптов.
         """
-        inputs = self.tokenizer(prompt_text, return_tensors="pt", return_attention_mask=True).to(self.model.device)
+        if self.response_cache is None:
+            return self._generate(prompt_text, max_retries, max_new_tokens)
+
+        # Квантизованная модель отвечает иначе, поэтому её ответы кэшируются отдельно
+        precision = {} if self.precision == "auto" else {"precision": self.precision}
+        key = make_cache_key(self.model_name, 0.0, prompt_text, max_new_tokens=max_new_tokens, **precision)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            print(f"🗄️ Ответ локальной модели взят из кэша, длина: {len(cached)} символов")
+            return cached
 
+        text = self._generate(prompt_text, max_retries, max_new_tokens)
+        self.response_cache.set(key, text)
+        return text
+
+    def _generate(self, prompt_text: str, max_retries: int = 3, max_new_tokens: int = 256) -> str:
+        """
+        Генерирует ответ локальной моделью.
+        """
         for attempt in range(max_retries):
             try:
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=256, # Можно настроить
-                    do_sample=False,    # Для более детерминированного вывода
-                    temperature=0.0,    # Для более детерминированного вывода
-                    eos_token_id=self.tokenizer.eos_token_id
-                )
-                decoded = self.tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-                
-                # Удаляем часть промпта из ответа, если модель его повторяет
-                # Это характерно для instruct-моделей
-                if decoded.startswith(prompt_text):
-                    decoded = decoded[len(prompt_text):].strip()
+                # Промпт уходит в общий батч; возвращаются только новые токены, без текста промпта
+                decoded = self.batcher.generate(prompt_text, max_new_tokens)
                 
                 # Ищем закрывающий тег [/INST] и берем текст после него
                 inst_match = re.search(r"\[/INST\](.*)", decoded, re.DOTALL | re.IGNORECASE)
@@ -73,6 +100,15 @@ class LocalLLM(LLMInterface):
         cleaned_text = re.sub(r'```(?:json|)\\n?(.*?)\\n?```', r'\\1', text, flags=re.DOTALL)
         cleaned_text = re.sub(r'`(?!`)(.*?)`', r'\\1', cleaned_text) # Одиночные тики, не двойные
 
+        # Сначала пробуем весь фрагмент от первой до последней фигурной скобки,
+        # чтобы не разрезать вложенный JSON (комбинированный ответ метрик)
+        outer_start, outer_end = cleaned_text.find('{'), cleaned_text.rfind('}')
+        if outer_start != -1 and outer_end > outer_start:
+            try:
+                return json.loads(cleaned_text[outer_start:outer_end + 1])
+            except json.JSONDecodeError:
+                pass
+
         # Пытаемся найти JSON объект в тексте
         # Сначала ищем самый внешний JSON объект
         match = re.search(r'{\s*".*?":.*?}', cleaned_text, re.DOTALL)
@@ -120,20 +156,27 @@ class LocalLLM(LLMInterface):
         response_text = self._make_request(prompt, max_retries)
         return self._clean_markdown_and_extract_json(response_text)
 
-    def calculate_engagement(self, messages: List[Dict[str, Any]], historical_summary: str, max_retries: int = 3) -> Optional[Dict[str, Any]]:
+    def calculate_engagement(self, messages: List[Dict[str, Any]], historical_summary: str, previous_engagement: Optional[dict] = None, max_retries: int = 3) -> Optional[Dict[str, Any]]:
         chat_text = self._format_chat_history(messages)
         user_ids = list(set(m['SenderId'] for m in messages)) # Получаем уникальные ID
-        prompt = local_prompts.engagement_prompt(chat_text, user_ids, historical_summary)
+        prompt = local_prompts.engagement_prompt(chat_text, user_ids, historical_summary, previous_engagement)
         response_text = self._make_request(prompt, max_retries)
         return self._clean_markdown_and_extract_json(response_text)
 
-    def calculate_attachment(self, messages: List[Dict[str, Any]], historical_summary: str, max_retries: int = 3) -> Optional[Dict[str, Any]]:
+    def calculate_attachment(self, messages: List[Dict[str, Any]], historical_summary: str, previous_attachments: Optional[dict] = None, max_retries: int = 3) -> Optional[Dict[str, Any]]:
         chat_text = self._format_chat_history(messages)
         user_ids = list(set(m['SenderId'] for m in messages))
-        prompt = local_prompts.attachment_prompt(chat_text, user_ids, historical_summary)
+        prompt = local_prompts.attachment_prompt(chat_text, user_ids, historical_summary, previous_attachments)
         response_text = self._make_request(prompt, max_retries)
         return self._clean_markdown_and_extract_json(response_text)
 
+    def calculate_all_metrics(self, messages: List[Dict[str, Any]], historical_summary: str, previous_engagement: Optional[dict] = None, previous_attachments: Optional[dict] = None, max_retries: int = 3) -> Dict[str, Dict[str, Any]]:
+        chat_text = self._format_chat_history(messages)
+        user_ids = list(set(m['SenderId'] for m in messages))
+        prompt = local_prompts.all_metrics_prompt(chat_text, user_ids, historical_summary, previous_engagement, previous_attachments)
+        response_text = self._make_request(prompt, max_retries, max_new_tokens=512)
+        return split_all_metrics(self._clean_markdown_and_extract_json(response_text))
+
     def generate_recommendations(self, messages: List[Dict[str, Any]], historical_summary: str, user_id: str, max_retries: int = 3) -> Optional[str]:
         chat_text = self._format_chat_history(messages)
         prompt = local_prompts.recommendations_prompt(chat_text, historical_summary, user_id)
@@ -146,4 +189,12 @@ class LocalLLM(LLMInterface):
         prompt = local_prompts.summary_prompt(chat_text, historical_summary)
         response_text = self._make_request(prompt, max_retries)
         # Саммери - это просто текст, не JSON
-        return response_text if response_text else None 
\ No newline at end of file
+        return response_text if response_text else None
+
+    def compact_summary(self, summary: str, token_budget: int, max_retries: int = 3) -> Optional[str]:
+        prompt = local_prompts.compact_summary_prompt(summary, token_budget)
+        response_text = self._make_request(prompt, max_retries, max_new_tokens=token_budget)
+        return response_text if response_text else None
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"]) if text else 0 
\ No newline at end of file
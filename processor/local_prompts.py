@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 def _create_local_prompt(instruction: str) -> str:
     """
@@ -6,108 +6,216 @@ def _create_local_prompt(instruction: str) -> str:
     """
     return f"<s>[INST] {instruction} [/INST]"
 
+def _local_prompt_prefix(instruction: str) -> str:
+    """
+    Возвращает начало промпта до динамической части (используется для кэша префиксов KV).
+    """
+    return f"<s>[INST] {instruction}"
+
+# Статические части инструкций. Всё, что зависит от чата, добавляется после них,
+# поэтому начало промпта одинаково у всех запросов одного типа.
+_COMPLIMENTS_INSTRUCTION = (
+    "Ты — самый профессиональный и точный аналитик диалогов. "
+    "Проанализируй чат и подсчитай, сколько комплиментов сделал каждый собеседник. "
+    "ВАЖНО: ответь строго в формате JSON. В качестве ключей используй только числовые ID пользователей, "
+    "как они указаны в начале каждого сообщения. Не используй слова 'SenderId' или 'пользователь'. "
+    "Используй только числовые ID, без кавычек в ключах."
+    "Пример правильного ответа: {\"123\": 3, \"456\": 1}"
+    "Пример неправильного ответа: {\"SenderId_123\": 3, \"user\": 1}"
+)
+
+_ENGAGEMENT_INSTRUCTION = (
+    "Ты — самый профессиональный и точный аналитик диалогов. "
+    "На основе истории сообщений между двумя собеседниками и новых сообщений оцени уровень вовлечённости каждого участника (от 0 до 100). "
+    "Если для участника уже был сделан прогноз ранее, обязательно учитывай его: "
+    "не меняй уровень вовлечённости резко без явных оснований. "
+    "Если появились сомнения, сначала плавно снижай или повышай уровень вовлечённости, а не делай резких скачков. "
+    "ВАЖНО: В ответе используй только числовые идентификаторы пользователей (SenderId) из чата. "
+    "Не используй слова 'SenderId' или 'пользователь', только сами числовые ID. "
+    "Ответь строго в формате JSON, где ключи — это идентификаторы пользователей, а значения — уровень вовлечённости."
+    "Пример правильного ответа: {\"123\": 82.5, \"456\": 67.2}"
+    "Пример неправильного ответа: {\"SenderId_123\": 82.5, \"user\": 67.2}"
+)
+
+_ATTACHMENT_INSTRUCTION = (
+    "You are the most professional and accurate dialogue analyst. "
+    "Based on the chat history and new messages, determine the attachment type for each participant: 'secure', 'anxious', or 'avoidant', and the confidence (0 to 100). "
+    "\n\nIMPORTANT RULES:"
+    "\n1. If the current type matches the previous prediction AND new messages show clear signs of this type, increase confidence by 5-10 points."
+    "\n2. If the current type differs from the previous prediction, decrease confidence by 10-15 points."
+    "\n3. Only change the attachment type if confidence drops below 40%."
+    "\n4. Confidence should never increase by more than 10 points at once."
+    "\n5. If there are no clear signs of any type, decrease confidence by 5 points."
+    "\n\nSIGNS OF EACH TYPE:"
+    "\n- SECURE:"
+    "\n  * Comfortable with both intimacy and independence"
+    "\n  * Clear and direct communication"
+    "\n  * Balanced emotional responses"
+    "\n  * Example: 'I enjoy our time together, but I also need some space for my hobbies'"
+    "\n- ANXIOUS:"
+    "\n  * Seeks constant reassurance"
+    "\n  * Worries about relationship stability"
+    "\n  * Overanalyzes messages and responses"
+    "\n  * Example: 'Are you sure you\'re not upset with me? You haven\'t replied in 5 minutes'"
+    "\n- AVOIDANT:"
+    "\n  * Maintains emotional distance"
+    "\n  * Avoids deep conversations"
+    "\n  * Prefers independence over closeness"
+    "\n  * Example: 'I don\'t like to discuss feelings. Let\'s keep things casual'"
+    "\n\nVERY IMPORTANT: Return a JSON object where keys are ONLY numeric user IDs from SenderId."
+    "\nDO NOT use 'SenderId' or 'user' in the keys, use only the numbers. Each value should be an object with keys 'type' and 'confidence'."
+    "\nCorrect example: {\"123\": {\"type\": \"secure\", \"confidence\": 75}, \"456\": {\"type\": \"anxious\", \"confidence\": 60}}"
+    "\nIncorrect example: {\"SenderId_123\": {\"type\": \"secure\", \"confidence\": 75}, \"user\": {\"type\": \"anxious\", \"confidence\": 60}}"
+    "\nUse only English for all keys and values."
+)
+
+_ALL_METRICS_INSTRUCTION = (
+    "Ты — самый профессиональный и точный аналитик диалогов. "
+    "Проанализируй чат и для каждого собеседника определи три метрики:"
+    "\n1. compliments — сколько комплиментов сделал собеседник в этом чате (целое число)."
+    "\n2. engagement — уровень вовлечённости собеседника от 0 до 100. "
+    "Если для участника уже был сделан прогноз ранее, обязательно учитывай его: "
+    "не меняй уровень вовлечённости резко без явных оснований, сначала плавно снижай или повышай его."
+    "\n3. attachment — тип привязанности ('secure', 'anxious' или 'avoidant') и уверенность (confidence) от 0 до 100."
+    "\n\nПРАВИЛА ДЛЯ ПРИВЯЗАННОСТИ:"
+    "\n- Если текущий тип совпадает с предыдущим прогнозом и в новых сообщениях есть явные признаки этого типа, повышай уверенность на 5-10 пунктов."
+    "\n- Если текущий тип отличается от предыдущего прогноза, снижай уверенность на 10-15 пунктов."
+    "\n- Меняй тип привязанности только если уверенность упала ниже 40."
+    "\n- Уверенность никогда не должна расти больше чем на 10 пунктов за раз."
+    "\n- Если явных признаков нет, снижай уверенность на 5 пунктов."
+    "\n- SECURE: комфорт и в близости, и в независимости, ясная и прямая коммуникация, сбалансированные эмоции."
+    "\n- ANXIOUS: постоянный поиск подтверждений, тревога о стабильности отношений, переанализ сообщений."
+    "\n- AVOIDANT: эмоциональная дистанция, уход от глубоких разговоров, предпочтение независимости."
+    "\n\nВАЖНО: ответь строго в формате JSON с ключами верхнего уровня 'compliments', 'engagement' и 'attachment'. "
+    "Внутри каждого ключа используй только числовые ID пользователей, как они указаны в начале каждого сообщения. "
+    "Не используй слова 'SenderId' или 'пользователь'. Значения type пиши только на английском."
+    "\nПример правильного ответа: "
+    "{\"compliments\": {\"123\": 3, \"456\": 1}, "
+    "\"engagement\": {\"123\": 82.5, \"456\": 67.2}, "
+    "\"attachment\": {\"123\": {\"type\": \"secure\", \"confidence\": 75}, \"456\": {\"type\": \"anxious\", \"confidence\": 60}}}"
+)
+
+_SUMMARY_INSTRUCTION = (
+    "Ты — аналитик диалогов. Твоя задача - точно и объективно резюмировать содержание сообщений."
+    "\n\nВАЖНЫЕ ПРАВИЛА:"
+    "\n1. Анализируй ТОЛЬКО предоставленные сообщения. Не выдумывай диалоги или детали, которых нет."
+    "\n2. Если есть сообщения только от одного участника, отметь это явно."
+    "\n3. Если сообщений мало, сделай краткое резюме только по фактам."
+    "\n4. НЕ ВКЛЮЧАЙ ссылки, поисковые подсказки или фразы о том, что \"в интернете есть информация\"."
+    "\n5. НЕ ССЫЛАЙСЯ на посторонние источники информации."
+    "\n6. Будь объективным и нейтральным."
+    "\n\nЕсли ты видишь только одно сообщение, просто резюмируй его содержание. "
+    "Не выдумывай ответы или реакции, которых нет в данных."
+    "\n\nСосредоточься ТОЛЬКО на содержании сообщений, без дополнительных предположений."
+)
+
+_COMPACT_SUMMARY_INSTRUCTION = (
+    "Ты — аналитик диалогов. Твоя задача - сжать историческое саммери диалога."
+    "\n\nВАЖНЫЕ ПРАВИЛА:"
+    "\n1. Сохрани ключевые факты, договорённости, темы и изменения в отношениях собеседников."
+    "\n2. Убери повторы и второстепенные детали; более старые события описывай короче, чем недавние."
+    "\n3. НЕ ДОБАВЛЯЙ ничего, чего нет в исходном саммери."
+    "\n4. Ответь только текстом нового саммери, без пояснений."
+)
+
+_RECOMMENDATIONS_INSTRUCTION = (
+    "Ты — коммуникационный коуч."
+    "Твоя задача дать пользователю одну короткую, практичную рекомендацию, как улучшить или углубить общение с другим человеком на основе:"
+    "Обобщения истории диалога,"
+    "Анализа эмоциональных сигналов,"
+    "Шаблонов вовлеченности,"
+    "Новых сообщений"
+    "Формулируй один конкретный и понятный совет, который легко применить:"
+    "это может быть поведенческое действие (например, задать вопрос, проявить эмоцию, проявить инициативу) или рекомендация по переосмыслению своей роли в общении (например, быть внимательнее к тону, снизить давление и т.д.)."
+    "Не добавляй пояснений, не давай длинных размышлений — только совет."
+    "Совет должен быть в указательной форме."
+    "Совет должен относиться не только к последним сообщениям, но и к истории диалога, учитывать контекст."
+    "Примеры совета:"
+    "Попробуй в ответ задать уточняющий вопрос — это покажет твою вовлеченность"
+    "Предложи конкретное время или фильм — это поможет перевести идею в действие."
+    "Добавь немного личного — небольшая деталь о себе сделает разговор теплее."
+)
+
 def compliments_prompt(chat_text: str) -> str:
-    instruction = (
-        "Ты — самый профессиональный и точный аналитик диалогов. "
-        "Проанализируй чат и подсчитай, сколько комплиментов сделал каждый собеседник. "
-        "ВАЖНО: ответь строго в формате JSON. В качестве ключей используй только числовые ID пользователей, "
-        "как они указаны в начале каждого сообщения. Не используй слова 'SenderId' или 'пользователь'. "
-        "Используй только числовые ID, без кавычек в ключах."
-        "Пример правильного ответа: {\"123\": 3, \"456\": 1}"
-        "Пример неправильного ответа: {\"SenderId_123\": 3, \"user\": 1}"
+    instruction = _COMPLIMENTS_INSTRUCTION + (
         f"\n\nЧат для анализа:\n{chat_text}\n\nПример ответа: {{\"123\": 3, \"456\": 1}}"
     )
     return _create_local_prompt(instruction)
 
-def engagement_prompt(chat_text: str, user_ids: List[str], historical_summary: Optional[str] = None) -> str:
+def engagement_prompt(chat_text: str, user_ids: List[str], historical_summary: Optional[str] = None, previous_engagement: Optional[dict] = None) -> str:
     history_context = f"Историческое саммери диалога:\n{historical_summary}\n\n" if historical_summary else ""
-    instruction = (
-        "Ты — самый профессиональный и точный аналитик диалогов. "
-        "На основе истории сообщений между двумя собеседниками и новых сообщений оцени уровень вовлечённости каждого участника (от 0 до 100). "
-        "Если для участника уже был сделан прогноз ранее, обязательно учитывай его: "
-        "не меняй уровень вовлечённости резко без явных оснований. "
-        "Если появились сомнения, сначала плавно снижай или повышай уровень вовлечённости, а не делай резких скачков. "
-        "ВАЖНО: В ответе используй только числовые идентификаторы пользователей (SenderId) из чата. "
-        "Не используй слова 'SenderId' или 'пользователь', только сами числовые ID. "
-        "Ответь строго в формате JSON, где ключи — это идентификаторы пользователей, а значения — уровень вовлечённости."
-        "Пример правильного ответа: {\"123\": 82.5, \"456\": 67.2}"
-        "Пример неправильного ответа: {\"SenderId_123\": 82.5, \"user\": 67.2}"
+    if previous_engagement:
+        history_context += "Предыдущие значения вовлечённости:\n"
+        for uid, val in previous_engagement.items():
+            history_context += f"- {uid}: {val}\n"
+        history_context += "\n"
+    instruction = _ENGAGEMENT_INSTRUCTION + (
         f"\n\n{history_context}Чат для анализа:\n{chat_text}"
     )
     return _create_local_prompt(instruction)
 
-def attachment_prompt(chat_text: str, user_ids: List[str], historical_summary: Optional[str] = None) -> str:
+def attachment_prompt(chat_text: str, user_ids: List[str], historical_summary: Optional[str] = None, previous_attachments: Optional[dict] = None) -> str:
     history_context = f"History summary:\n{historical_summary}\n\n" if historical_summary else ""
-    instruction = (
-        "You are the most professional and accurate dialogue analyst. "
-        "Based on the chat history and new messages, determine the attachment type for each participant: 'secure', 'anxious', or 'avoidant', and the confidence (0 to 100). "
-        "\n\nIMPORTANT RULES:"
-        "\n1. If the current type matches the previous prediction AND new messages show clear signs of this type, increase confidence by 5-10 points."
-        "\n2. If the current type differs from the previous prediction, decrease confidence by 10-15 points."
-        "\n3. Only change the attachment type if confidence drops below 40%."
-        "\n4. Confidence should never increase by more than 10 points at once."
-        "\n5. If there are no clear signs of any type, decrease confidence by 5 points."
-        "\n\nSIGNS OF EACH TYPE:"
-        "\n- SECURE:"
-        "\n  * Comfortable with both intimacy and independence"
-        "\n  * Clear and direct communication"
-        "\n  * Balanced emotional responses"
-        "\n  * Example: 'I enjoy our time together, but I also need some space for my hobbies'"
-        "\n- ANXIOUS:"
-        "\n  * Seeks constant reassurance"
-        "\n  * Worries about relationship stability"
-        "\n  * Overanalyzes messages and responses"
-        "\n  * Example: 'Are you sure you\'re not upset with me? You haven\'t replied in 5 minutes'"
-        "\n- AVOIDANT:"
-        "\n  * Maintains emotional distance"
-        "\n  * Avoids deep conversations"
-        "\n  * Prefers independence over closeness"
-        "\n  * Example: 'I don\'t like to discuss feelings. Let\'s keep things casual'"
-        "\n\nVERY IMPORTANT: Return a JSON object where keys are ONLY numeric user IDs from SenderId."
-        "\nDO NOT use 'SenderId' or 'user' in the keys, use only the numbers. Each value should be an object with keys 'type' and 'confidence'."
-        "\nCorrect example: {\"123\": {\"type\": \"secure\", \"confidence\": 75}, \"456\": {\"type\": \"anxious\", \"confidence\": 60}}"
-        "\nIncorrect example: {\"SenderId_123\": {\"type\": \"secure\", \"confidence\": 75}, \"user\": {\"type\": \"anxious\", \"confidence\": 60}}"
-        "\nUse only English for all keys and values."
+    if previous_attachments:
+        history_context += "Previous attachment predictions:\n"
+        for uid, val in previous_attachments.items():
+            history_context += f"- {uid}: type={val.get('type', 'unknown')}, confidence={val.get('confidence', 0)}\n"
+        history_context += "\n"
+    instruction = _ATTACHMENT_INSTRUCTION + (
         f"\n\n{history_context}Chat for analysis:\n{chat_text}"
     )
     return _create_local_prompt(instruction)
 
+def all_metrics_prompt(
+    chat_text: str,
+    user_ids: List[str],
+    historical_summary: Optional[str] = None,
+    previous_engagement: Optional[dict] = None,
+    previous_attachments: Optional[dict] = None
+) -> str:
+    history_context = f"Историческое саммери диалога:\n{historical_summary}\n\n" if historical_summary else ""
+    if previous_engagement:
+        history_context += "Предыдущие значения вовлечённости:\n"
+        for uid, val in previous_engagement.items():
+            history_context += f"- {uid}: {val}\n"
+        history_context += "\n"
+    if previous_attachments:
+        history_context += "Предыдущие прогнозы привязанности:\n"
+        for uid, val in previous_attachments.items():
+            history_context += f"- {uid}: type={val.get('type', 'unknown')}, confidence={val.get('confidence', 0)}\n"
+        history_context += "\n"
+    instruction = _ALL_METRICS_INSTRUCTION + (
+        f"\n\n{history_context}Чат для анализа:\n{chat_text}"
+    )
+    return _create_local_prompt(instruction)
+
 def recommendations_prompt(chat_text: str, historical_summary: Optional[str], user_id: str) -> str:
     history_context = f"Историческое саммери диалога:\n{historical_summary}\n\n" if historical_summary else ""
-    instruction = (
-        "Ты — коммуникационный коуч."
-        f"Твоя задача дать пользователю {user_id} одну короткую, практичную рекомендацию, как улучшить или углубить общение с другим человеком на основе:"
-        "Обобщения истории диалога,"
-        "Анализа эмоциональных сигналов,"
-        "Шаблонов вовлеченности,"
-        "Новых сообщений"
-        "Формулируй один конкретный и понятный совет, который легко применить:"
-        "это может быть поведенческое действие (например, задать вопрос, проявить эмоцию, проявить инициативу) или рекомендация по переосмыслению своей роли в общении (например, быть внимательнее к тону, снизить давление и т.д.)."
-        "Не добавляй пояснений, не давай длинных размышлений — только совет."
-        "Совет должен быть в указательной форме."
-        "Совет должен относиться не только к последним сообщениям, но и к истории диалога, учитывать контекст."
-        "Примеры совета:"
-        "Попробуй в ответ задать уточняющий вопрос — это покажет твою вовлеченность"
-        "Предложи конкретное время или фильм — это поможет перевести идею в действие."
-        "Добавь немного личного — небольшая деталь о себе сделает разговор теплее."
+    instruction = _RECOMMENDATIONS_INSTRUCTION + (
         f"\n\n{history_context}Дай рекомендацию пользователю {user_id}, последние сообщения:\n{chat_text}"
     )
     return _create_local_prompt(instruction)
 
 def summary_prompt(chat_text: str, historical_summary: Optional[str] = None) -> str:
     history_context = f"Предыдущее историческое саммери:\n{historical_summary}\n\n" if historical_summary else ""
-    instruction = (
-        "Ты — аналитик диалогов. Твоя задача - точно и объективно резюмировать содержание сообщений."
-        "\n\nВАЖНЫЕ ПРАВИЛА:"
-        "\n1. Анализируй ТОЛЬКО предоставленные сообщения. Не выдумывай диалоги или детали, которых нет."
-        "\n2. Если есть сообщения только от одного участника, отметь это явно."
-        "\n3. Если сообщений мало, сделай краткое резюме только по фактам."
-        "\n4. НЕ ВКЛЮЧАЙ ссылки, поисковые подсказки или фразы о том, что \"в интернете есть информация\"."
-        "\n5. НЕ ССЫЛАЙСЯ на посторонние источники информации."
-        "\n6. Будь объективным и нейтральным."
-        "\n\nЕсли ты видишь только одно сообщение, просто резюмируй его содержание. "
-        "Не выдумывай ответы или реакции, которых нет в данных."
-        "\n\nСосредоточься ТОЛЬКО на содержании сообщений, без дополнительных предположений."
+    instruction = _SUMMARY_INSTRUCTION + (
         f"\n\n{history_context}Обнови саммери, учитывая следующий новый фрагмент чата:\n{chat_text}"
     )
-    return _create_local_prompt(instruction) 
\ No newline at end of file
+    return _create_local_prompt(instruction) 
+
+def compact_summary_prompt(summary: str, token_budget: int) -> str:
+    instruction = _COMPACT_SUMMARY_INSTRUCTION + (
+        f"\n\nСожми саммери так, чтобы оно занимало не больше {token_budget} токенов:\n{summary}"
+    )
+    return _create_local_prompt(instruction)
+
+# Статические префиксы промптов по типу запроса
+STATIC_PREFIXES: Dict[str, str] = {
+    "compliments": _local_prompt_prefix(_COMPLIMENTS_INSTRUCTION),
+    "engagement": _local_prompt_prefix(_ENGAGEMENT_INSTRUCTION),
+    "attachment": _local_prompt_prefix(_ATTACHMENT_INSTRUCTION),
+    "all_metrics": _local_prompt_prefix(_ALL_METRICS_INSTRUCTION),
+    "recommendations": _local_prompt_prefix(_RECOMMENDATIONS_INSTRUCTION),
+    "summary": _local_prompt_prefix(_SUMMARY_INSTRUCTION),
+    "compact_summary": _local_prompt_prefix(_COMPACT_SUMMARY_INSTRUCTION)
+}
@@ -0,0 +1,82 @@
+import copy
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+
+class PrefixKVCache:
+    """
+    Кэш past_key_values для статических префиксов промптов локальной модели.
+    Префикс (инструкция) прогоняется через модель один раз при старте, а каждый
+    запрос начинает генерацию с копии готового кэша, так что prefill оплачивается
+    только для динамической части (история и текст чата).
+    """
+
+    def __init__(self, model, tokenizer):
+        """
+        Args:
+            model: Загруженная модель transformers
+            tokenizer: Токенизатор модели
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self._entries: Dict[str, Tuple[str, List[int], DynamicCache]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, name: str, prefix_text: str):
+        """
+        Прогоняет префикс через модель и сохраняет его KV-кэш
+
+        Args:
+            name: Имя префикса (тип запроса)
+            prefix_text: Текст префикса, с которого начинаются промпты этого типа
+        """
+        start_time = time.time()
+        inputs = self.tokenizer(prefix_text, return_tensors="pt").to(self.model.device)
+        cache = DynamicCache()
+        with torch.inference_mode():
+            self.model(**inputs, past_key_values=cache, use_cache=True)
+        prefix_ids = inputs["input_ids"][0].tolist()
+        with self._lock:
+            self._entries[name] = (prefix_text, prefix_ids, cache)
+        print(f"✅ KV-кэш префикса '{name}': {len(prefix_ids)} токенов за {time.time() - start_time:.2f} сек.")
+
+    def lookup(self, prompt_text: str, input_ids: List[int]) -> Optional[DynamicCache]:
+        """
+        Ищет закэшированный префикс для промпта
+
+        Args:
+            prompt_text: Полный текст промпта
+            input_ids: Токены полного промпта
+
+        Returns:
+            Копия KV-кэша префикса или None, если подходящего префикса нет
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+        for prefix_text, prefix_ids, cache in entries:
+            if not prompt_text.startswith(prefix_text):
+                continue
+            # Токенизация на стыке префикса и остатка может отличаться от токенизации префикса отдельно,
+            # поэтому кэш используется только при точном совпадении токенов
+            if len(input_ids) > len(prefix_ids) and input_ids[:len(prefix_ids)] == prefix_ids:
+                self.hits += 1
+                # generate дописывает в кэш, поэтому каждому запросу нужна своя копия
+                return copy.deepcopy(cache)
+        self.misses += 1
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики кэша префиксов"""
+        total = self.hits + self.misses
+        return {
+            "prefixes": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket. Ожидающие вызовы обслуживаются строго по очереди (FIFO),
+    поэтому поток запросов равномерно распределяется во времени без всплесков.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: Скорость пополнения в токенах в секунду (0 — без ограничения)
+            capacity: Ёмкость корзины, то есть допустимый всплеск (по умолчанию равна rate, минимум 1)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if now < self.blocked_until:
+            self.updated_at = now
+            return
+        elapsed = now - max(self.updated_at, self.blocked_until)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Ждёт, пока в корзине появится токен, и забирает его"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+
+    def penalize(self, seconds: float):
+        """
+        Приостанавливает выдачу токенов (например, после ответа 429)
+
+        Args:
+            seconds: На сколько секунд приостановить выдачу
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class LLMScheduler:
+    """
+    Общий планировщик исходящих запросов к одному LLM-бэкенду:
+    ограничивает число запросов в секунду и количество одновременных запросов.
+    """
+
+    def __init__(self, name: str, requests_per_second: float, max_in_flight: int, burst: Optional[float] = None):
+        """
+        Args:
+            name: Имя бэкенда (для логов и метрик)
+            requests_per_second: Разрешённое число запросов в секунду (0 — без ограничения)
+            max_in_flight: Максимум одновременных запросов (0 — без ограничения)
+            burst: Допустимый всплеск запросов сверх равномерного потока
+        """
+        self.name = name
+        self.requests_per_second = requests_per_second
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self._semaphore = asyncio.Semaphore(max_in_flight) if max_in_flight > 0 else None
+        self.in_flight = 0
+        self.waiting = 0
+        self.total_requests = 0
+        self.total_wait_time = 0.0
+        self.throttled = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Контекстный менеджер, внутри которого выполняется один запрос к бэкенду.
+        Ожидание происходит в очереди, а не фиксированной паузой.
+        """
+        self.waiting += 1
+        start_time = time.monotonic()
+        acquired = False
+        try:
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+                acquired = True
+            await self.bucket.acquire()
+        except BaseException:
+            if acquired:
+                self._semaphore.release()
+            raise
+        finally:
+            self.waiting -= 1
+
+        self.total_wait_time += time.monotonic() - start_time
+        self.total_requests += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def throttle(self, seconds: float):
+        """
+        Сообщает планировщику, что провайдер попросил снизить нагрузку (HTTP 429)
+
+        Args:
+            seconds: Пауза перед следующими запросами
+        """
+        self.throttled += 1
+        self.bucket.penalize(seconds)
+        print(f"⏱️ {self.name}: провайдер ограничил запросы, пауза {seconds:.1f} сек.")
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает текущие показатели планировщика"""
+        avg_wait = self.total_wait_time / self.total_requests if self.total_requests else 0.0
+        return {
+            "backend": self.name,
+            "requests_per_second": self.requests_per_second,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "total_requests": self.total_requests,
+            "avg_wait_seconds": avg_wait,
+            "throttled": self.throttled
+        }
+
+
+_schedulers: Dict[str, LLMScheduler] = {}
+
+
+def get_scheduler(backend: str) -> LLMScheduler:
+    """
+    Возвращает общий планировщик для указанного бэкенда, создавая его по настройкам из config
+
+    Args:
+        backend: Тип бэкенда ("yandex" или "local")
+
+    Returns:
+        Экземпляр LLMScheduler
+    """
+    if backend not in _schedulers:
+        from config import YANDEX_RPS, YANDEX_MAX_IN_FLIGHT, LOCAL_RPS, LOCAL_MAX_IN_FLIGHT
+
+        if backend == "yandex":
+            _schedulers[backend] = LLMScheduler(backend, YANDEX_RPS, YANDEX_MAX_IN_FLIGHT)
+        elif backend == "local":
+            _schedulers[backend] = LLMScheduler(backend, LOCAL_RPS, LOCAL_MAX_IN_FLIGHT)
+        else:
+            raise ValueError(f"Неизвестный тип LLM: {backend}. Доступные типы: 'yandex', 'local'")
+    return _schedulers[backend]
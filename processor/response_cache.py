@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def make_cache_key(model: str, temperature: float, messages: Any, **params) -> str:
+    """
+    Строит ключ кэша по точному содержимому запроса
+
+    Args:
+        model: Имя модели
+        temperature: Температура генерации
+        messages: Сообщения или текст промпта
+        **params: Прочие параметры генерации, влияющие на ответ
+
+    Returns:
+        SHA-256 хэш запроса в hex
+    """
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "messages": messages, "params": params},
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """LRU-кэш ответов в памяти процесса"""
+
+    blocking = False
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if self.ttl_seconds and time.time() - created_at > self.ttl_seconds:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCacheBackend:
+    """Кэш ответов на диске в SQLite; переживает перезапуск процесса"""
+
+    blocking = True
+
+    # Как часто (в записях) проверять превышение размера
+    EVICTION_CHECK_EVERY = 100
+
+    def __init__(self, path: str, max_entries: int = 100000, ttl_seconds: float = 0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_responses_accessed_at ON llm_responses (accessed_at)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE llm_responses SET accessed_at = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._writes += 1
+            if self._writes % self.EVICTION_CHECK_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        if self.ttl_seconds:
+            cursor = self._conn.execute(
+                "DELETE FROM llm_responses WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+            self.evictions += cursor.rowcount
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_responses").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            cursor = self._conn.execute("""
+                DELETE FROM llm_responses WHERE key IN (
+                    SELECT key FROM llm_responses ORDER BY accessed_at LIMIT ?
+                )
+            """, (excess,))
+            self.evictions += cursor.rowcount
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_responses").fetchone()
+            return count
+
+
+class ResponseCache:
+    """
+    Кэш ответов LLM по хэшу запроса (сообщения + модель + температура).
+    При температуре 0.0 повторная отправка того же батча возвращает тот же ответ без запроса к модели.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: str):
+        if value:
+            self.backend.set(key, value)
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Асинхронный get: дисковый бэкенд выполняется вне event loop"""
+        if not self.backend.blocking:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: str):
+        """Асинхронный set: дисковый бэкенд выполняется вне event loop"""
+        if not self.backend.blocking:
+            self.set(key, value)
+        else:
+            await asyncio.to_thread(self.set, key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики кэша"""
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.backend.evictions
+        }
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_created = False
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    Возвращает общий кэш ответов по настройкам из config
+
+    Returns:
+        Экземпляр ResponseCache или None, если кэш выключен (LLM_CACHE_BACKEND=none)
+    """
+    global _response_cache, _response_cache_created
+    if not _response_cache_created:
+        from config import LLM_CACHE_BACKEND, LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS
+
+        if LLM_CACHE_BACKEND == "memory":
+            _response_cache = ResponseCache(MemoryCacheBackend(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS))
+        elif LLM_CACHE_BACKEND == "sqlite":
+            _response_cache = ResponseCache(SQLiteCacheBackend(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS))
+        elif LLM_CACHE_BACKEND != "none":
+            raise ValueError(f"Неизвестный бэкенд кэша LLM: {LLM_CACHE_BACKEND}. Доступные: 'none', 'memory', 'sqlite'")
+        _response_cache_created = True
+        if _response_cache is not None:
+            print(f"🗄️ Кэш ответов LLM: {LLM_CACHE_BACKEND}, максимум {LLM_CACHE_MAX_ENTRIES} записей")
+    return _response_cache
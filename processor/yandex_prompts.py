@@ -109,6 +109,107 @@ def attachment_messages(chat_text: str, user_ids: list, historical_summary: str
         {"role": "user", "text": user_content}
     ]
 
+def all_metrics_messages(
+    chat_text: str,
+    user_ids: list,
+    historical_summary: str = "",
+    previous_engagement: dict = None,
+    previous_attachments: dict = None
+) -> List[Dict[str, str]]:
+    """Сообщения для расчета комплиментов, вовлеченности и привязанности одним запросом"""
+    system_prompt = (
+        "Ты — самый профессиональный и точный аналитик диалогов. "
+        "Проанализируй чат и для каждого собеседника определи три метрики:"
+        "\n1. compliments — сколько комплиментов сделал собеседник в этом чате (целое число)."
+        "\n2. engagement — уровень вовлечённости собеседника от 0 до 100. "
+        "Если для участника уже был сделан прогноз ранее, обязательно учитывай его: "
+        "не меняй уровень вовлечённости резко без явных оснований, сначала плавно снижай или повышай его."
+        "\n3. attachment — тип привязанности ('secure', 'anxious' или 'avoidant') и уверенность (confidence) от 0 до 100."
+        "\n\nПРАВИЛА ДЛЯ ПРИВЯЗАННОСТИ:"
+        "\n- Если текущий тип совпадает с предыдущим прогнозом и в новых сообщениях есть явные признаки этого типа, повышай уверенность на 5-10 пунктов."
+        "\n- Если текущий тип отличается от предыдущего прогноза, снижай уверенность на 10-15 пунктов."
+        "\n- Меняй тип привязанности только если уверенность упала ниже 40."
+        "\n- Уверенность никогда не должна расти больше чем на 10 пунктов за раз."
+        "\n- Если явных признаков нет, снижай уверенность на 5 пунктов."
+        "\n- SECURE: комфорт и в близости, и в независимости, ясная и прямая коммуникация, сбалансированные эмоции."
+        "\n- ANXIOUS: постоянный поиск подтверждений, тревога о стабильности отношений, переанализ сообщений."
+        "\n- AVOIDANT: эмоциональная дистанция, уход от глубоких разговоров, предпочтение независимости."
+        "\n\nВАЖНО: ответь строго в формате JSON с ключами верхнего уровня 'compliments', 'engagement' и 'attachment'. "
+        "Внутри каждого ключа используй только числовые ID пользователей, как они указаны в начале каждого сообщения. "
+        "Не используй слова 'SenderId' или 'пользователь'. Значения type пиши только на английском."
+        "\nПример правильного ответа: "
+        "{\"compliments\": {\"123\": 3, \"456\": 1}, "
+        "\"engagement\": {\"123\": 82.5, \"456\": 67.2}, "
+        "\"attachment\": {\"123\": {\"type\": \"secure\", \"confidence\": 75}, \"456\": {\"type\": \"anxious\", \"confidence\": 60}}}"
+    )
+    history_context = f"Историческое саммери:\n{historical_summary}\n\n" if historical_summary else ""
+    prev_context = ""
+    if previous_engagement:
+        prev_context += "Предыдущие значения вовлечённости:\n"
+        for uid, val in previous_engagement.items():
+            prev_context += f"- {uid}: {val}\n"
+        prev_context += "\n"
+    if previous_attachments:
+        prev_context += "Предыдущие прогнозы привязанности:\n"
+        for uid, val in previous_attachments.items():
+            prev_context += f"- {uid}: type={val.get('type', 'unknown')}, confidence={val.get('confidence', 0)}\n"
+        prev_context += "\n"
+    user_content = f"{history_context}{prev_context}Чат:\n{chat_text}"
+    
+    return create_yandex_messages(system_prompt, user_content)
+
+# Ожидаемая структура ответа для каждого типа запроса: передается в промпт исправления JSON,
+# чтобы модель не теряла вложенность ответа
+COMPLIMENTS_SCHEMA = (
+    "объект, где ключи — числовые ID пользователей, а значения — число комплиментов (целое число). "
+    "Пример: {\"123\": 3, \"456\": 1}"
+)
+ENGAGEMENT_SCHEMA = (
+    "объект, где ключи — числовые ID пользователей, а значения — уровень вовлечённости от 0 до 100. "
+    "Пример: {\"123\": 82.5, \"456\": 67.2}"
+)
+ATTACHMENT_SCHEMA = (
+    "объект, где ключи — числовые ID пользователей, а значения — объекты с ключами type и confidence. "
+    "Пример: {\"123\": {\"type\": \"secure\", \"confidence\": 75}, \"456\": {\"type\": \"anxious\", \"confidence\": 60}}"
+)
+ALL_METRICS_SCHEMA = (
+    "объект с ключами верхнего уровня compliments, engagement и attachment; значение каждого — объект, "
+    "где ключи — числовые ID пользователей. compliments — число комплиментов, engagement — вовлечённость от 0 до 100, "
+    "attachment — объект с ключами type и confidence. "
+    "Пример: {\"compliments\": {\"123\": 3, \"456\": 1}, "
+    "\"engagement\": {\"123\": 82.5, \"456\": 67.2}, "
+    "\"attachment\": {\"123\": {\"type\": \"secure\", \"confidence\": 75}, \"456\": {\"type\": \"anxious\", \"confidence\": 60}}}"
+)
+
+def json_repair_prompt(text: str, schema: str) -> str:
+    """
+    Промпт для исправления ответа, из которого не удалось извлечь JSON
+
+    Args:
+        text: Исходный ответ модели
+        schema: Описание ожидаемой структуры ответа с примером
+
+    Returns:
+        Текст промпта
+    """
+    return f"""Проанализируй следующий текст и верни его как валидный JSON.
+
+        ТЕКСТ:
+        {text}
+
+        ОЖИДАЕМАЯ СТРУКТУРА:
+        {schema}
+
+        ВАЖНЫЕ ПРАВИЛА:
+        1. Верни ТОЛЬКО валидный JSON, без дополнительного текста
+        2. Сохрани структуру из описания выше: не убирай и не объединяй вложенные объекты
+        3. В качестве ID пользователей используй только числовые ID, НЕ ИСПОЛЬЗУЙ 'SenderId' или 'user' в ключах
+        4. Все текстовые значения должны быть строками в двойных кавычках
+        5. Числовые значения НЕ должны быть в кавычках
+
+        Верни ТОЛЬКО исправленный JSON:
+    """
+
 def recommendations_messages(chat_text: str, historical_summary: str, user_id: str) -> List[Dict[str, str]]:
     """Сообщения для генерации рекомендаций"""
     system_prompt = (
@@ -156,6 +257,20 @@ def summary_messages(chat_text: str, historical_summary: str = "") -> List[Dict[
     
     return create_yandex_messages(system_prompt, user_content)
 
+def compact_summary_messages(summary: str, token_budget: int) -> List[Dict[str, str]]:
+    """Сообщения для сжатия исторического саммери до бюджета токенов"""
+    system_prompt = '''Ты — аналитик диалогов. Твоя задача - сжать историческое саммери диалога.
+
+ВАЖНЫЕ ПРАВИЛА:
+1. Сохрани ключевые факты, договорённости, темы и изменения в отношениях собеседников.
+2. Убери повторы и второстепенные детали; более старые события описывай короче, чем недавние.
+3. НЕ ДОБАВЛЯЙ ничего, чего нет в исходном саммери.
+4. Ответь только текстом нового саммери, без пояснений.'''
+    
+    user_content = f"Сожми саммери так, чтобы оно занимало не больше {token_budget} токенов:\n{summary}"
+    
+    return create_yandex_messages(system_prompt, user_content)
+
 def legacy_analysis_messages(chat_text: str) -> List[Dict[str, str]]:
     """Устаревшие сообщения для анализа батча (обратная совместимость)"""
     system_prompt = "Проанализируй чат и оцени: сколько комплиментов сделал каждый собеседник и какой уровень вовлечённости у каждого (от 0 до 100). Ответ дай строго в формате JSON."
@@ -207,7 +322,8 @@ def update_summary(messages: List[Dict[str, Any]], historical_summary: Optional[
 
     try:
         # Используем llm вместо get_llm_response напрямую
-        from processor.llm_handler import llm
+        from processor.llm_handler import get_llm
+        llm = get_llm()
         
         # Получаем ответ от LLM
         response = llm.get_llm_response(prompt)
@@ -1,19 +1,31 @@
 import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import Dict, Any, List, Optional, Tuple
 from processor import llm_handler
-from services.db_service import db_service
-import concurrent.futures
-import math
+from services.db_service import db_service, UnitOfWork
+from config import (
+    METRICS_MODE,
+    SUMMARY_MODE, SUMMARY_TOKEN_BUDGET, SUMMARY_UPDATE_EVERY_N_BATCHES, SUMMARY_PENDING_TOKEN_BUDGET,
+    SUMMARY_PENDING_IDLE_SECONDS, SUMMARY_PENDING_MAX_DIALOGS,
+    CHUNK_TOKEN_BUDGET, PROMPT_OVERHEAD_TOKENS, CHUNK_CONCURRENCY
+)
+from utils.chunking import message_token_counts, split_by_token_budget, tail_by_token_budget
+from utils.messages import Message
 import time
 
 
-MAX_CHUNK_SIZE = 30
-
 class AnalysisService:
     def __init__(self):
-        self.metrics_cache = {}
+        # Сообщения, ещё не вошедшие в саммери (режим incremental): диалог -> (сообщения, батчей
+        # с прошлого обновления, время последнего батча); в начале — давно не обновлявшиеся диалоги,
+        # их саммери сохраняется досрочно
+        self.summary_pending: "OrderedDict[Tuple[str, int], Tuple[List[Message], int, float]]" = OrderedDict()
+        # Замки диалогов: [замок, число владельцев и ожидающих]
+        self._dialog_locks = {}
     
-    async def process_batch(self, session_id: str, telegram_user_id: int, interlocutor_id: int, messages: List[Dict[str, Any]]):
+    async def process_batch(self, session_id: str, telegram_user_id: int, interlocutor_id: int, messages: List[Message]):
         """
         Асинхронно обрабатывает новый батч сообщений, выполняя все необходимые задачи анализа
         
@@ -22,107 +34,70 @@ class AnalysisService:
             telegram_user_id: ID пользователя телеграм
             interlocutor_id: ID собеседника
             messages: Список сообщений для анализа
+            
+        Raises:
+            Exception: Если хотя бы один шаг анализа или сохранение не удались; ничего из батча
+                в этом случае не сохранено, и его можно обработать заново
         """
+        # Досрочное сохранение саммери диалога не должно вклиниться между чтением его очереди и коммитом батча
+        async with self._dialog_lock((session_id, interlocutor_id)):
+            await self._process_batch(session_id, telegram_user_id, interlocutor_id, messages)
+
+    async def _process_batch(self, session_id: str, telegram_user_id: int, interlocutor_id: int, messages: List[Message]):
         try:
             print(f"📝 Начинаем обработку батча сессии {session_id}, чата {interlocutor_id}, размер батча: {len(messages)}")
+            # Все записи батча сохраняются вместе в конце обработки
+            uow = db_service.unit_of_work()
             
 
-            if len(messages) > MAX_CHUNK_SIZE:
-                chunks = self._split_messages_into_chunks(messages, MAX_CHUNK_SIZE)
-                print(f"🔄 Большой батч разбит на {len(chunks)} частей по ~{MAX_CHUNK_SIZE} сообщений")
-                
+            historical_summary = await db_service.get_historical_summary(session_id, interlocutor_id)
+            print(f"📚 Получено историческое саммери, длина: {len(historical_summary) if historical_summary else 0} символов")
 
-                compliments_results = {}
-                engagement_results = {}
-                attachment_results = {}
-                
+            token_counts = message_token_counts(messages, llm_handler.count_tokens)
+            chunk_budget = self._chunk_token_budget(historical_summary)
+            chunks = split_by_token_budget(messages, token_counts, chunk_budget)
 
-                historical_summary = await db_service.get_historical_summary(session_id, interlocutor_id)
-                print(f"📚 Получено историческое саммери, длина: {len(historical_summary) if historical_summary else 0} символов")
+            if len(chunks) > 1:
+                print(f"🔄 Большой батч ({sum(token_counts)} токенов) разбит на {len(chunks)} частей до {chunk_budget} токенов")
                 
 
-                for i, chunk in enumerate(chunks):
-                    print(f"🧩 Обрабатываем часть {i+1}/{len(chunks)}, размер: {len(chunk)} сообщений")
-                    
-
-                    if i % 3 == 0 and i > 0:
-                        pass
-                    
-
-                    try:
-
-                        if i > 0:
-                            delay = 2.0
-                            print(f"⏱️ Ждем {delay} секунд перед обработкой следующего чанка...")
-                            await asyncio.sleep(delay)
-                        
-                        compliments, engagement, attachment = await self._get_metrics_for_chunk(chunk, historical_summary)
-                        
-
-                        if compliments:
-                            for sender, count in compliments.items():
-                                if sender in compliments_results:
-                                    compliments_results[sender] += count
-                                else:
-                                    compliments_results[sender] = count
-                        
-                        if engagement:
-                            for sender, score in engagement.items():
-                                if sender in engagement_results:
-
-                                    engagement_results[sender] = (engagement_results[sender] + score) / 2
-                                else:
-                                    engagement_results[sender] = score
-                        
-                        if attachment:
-                            for sender, data in attachment.items():
-                                if sender not in attachment_results:
-                                    attachment_results[sender] = data
-                                elif data.get("confidence", 0) > attachment_results[sender].get("confidence", 0):
-
-                                    attachment_results[sender] = data
-                                    
-                        print(f"✅ Часть {i+1} успешно обработана")
-                    except Exception as e:
-                        print(f"❌ Ошибка при обработке части {i+1}: {e}")
-                        import traceback
-                        print(f"Стек ошибки:\n{traceback.format_exc()}")
+                await self._analyze_metrics_chunked(
+                    session_id, telegram_user_id, interlocutor_id, messages, chunks, historical_summary, uow
+                )
                 
 
                 print(f"🔄 Генерируем рекомендации на основе всего батча")
-                await self._generate_user_recommendations(session_id, telegram_user_id, interlocutor_id, messages, historical_summary or "")
+                await self._generate_user_recommendations(session_id, telegram_user_id, interlocutor_id, messages, historical_summary or "", uow)
                 
 
 
-                last_chunk_size = min(MAX_CHUNK_SIZE, len(messages))
-                last_messages = messages[-last_chunk_size:]
+                # Инкрементальный режим сам укладывает весь батч в бюджет токенов
+                if SUMMARY_MODE == "incremental":
+                    last_messages = messages
+                else:
+                    last_messages = tail_by_token_budget(messages, token_counts, chunk_budget)
                 print(f"🔄 Обновляем саммери на основе последних {len(last_messages)} сообщений")
-                await self._update_summary(session_id, interlocutor_id, last_messages, historical_summary)
+                await self._update_summary(session_id, interlocutor_id, last_messages, historical_summary, uow)
                 
             else:
 
 
-                historical_summary = await db_service.get_historical_summary(session_id, interlocutor_id)
-                print(f"📚 Получено историческое саммери, длина: {len(historical_summary) if historical_summary else 0} символов")
-                
-
                 print(f"🔄 Анализируем метрики для батча из {len(messages)} сообщений")
                 
 
 
                 print(f"🔄 Анализируем метрики...")
-                await self._analyze_metrics(session_id, telegram_user_id, interlocutor_id, messages, historical_summary)
+                await self._analyze_metrics(session_id, telegram_user_id, interlocutor_id, messages, historical_summary, uow)
                 
                 print(f"🔄 Генерируем рекомендации для пользователя {telegram_user_id}")
-                await self._generate_user_recommendations(session_id, telegram_user_id, interlocutor_id, messages, historical_summary or "")
+                await self._generate_user_recommendations(session_id, telegram_user_id, interlocutor_id, messages, historical_summary or "", uow)
                 
 
                 print(f"🔄 Обновляем саммери диалога")
-                await self._update_summary(session_id, interlocutor_id, messages, historical_summary)
+                await self._update_summary(session_id, interlocutor_id, messages, historical_summary, uow)
             
 
-            print(f"🔄 Принудительно сохраняем метрики в БД")
-            await self.flush_metrics()
+            await self._commit_batch(uow)
             
             print(f"✅ Обработка батча сессии {session_id}, чата {interlocutor_id} завершена")
             
@@ -131,6 +106,33 @@ class AnalysisService:
 
             import traceback
             print(f"Стек ошибки:\n{traceback.format_exc()}")
+            raise
+    
+    @asynccontextmanager
+    async def _dialog_lock(self, key: Tuple[str, int]):
+        """Захватывает замок диалога; замок удаляется, когда он больше никому не нужен"""
+        entry = self._dialog_locks.get(key)
+        if entry is None:
+            entry = self._dialog_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._dialog_locks[key]
+    
+    async def _commit_batch(self, uow: UnitOfWork):
+        """
+        Сохраняет записи батча одной транзакцией. Ошибка пробрасывается: батч не сохранён
+        целиком и будет обработан заново, частичного сохранения (например, только метрик) нет
+        """
+        start_time = time.time()
+        await uow.commit()
+        if len(uow):
+            print(f"✅ Результаты батча сохранены в БД за {time.time() - start_time:.2f} сек: "
+                  f"саммери {len(uow.summaries)}, метрик {len(uow.metrics)}, рекомендаций {len(uow.recommendations)}")
     
     async def _check_network_connection(self):
         """Проверяет сетевое соединение"""
@@ -142,301 +144,505 @@ class AnalysisService:
             import traceback
             print(f"Стек ошибки проверки сети:\n{traceback.format_exc()}")
     
-    def _split_messages_into_chunks(self, messages: List[Dict[str, Any]], chunk_size: int) -> List[List[Dict[str, Any]]]:
+    def _chunk_token_budget(self, historical_summary: Optional[str]) -> int:
         """
-        Разбивает большой список сообщений на более мелкие части
+        Определяет, сколько токенов сообщений помещается в один запрос метрик
         
         Args:
-            messages: Список сообщений для разбиения
-            chunk_size: Максимальный размер одной части
+            historical_summary: Историческое саммери, которое тоже попадает в промпт
             
         Returns:
-            Список частей с сообщениями
+            Бюджет токенов на сообщения одной части
         """
-        total_chunks = math.ceil(len(messages) / chunk_size)
-        return [messages[i*chunk_size:(i+1)*chunk_size] for i in range(total_chunks)]
+        budget = CHUNK_TOKEN_BUDGET - PROMPT_OVERHEAD_TOKENS - llm_handler.count_tokens(historical_summary or "")
+        # Даже при очень длинном саммери часть не должна вырождаться в одно сообщение
+        return max(budget, CHUNK_TOKEN_BUDGET // 4)
     
-    async def _get_metrics_for_chunk(self, messages: List[Dict[str, Any]], historical_summary: Optional[str]):
+    async def _get_metrics_for_chunk(self, messages: List[Message], historical_summary: Optional[str],
+                                     previous_engagement: Optional[dict] = None,
+                                     previous_attachments: Optional[dict] = None):
         """
         Получает метрики для части сообщений
         
         Args:
             messages: Список сообщений для анализа
             historical_summary: Историческое саммери
+            previous_engagement: Предыдущие значения вовлеченности
+            previous_attachments: Предыдущие прогнозы привязанности
             
         Returns:
             Tuple из (compliments, engagement, attachment)
         """
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
-
-            start_time = time.time()
-            
-
-            current_loop = asyncio.get_running_loop()
-            
-            print(f"🔄 Запрашиваем комплименты для {len(messages)} сообщений")
-            compliments_future = current_loop.run_in_executor(
-                pool, 
-                lambda: llm_handler.count_compliments(messages)
-            )
-            
-            print(f"🔄 Запрашиваем уровень вовлеченности для {len(messages)} сообщений")
-            engagement_future = current_loop.run_in_executor(
-                pool, 
-                lambda: llm_handler.calculate_engagement(messages, historical_summary or "", max_retries=3)
-            )
+        start_time = time.time()
+        
+        compliments, engagement, attachment = await self._request_metrics(
+            messages, historical_summary, previous_engagement, previous_attachments
+        )
+        
+        elapsed_time = time.time() - start_time
+        print(f"⏱️ Получение метрик заняло {elapsed_time:.2f} секунд")
+        
+        return compliments, engagement, attachment
+    
+    async def _request_metrics(self, messages: List[Message], historical_summary: Optional[str],
+                               previous_engagement: Optional[dict] = None,
+                               previous_attachments: Optional[dict] = None) -> Tuple[Dict, Dict, Dict]:
+        """
+        Запрашивает комплименты, вовлеченность и привязанность в режиме METRICS_MODE
+        
+        Args:
+            messages: Список сообщений для анализа
+            historical_summary: Историческое саммери
+            previous_engagement: Предыдущие значения вовлечённости
+            previous_attachments: Предыдущие прогнозы привязанности
             
-            print(f"🔄 Запрашиваем тип привязанности для {len(messages)} сообщений")
-            attachment_future = current_loop.run_in_executor(
-                pool, 
-                lambda: llm_handler.calculate_attachment(messages, historical_summary or "", max_retries=3)
+        Returns:
+            Tuple из (compliments, engagement, attachment)
+        """
+        if METRICS_MODE == "combined":
+            print(f"🔄 Запрашиваем все метрики одним запросом для {len(messages)} сообщений")
+            metrics = await llm_handler.calculate_all_metrics_async(
+                messages, historical_summary or "", previous_engagement, previous_attachments, max_retries=3
             )
-            
-
+            metrics = metrics or {}
+            compliments = metrics.get("compliments")
+            engagement = metrics.get("engagement")
+            attachment = metrics.get("attachment")
+        else:
+            print(f"🔄 Запрашиваем комплименты, вовлеченность и привязанность для {len(messages)} сообщений")
             compliments, engagement, attachment = await asyncio.gather(
-                compliments_future, engagement_future, attachment_future
+                llm_handler.count_compliments_async(messages),
+                llm_handler.calculate_engagement_async(messages, historical_summary or "", previous_engagement, max_retries=3),
+                llm_handler.calculate_attachment_async(messages, historical_summary or "", previous_attachments, max_retries=3)
             )
-            
-
-            compliments = compliments or {}
-            engagement = engagement or {}
-            attachment = attachment or {}
-            
-            elapsed_time = time.time() - start_time
-            print(f"⏱️ Получение метрик заняло {elapsed_time:.2f} секунд")
-            
-            return compliments, engagement, attachment
+        
+        return compliments or {}, engagement or {}, attachment or {}
     
-    async def _update_summary(self, session_id: str, interlocutor_id: int, messages: List[Dict[str, Any]], historical_summary: Optional[str]) -> str:
-        """Асинхронно обновляет и сохраняет историческое саммери"""
-        try:
+    async def _update_summary(self, session_id: str, interlocutor_id: int, messages: List[Message],
+                              historical_summary: Optional[str], uow: UnitOfWork) -> str:
+        """Асинхронно обновляет историческое саммери и добавляет его к записям батча"""
+        if SUMMARY_MODE == "incremental":
+            return await self._update_summary_incremental(session_id, interlocutor_id, messages, historical_summary, uow)
+
+        print(f"🔄 Обновляем саммери на основе {len(messages)} сообщений")
+        new_summary = await llm_handler.update_summary_async(messages, historical_summary)
+        if not new_summary:
+            raise RuntimeError("модель вернула пустое саммери")
+        
+        uow.add_summary(session_id, interlocutor_id, new_summary, llm_handler.count_tokens(new_summary))
+        print(f"✅ Саммери для сессии {session_id}, чата {interlocutor_id} обновлено")
+        return new_summary
 
-            current_loop = asyncio.get_running_loop()
-            
-            print(f"🔄 Обновляем саммери на основе {len(messages)} сообщений")
-            new_summary = await current_loop.run_in_executor(
-                None,
-                lambda: llm_handler.update_summary(messages, historical_summary)
-            )
-            
-            if new_summary:
-                await db_service.save_historical_summary(session_id, interlocutor_id, new_summary)
-                print(f"✅ Саммери для сессии {session_id}, чата {interlocutor_id} обновлено")
-                return new_summary
-        except Exception as e:
-            print(f"❌ Ошибка при обновлении саммери: {e}")
-            import traceback
-            print(f"Стек ошибки саммери:\n{traceback.format_exc()}")
-        return historical_summary or ""
-    
-    async def _analyze_metrics(self, session_id: str, telegram_user_id: int, interlocutor_id: int, 
-                         messages: List[Dict[str, Any]], historical_summary: Optional[str]):
-        """Асинхронно анализирует и сохраняет метрики диалога"""
-        try:
+    async def _update_summary_incremental(self, session_id: str, interlocutor_id: int,
+                                          messages: List[Message], historical_summary: Optional[str], uow: UnitOfWork) -> str:
+        """
+        Обновляет саммери раз в SUMMARY_UPDATE_EVERY_N_BATCHES батчей или раньше, если накопленные
+        сообщения превысили SUMMARY_PENDING_TOKEN_BUDGET. Размер самого саммери в этом условии
+        не участвует: иначе саммери, дошедшее до SUMMARY_TOKEN_BUDGET, обновлялось бы на каждом батче.
+        Накопленные сообщения сворачиваются в саммери частями по бюджету, а разросшееся
+        саммери сжимается, поэтому размер промпта не растёт с длиной диалога.
 
-            user_messages = [m for m in messages if str(m['SenderId']) == str(telegram_user_id)]
-            interlocutor_messages = [m for m in messages if str(m['SenderId']) == str(interlocutor_id)]
-            
-            print(f"📊 Статистика сообщений:")
-            print(f"  - От пользователя {telegram_user_id}: {len(user_messages)} сообщений")
-            print(f"  - От собеседника {interlocutor_id}: {len(interlocutor_messages)} сообщений")
-            
+        Args:
+            session_id: ID сессии
+            interlocutor_id: ID собеседника
+            messages: Новые сообщения батча
+            historical_summary: Текущее саммери
+            uow: Записи батча; очередь сообщений меняется только после их сохранения,
+                поэтому повторная обработка батча не добавит его сообщения дважды
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+        Returns:
+            Актуальное саммери
+        """
+        key = (session_id, interlocutor_id)
+        pending, batches, _ = self.summary_pending.get(key, ([], 0, 0.0))
+        pending = pending + list(messages)
+        batches += 1
+
+        summary = historical_summary or ""
+        summary_tokens = llm_handler.count_tokens(summary)
+        message_tokens = message_token_counts(pending, llm_handler.count_tokens)
+        pending_tokens = sum(message_tokens)
+
+        if batches < SUMMARY_UPDATE_EVERY_N_BATCHES and pending_tokens <= SUMMARY_PENDING_TOKEN_BUDGET:
+            def batch_deferred():
+                self.summary_pending[key] = (pending, batches, time.monotonic())
+                self.summary_pending.move_to_end(key)
+            uow.after_commit(batch_deferred)
+            print(f"⏭️ Саммери отложено: батч {batches}/{SUMMARY_UPDATE_EVERY_N_BATCHES}, "
+                  f"{pending_tokens}/{SUMMARY_PENDING_TOKEN_BUDGET} токенов новых сообщений")
+            return summary
+
+        print(f"🔄 Инкрементально обновляем саммери: {len(pending)} сообщений, {pending_tokens} токенов, "
+              f"саммери {summary_tokens} токенов")
+        return await self._fold_summary(session_id, interlocutor_id, pending, message_tokens, summary, uow)
+
+    async def _fold_summary(self, session_id: str, interlocutor_id: int, pending: List[Message],
+                            message_tokens: List[int], summary: str, uow: UnitOfWork) -> str:
+        """
+        Сворачивает накопленные сообщения в саммери и добавляет его к записям; очередь диалога
+        очищается после сохранения записей
 
-                current_loop = asyncio.get_running_loop()
-                
-                print(f"🔄 Запрашиваем комплименты для {len(messages)} сообщений")
-                compliments_future = current_loop.run_in_executor(
-                    pool, 
-                    lambda: llm_handler.count_compliments(messages)
-                )
-                
-                print(f"🔄 Запрашиваем уровень вовлеченности для {len(messages)} сообщений")
-                engagement_future = current_loop.run_in_executor(
-                    pool, 
-                    lambda: llm_handler.calculate_engagement(messages, historical_summary or "", max_retries=3)
-                )
-                
-                print(f"🔄 Запрашиваем тип привязанности для {len(messages)} сообщений")
-                attachment_future = current_loop.run_in_executor(
-                    pool, 
-                    lambda: llm_handler.calculate_attachment(messages, historical_summary or "", max_retries=3)
-                )
-                
+        Args:
+            session_id: ID сессии
+            interlocutor_id: ID собеседника
+            pending: Накопленные сообщения
+            message_tokens: Токены каждого из них
+            summary: Текущее саммери
+            uow: Записи, с которыми сохраняется саммери
 
-                compliments, engagement, attachment = await asyncio.gather(
-                    compliments_future, engagement_future, attachment_future
-                )
-            
+        Returns:
+            Новое саммери
+        """
+        key = (session_id, interlocutor_id)
+        summary_tokens = llm_handler.count_tokens(summary)
+        # Каждая часть укладывается в бюджет, саммери сворачивается по частям
+        parts = split_by_token_budget(pending, message_tokens, SUMMARY_TOKEN_BUDGET)
+
+        for part in parts:
+            new_summary = await llm_handler.update_summary_async(part, summary or None)
+            if not new_summary:
+                raise RuntimeError("модель вернула пустое саммери")
+            summary = new_summary
+            summary_tokens = llm_handler.count_tokens(summary)
+            if summary_tokens > SUMMARY_TOKEN_BUDGET:
+                compacted = await llm_handler.compact_summary_async(summary, SUMMARY_TOKEN_BUDGET)
+                if compacted:
+                    print(f"🗜️ Саммери сжато: {summary_tokens} → {llm_handler.count_tokens(compacted)} токенов")
+                    summary = compacted
+                    summary_tokens = llm_handler.count_tokens(summary)
+
+        uow.add_summary(session_id, interlocutor_id, summary, summary_tokens)
+
+        def summary_saved():
+            self.summary_pending.pop(key, None)
+        uow.after_commit(summary_saved)
+        print(f"✅ Саммери для сессии {session_id}, чата {interlocutor_id} обновлено, {summary_tokens} токенов")
+        return summary
+    
+    async def _analyze_metrics(self, session_id: str, telegram_user_id: int, interlocutor_id: int, 
+                         messages: List[Message], historical_summary: Optional[str], uow: UnitOfWork):
+        """Асинхронно анализирует метрики диалога и добавляет их к записям батча"""
+        user_messages = [m for m in messages if str(m['SenderId']) == str(telegram_user_id)]
+        interlocutor_messages = [m for m in messages if str(m['SenderId']) == str(interlocutor_id)]
+        
+        print(f"📊 Статистика сообщений:")
+        print(f"  - От пользователя {telegram_user_id}: {len(user_messages)} сообщений")
+        print(f"  - От собеседника {interlocutor_id}: {len(interlocutor_messages)} сообщений")
+        
 
-            compliments = compliments or {}
-            engagement = engagement or {}
-            attachment = attachment or {}
+        # Предыдущие метрики нужны до запросов к LLM, чтобы вовлеченность
+        # посчитать один раз и сразу с учетом истории
+        previous_by_role = await self._load_previous_metrics(session_id, interlocutor_id)
+        previous_engagement, previous_attachments = self._build_previous_context(
+            previous_by_role, telegram_user_id, interlocutor_id
+        )
+        
+        compliments, engagement, attachment = await self._request_metrics(
+            messages, historical_summary, previous_engagement, previous_attachments
+        )
+        
+        self._store_metrics(
+            session_id, telegram_user_id, interlocutor_id, messages,
+            previous_by_role, compliments, engagement, attachment, uow
+        )
+    
+    async def _analyze_metrics_chunked(self, session_id: str, telegram_user_id: int, interlocutor_id: int,
+                                       messages: List[Message], chunks: List[List[Message]],
+                                       historical_summary: Optional[str], uow: UnitOfWork):
+        """
+        Анализирует метрики большого батча: части отправляются параллельно (не больше CHUNK_CONCURRENCY
+        одновременно), результаты объединяются в порядке частей и сохраняются одной записью на участника
+        
+        Args:
+            session_id: ID сессии
+            telegram_user_id: ID пользователя телеграм
+            interlocutor_id: ID собеседника
+            messages: Все сообщения батча
+            chunks: Части батча в исходном порядке
+            historical_summary: Историческое саммери
+            uow: Записи батча
             
-            if not compliments and not engagement and not attachment:
-                print("⚠️ Не удалось получить ни одной метрики")
-                return
+        Raises:
+            Exception: Если не удалась хотя бы одна часть: метрики по неполному батчу не сохраняются
+        """
+        previous_by_role = await self._load_previous_metrics(session_id, interlocutor_id)
+        previous_engagement, previous_attachments = self._build_previous_context(
+            previous_by_role, telegram_user_id, interlocutor_id
+        )
+        semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+        
+        async def process_chunk(index: int, chunk: List[Message]):
+            async with semaphore:
+                print(f"🧩 Обрабатываем часть {index+1}/{len(chunks)}, размер: {len(chunk)} сообщений")
+                try:
+                    result = await self._get_metrics_for_chunk(
+                        chunk, historical_summary, previous_engagement, previous_attachments
+                    )
+                except Exception as e:
+                    print(f"❌ Ошибка при обработке части {index+1}: {e}")
+                    raise
+                print(f"✅ Часть {index+1} успешно обработана")
+                return result
+        
+        results = await asyncio.gather(*(process_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+        compliments, engagement, attachment = self._merge_chunk_metrics(chunks, results)
+        
+        self._store_metrics(
+            session_id, telegram_user_id, interlocutor_id, messages,
+            previous_by_role, compliments, engagement, attachment, uow
+        )
+    
+    def _merge_chunk_metrics(self, chunks: List[List[Message]], results: List[Optional[Tuple[dict, dict, dict]]]):
+        """
+        Детерминированно объединяет метрики частей батча
+        
+        Комплименты суммируются. Вовлеченность — среднее по частям, взвешенное числом сообщений
+        участника в части. Тип привязанности выбирается голосованием с весом
+        (уверенность × число сообщений), уверенность — взвешенное среднее по частям с этим типом.
+        При равенстве побеждает более поздняя часть.
+        
+        Args:
+            chunks: Части батча в исходном порядке
+            results: Результаты частей в том же порядке (None для неудачных)
             
-
-            print(f"📊 Получены метрики: комплименты={compliments}, вовлеченность={engagement}")
+        Returns:
+            Tuple из (compliments, engagement, attachment)
+        """
+        compliments = {}
+        engagement_sums = {}
+        attachment_votes = {}
+        
+        for index, (chunk, result) in enumerate(zip(chunks, results)):
+            if not result:
+                continue
+            chunk_compliments, chunk_engagement, chunk_attachment = result
+            message_counts = {}
+            for message in chunk:
+                sender = str(message['SenderId'])
+                message_counts[sender] = message_counts.get(sender, 0) + 1
             
-
-            previous_engagement = {}
-            for sender_id in [telegram_user_id, interlocutor_id]:
-                role = "user" if str(sender_id) == str(telegram_user_id) else "interlocutor"
-                prev_metrics = await db_service.get_latest_metrics(session_id, interlocutor_id, role)
-                if prev_metrics:
-                    previous_engagement[str(sender_id)] = prev_metrics.get("engagement_score", 0)
-
-
-            engagement = llm_handler.calculate_engagement(messages, historical_summary, previous_engagement, max_retries=3) or {}
+            for sender, count in chunk_compliments.items():
+                compliments[sender] = compliments.get(sender, 0) + count
             
+            for sender, score in chunk_engagement.items():
+                weight = message_counts.get(sender, 0)
+                total, weights, plain_total, parts = engagement_sums.get(sender, (0.0, 0, 0.0, 0))
+                engagement_sums[sender] = (total + score * weight, weights + weight, plain_total + score, parts + 1)
+            
+            for sender, data in chunk_attachment.items():
+                if not isinstance(data, dict) or not data.get("type"):
+                    continue
+                weight = max(message_counts.get(sender, 0), 1)
+                confidence = data.get("confidence") or 0
+                votes = attachment_votes.setdefault(sender, {})
+                score, weights, _ = votes.get(data["type"], (0.0, 0, index))
+                votes[data["type"]] = (score + confidence * weight, weights + weight, index)
+        
+        engagement = {}
+        for sender, (total, weights, plain_total, parts) in engagement_sums.items():
+            # Если у участника нет сообщений ни в одной части, берем обычное среднее
+            engagement[sender] = total / weights if weights else plain_total / parts
+        
+        attachment = {}
+        for sender, votes in attachment_votes.items():
+            att_type, (score, weights, _) = max(votes.items(), key=lambda item: (item[1][0], item[1][2]))
+            attachment[sender] = {"type": att_type, "confidence": score / weights}
+        
+        return compliments, engagement, attachment
+    
+    def _store_metrics(self, session_id: str, telegram_user_id: int, interlocutor_id: int,
+                       messages: List[Message], previous_by_role: Dict[str, Optional[Dict[str, Any]]],
+                       compliments: Dict[str, Any], engagement: Dict[str, Any], attachment: Dict[str, Any], uow: UnitOfWork):
+        """Добавляет к записям батча метрики каждого участника"""
+        user_messages = [m for m in messages if str(m['SenderId']) == str(telegram_user_id)]
+        interlocutor_messages = [m for m in messages if str(m['SenderId']) == str(interlocutor_id)]
+        
+        if not compliments and not engagement and not attachment:
+            raise RuntimeError("не удалось получить ни одной метрики")
+        
 
-            previous_attachments = {}
-            for sender_id in [telegram_user_id, interlocutor_id]:
-                role = "user" if str(sender_id) == str(telegram_user_id) else "interlocutor"
-                prev_metrics = await db_service.get_latest_metrics(session_id, interlocutor_id, role)
-                if prev_metrics:
-                    previous_attachments[str(sender_id)] = {
-                        "type": prev_metrics.get("attachment_type", "неизвестно"),
-                        "confidence": prev_metrics.get("attachment_confidence", 0) * 100
-                    }
-
+        print(f"📊 Получены метрики: комплименты={compliments}, вовлеченность={engagement}")
+        # Время расчёта: более раннее значение не перезапишет в chat_metrics_latest более позднее
+        computed_at = datetime.now(timezone.utc)
+        
 
-            for sender_id in set(list(compliments.keys()) + list(engagement.keys()) + list(attachment.keys())):
+        for sender_id in set(list(compliments.keys()) + list(engagement.keys()) + list(attachment.keys())):
 
-                role = "user" if str(sender_id) == str(telegram_user_id) else "interlocutor"
-                
+            role = "user" if str(sender_id) == str(telegram_user_id) else "interlocutor"
+            
 
-                participant_messages = user_messages if role == "user" else interlocutor_messages
-                if not participant_messages:
-                    print(f"⚠️ Пропускаем сохранение метрик для {role} ({sender_id}): нет сообщений")
-                    continue
-                
+            participant_messages = user_messages if role == "user" else interlocutor_messages
+            if not participant_messages:
+                print(f"⚠️ Пропускаем сохранение метрик для {role} ({sender_id}): нет сообщений")
+                continue
+            
 
-                previous_metrics = await db_service.get_latest_metrics(session_id, interlocutor_id, role)
-                previous_total = previous_metrics.get('total_compliments', 0) if previous_metrics else 0
-                
+            previous_metrics = previous_by_role.get(role)
+            previous_total = previous_metrics.get('total_compliments', 0) if previous_metrics else 0
+            
 
-                compliment_count = compliments.get(str(sender_id), 0)
-                
+            compliment_count = compliments.get(str(sender_id), 0)
+            
 
-                compliments_delta = compliment_count
-                new_total = previous_total + compliments_delta
-                
-                print(f"Комплименты для {role} ({sender_id}):")
-                print(f"  - Найдено в текущем батче: {compliment_count}")
-                print(f"  - Предыдущее total_compliments: {previous_total}")
-                print(f"  - Сохраняем delta: {compliments_delta}")
-                print(f"  - Новое total: {new_total}")
-                
+            compliments_delta = compliment_count
+            new_total = previous_total + compliments_delta
+            
+            print(f"Комплименты для {role} ({sender_id}):")
+            print(f"  - Найдено в текущем батче: {compliment_count}")
+            print(f"  - Предыдущее total_compliments: {previous_total}")
+            print(f"  - Сохраняем delta: {compliments_delta}")
+            print(f"  - Новое total: {new_total}")
+            
 
-                att = attachment.get(str(sender_id), {})
-                att_type = att.get("type") or "unknown"
-                att_conf = att.get("confidence") or 0
-                if att_type in [None, "", "неизвестно"]:
-                    att_type = "unknown"
-                
+            att = attachment.get(str(sender_id), {})
+            att_type = att.get("type") or "unknown"
+            att_conf = att.get("confidence") or 0
+            if att_type in [None, "", "неизвестно"]:
+                att_type = "unknown"
+            
 
-                cache_key = f"{session_id}:{interlocutor_id}:{role}"
-                self.metrics_cache[cache_key] = {
-                    "session_id": session_id,
-                    "telegram_user_id": telegram_user_id,
-                    "interlocutor_id": interlocutor_id,
-                    "role": role,
-                    "compliments_delta": compliments_delta,
-                    "total_compliments": new_total,
-                    "engagement_score": engagement.get(str(sender_id), 0),
-                    "attachment_type": att_type if att_type != "unknown" else "",
-                    "attachment_confidence": att_conf / 100
-                }
-                print(f"✅ Метрики для {role} ({sender_id}) добавлены в кэш")
+            uow.add_metrics({
+                "session_id": session_id,
+                "telegram_user_id": telegram_user_id,
+                "interlocutor_id": interlocutor_id,
+                "role": role,
+                "compliments_delta": compliments_delta,
+                "total_compliments": new_total,
+                "engagement_score": engagement.get(str(sender_id), 0),
+                "attachment_type": att_type if att_type != "unknown" else "",
+                "attachment_confidence": att_conf / 100,
+                "computed_at": computed_at
+            })
+            print(f"✅ Метрики для {role} ({sender_id}) добавлены к записям батча")
+    
+    async def _load_previous_metrics(self, session_id: str, interlocutor_id: int) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Загружает последние сохраненные метрики обоих участников диалога
         
-        except Exception as e:
-            print(f"❌ Ошибка при анализе метрик: {e}")
-            import traceback
-            print(f"Стек ошибки метрик:\n{traceback.format_exc()}")
+        Args:
+            session_id: ID сессии
+            interlocutor_id: ID собеседника
+            
+        Returns:
+            Dict {role: метрики или None}
+        """
+        roles = ("user", "interlocutor")
+        results = await asyncio.gather(
+            *(db_service.get_latest_metrics(session_id, interlocutor_id, role) for role in roles)
+        )
+        return dict(zip(roles, results))
+    
+    def _build_previous_context(self, previous_by_role: Dict[str, Optional[Dict[str, Any]]],
+                                telegram_user_id: int, interlocutor_id: int) -> Tuple[Dict, Dict]:
+        """
+        Готовит предыдущие значения вовлеченности и привязанности для промптов
+        
+        Args:
+            previous_by_role: Последние метрики по ролям
+            telegram_user_id: ID пользователя телеграм
+            interlocutor_id: ID собеседника
+            
+        Returns:
+            Tuple из (previous_engagement, previous_attachments)
+        """
+        previous_engagement = {}
+        previous_attachments = {}
+        for sender_id, role in ((telegram_user_id, "user"), (interlocutor_id, "interlocutor")):
+            prev_metrics = previous_by_role.get(role)
+            if prev_metrics:
+                previous_engagement[str(sender_id)] = prev_metrics.get("engagement_score", 0)
+                previous_attachments[str(sender_id)] = {
+                    "type": prev_metrics.get("attachment_type", "неизвестно"),
+                    "confidence": prev_metrics.get("attachment_confidence", 0) * 100
+                }
+        return previous_engagement, previous_attachments
     
     async def _generate_user_recommendations(self, session_id: str, telegram_user_id: int, 
-                                     interlocutor_id: int, messages: List[Dict[str, Any]], 
-                                     historical_summary: str):
-        """Асинхронно генерирует рекомендации для пользователя"""
-        try:
-
-            current_loop = asyncio.get_running_loop()
+                                     interlocutor_id: int, messages: List[Message], 
+                                     historical_summary: str, uow: UnitOfWork):
+        """Асинхронно генерирует рекомендации для пользователя и добавляет их к записям батча"""
+        token_counts = message_token_counts(messages, llm_handler.count_tokens)
+        messages_for_recommendations = tail_by_token_budget(
+            messages, token_counts, self._chunk_token_budget(historical_summary)
+        )
+        if len(messages_for_recommendations) < len(messages):
+            print(f"🔄 Используем только последние {len(messages_for_recommendations)} сообщений для генерации рекомендаций")
             
+        print(f"🔄 Генерируем рекомендации на основе {len(messages_for_recommendations)} сообщений")
+        recommendations = await llm_handler.generate_recommendations_async(
+            messages_for_recommendations, historical_summary, str(telegram_user_id)
+        )
+        if not recommendations:
+            raise RuntimeError(f"не удалось сгенерировать рекомендации для пользователя {telegram_user_id}")
+
+        uow.add_recommendation(session_id, telegram_user_id, interlocutor_id, recommendations)
+        print(f"✅ Рекомендации для пользователя {telegram_user_id} добавлены к записям батча")
+    
+    async def flush_summaries(self, keys: Optional[List[Tuple[str, int]]] = None) -> int:
+        """
+        Досрочно сворачивает и сохраняет отложенные саммери (режим incremental). Вызывается,
+        когда накопленные в памяти сообщения иначе пропали бы: при отзыве партиций диалога,
+        при остановке сервиса и для давно молчащих диалогов
 
-            if len(messages) > MAX_CHUNK_SIZE:
-                print(f"🔄 Используем только последние {MAX_CHUNK_SIZE} сообщений для генерации рекомендаций")
-                messages_for_recommendations = messages[-MAX_CHUNK_SIZE:]
-            else:
-                messages_for_recommendations = messages
-                
-            print(f"🔄 Генерируем рекомендации на основе {len(messages_for_recommendations)} сообщений")
-            recommendations = await current_loop.run_in_executor(
-                None,
-                lambda: llm_handler.generate_recommendations(messages_for_recommendations, historical_summary, str(telegram_user_id))
-            )
-            
-            if recommendations:
-
-                print(f"🔄 Сохраняем рекомендации для пользователя {telegram_user_id} в БД")
-                save_result = await db_service.save_user_recommendation(
-                    session_id, 
-                    telegram_user_id, 
-                    interlocutor_id, 
-                    recommendations
-                )
-                if save_result:
-                    print(f"✅ Рекомендации для пользователя {telegram_user_id} успешно сохранены в БД")
-                else:
-                    print(f"⚠️ Не удалось сохранить рекомендации для пользователя {telegram_user_id} в БД")
-            else:
-                print(f"⚠️ Не удалось сгенерировать рекомендации для пользователя {telegram_user_id}")
-        except Exception as e:
-            print(f"❌ Ошибка при генерации рекомендаций: {e}")
-            import traceback
-            print(f"Стек ошибки рекомендаций:\n{traceback.format_exc()}")
+        Args:
+            keys: Диалоги (session_id, interlocutor_id); None — все с отложенным саммери
+
+        Returns:
+            Сколько саммери сохранено
+        """
+        keys = list(self.summary_pending) if keys is None else [key for key in keys if key in self.summary_pending]
+        if not keys:
+            return 0
+        print(f"🔄 Досрочно сохраняем отложенные саммери: {len(keys)} диалогов")
+        semaphore = asyncio.Semaphore(CHUNK_CONCURRENCY)
+
+        async def flush(key: Tuple[str, int]) -> bool:
+            async with semaphore:
+                return await self._flush_summary(key)
+
+        results = await asyncio.gather(*(flush(key) for key in keys))
+        return sum(results)
     
-    async def flush_metrics(self):
+    async def flush_idle_summaries(self) -> int:
         """
-        Асинхронно сохраняет накопленные метрики в базу данных
-        Этот метод можно вызывать периодически
+        Сохраняет отложенные саммери диалогов, в которых не было батчей дольше
+        SUMMARY_PENDING_IDLE_SECONDS, и самых давних сверх SUMMARY_PENDING_MAX_DIALOGS,
+        чтобы очередь в памяти не росла с числом диалогов
+
+        Returns:
+            Сколько саммери сохранено
         """
-        metrics_to_save = self.metrics_cache.copy()
-        print(f"🔄 Начинаем сохранение метрик в БД, количество метрик в кэше: {len(metrics_to_save)}")
-        self.metrics_cache.clear()
-        
-        for cache_key, metrics in metrics_to_save.items():
+        now = time.monotonic()
+        overflow = len(self.summary_pending) - SUMMARY_PENDING_MAX_DIALOGS
+        keys = []
+        for index, (key, (_, _, updated_at)) in enumerate(self.summary_pending.items()):
+            if index >= overflow and now - updated_at < SUMMARY_PENDING_IDLE_SECONDS:
+                break
+            keys.append(key)
+        return await self.flush_summaries(keys)
+    
+    async def _flush_summary(self, key: Tuple[str, int]) -> bool:
+        """Сворачивает очередь диалога в саммери и сохраняет его отдельной транзакцией"""
+        session_id, interlocutor_id = key
+        async with self._dialog_lock(key):
+            entry = self.summary_pending.get(key)
+            if entry is None:
+                return False
+            pending, batches, _ = entry
             try:
-                print(f"🔄 Сохраняем метрики для {cache_key}:")
-                print(f"  - session_id: {metrics['session_id']}")
-                print(f"  - role: {metrics['role']}")
-                print(f"  - compliments_delta: {metrics['compliments_delta']}")
-                print(f"  - total_compliments: {metrics['total_compliments']}")
-                print(f"  - engagement_score: {metrics['engagement_score']}")
-                print(f"  - attachment_type: {metrics['attachment_type']}")
-                print(f"  - attachment_confidence: {metrics['attachment_confidence']}")
-                
-                await db_service.save_chat_metrics(
-                    metrics["session_id"],
-                    metrics["telegram_user_id"],
-                    metrics["interlocutor_id"],
-                    metrics["role"],
-                    metrics["compliments_delta"],
-                    metrics["total_compliments"],
-                    metrics["engagement_score"],
-                    metrics["attachment_type"],
-                    metrics["attachment_confidence"]
-                )
-                print(f"✅ Метрики для {cache_key} сохранены в БД")
+                historical_summary = await db_service.get_historical_summary(session_id, interlocutor_id)
+                message_tokens = message_token_counts(pending, llm_handler.count_tokens)
+                uow = db_service.unit_of_work()
+                await self._fold_summary(session_id, interlocutor_id, pending, message_tokens, historical_summary or "", uow)
+                await uow.commit()
+                return True
             except Exception as e:
-                print(f"❌ Ошибка при сохранении метрик для {cache_key}: {e}")
-                import traceback
-                print(f"Стек ошибки:\n{traceback.format_exc()}")
-
-                self.metrics_cache[cache_key] = metrics
+                print(f"❌ Не удалось досрочно сохранить саммери сессии {session_id}, чата {interlocutor_id}: {e}")
+                # Следующая попытка — не раньше, чем через SUMMARY_PENDING_IDLE_SECONDS
+                if key in self.summary_pending:
+                    self.summary_pending[key] = (pending, batches, time.monotonic())
+                    self.summary_pending.move_to_end(key)
+                return False
 
 
 analysis_service = AnalysisService() 
\ No newline at end of file
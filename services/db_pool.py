@@ -0,0 +1,238 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Iterable, Optional
+
+import asyncpg
+
+# Верхние границы корзин гистограммы задержек, мс (последняя корзина — всё, что дольше)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами: дешёвая запись, перцентили с точностью до корзины"""
+
+    def __init__(self, buckets_ms: Iterable[float] = LATENCY_BUCKETS_MS):
+        """
+        Args:
+            buckets_ms: Возрастающие верхние границы корзин в миллисекундах
+        """
+        self.bounds = tuple(buckets_ms)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        """Записывает одно измерение в секундах"""
+        ms = seconds * 1000
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def quantile(self, q: float) -> float:
+        """
+        Возвращает верхнюю границу корзины, в которую попадает перцентиль
+
+        Args:
+            q: Доля от 0 до 1
+
+        Returns:
+            Граница в мс, не больше максимума измерений
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(float(self.bounds[index]), self.max_ms) if index < len(self.bounds) else self.max_ms
+        return self.max_ms
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает сводку: число измерений, среднее, p50/p95/p99 и максимум в мс"""
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 2)
+        }
+
+
+class AnalyzerConnection(asyncpg.Connection):
+    """Соединение пула с собственным набором подготовленных горячих запросов"""
+
+    __slots__ = ("prepared",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Имя запроса -> PreparedStatement; живёт столько же, сколько соединение
+        self.prepared = {}
+
+
+class DBPool:
+    """
+    Пул соединений asyncpg с настраиваемыми размерами и учётом нагрузки.
+
+    Считает ожидание соединения, время его удержания и задержки запросов по именам.
+    Горячие запросы, переданные в queries, готовятся (PREPARE) один раз на соединение
+    при первом использовании и дальше выполняются без разбора и планирования текста.
+    """
+
+    def __init__(self, queries: Dict[str, str], min_size: int = 2, max_size: int = 10,
+                 max_queries: int = 50000, max_inactive_connection_lifetime: float = 300.0,
+                 statement_cache_size: int = 100, acquire_timeout: Optional[float] = None,
+                 **connect_kwargs):
+        """
+        Args:
+            queries: Горячие запросы: имя -> текст SQL
+            min_size: Соединений, открываемых сразу
+            max_size: Максимум соединений
+            max_queries: После стольких запросов соединение пересоздается
+            max_inactive_connection_lifetime: Через сколько секунд простоя закрывать соединение (0 — никогда)
+            statement_cache_size: Размер кэша подготовленных запросов asyncpg на соединение;
+                0 отключает и подготовку горячих запросов (например, за pgbouncer в режиме transaction)
+            acquire_timeout: Сколько ждать свободного соединения (None — без ограничения)
+            **connect_kwargs: Параметры подключения asyncpg (host, port, database, user, password, timeout)
+        """
+        self.queries = queries
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_queries = max_queries
+        self.max_inactive_connection_lifetime = max_inactive_connection_lifetime
+        self.statement_cache_size = statement_cache_size
+        self.acquire_timeout = acquire_timeout
+        self.connect_kwargs = connect_kwargs
+        self.pool = None
+
+        self.acquired = 0
+        self.acquire_timeouts = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.prepares = 0
+        self.query_errors = 0
+        self.wait = LatencyHistogram()
+        self.hold = LatencyHistogram()
+        self.query_latency: Dict[str, LatencyHistogram] = {}
+
+    async def start(self):
+        """Создает пул asyncpg"""
+        self.pool = await asyncpg.create_pool(
+            min_size=self.min_size,
+            max_size=self.max_size,
+            max_queries=self.max_queries,
+            max_inactive_connection_lifetime=self.max_inactive_connection_lifetime,
+            statement_cache_size=self.statement_cache_size,
+            connection_class=AnalyzerConnection,
+            **self.connect_kwargs
+        )
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Берет соединение из пула, учитывая время ожидания и удержания"""
+        start = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            self.wait.observe(time.perf_counter() - start)
+            raise
+        acquired_at = time.perf_counter()
+        self.wait.observe(acquired_at - start)
+        self.acquired += 1
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            yield conn
+        finally:
+            self.in_use -= 1
+            self.hold.observe(time.perf_counter() - acquired_at)
+            await self.pool.release(conn)
+
+    async def fetchrow(self, conn, name: str, *args):
+        """Выполняет горячий запрос и возвращает первую строку"""
+        return await self._run(conn, name, "fetchrow", args)
+
+    async def fetchval(self, conn, name: str, *args):
+        """Выполняет горячий запрос и возвращает первое значение первой строки"""
+        return await self._run(conn, name, "fetchval", args)
+
+    async def execute(self, conn, name: str, *args):
+        """Выполняет горячий запрос без результата"""
+        await self._run(conn, name, "fetch", args)
+
+    async def executemany(self, conn, name: str, args: list):
+        """Выполняет горячий запрос для каждого набора аргументов одним конвейером"""
+        if args:
+            await self._run(conn, name, "executemany", (args,))
+
+    async def _run(self, conn, name: str, method: str, args: tuple):
+        start = time.perf_counter()
+        try:
+            try:
+                statement = await self._statement(conn, name)
+                return await self._call(conn, statement, name, method, args)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                # Схема таблицы поменялась после PREPARE: готовим запрос заново
+                # (внутри транзакции повторять нельзя — она уже прервана)
+                conn.prepared.pop(name, None)
+                if conn.is_in_transaction():
+                    raise
+                statement = await self._statement(conn, name)
+                return await self._call(conn, statement, name, method, args)
+        except Exception:
+            self.query_errors += 1
+            raise
+        finally:
+            histogram = self.query_latency.get(name)
+            if histogram is None:
+                histogram = self.query_latency[name] = LatencyHistogram()
+            histogram.observe(time.perf_counter() - start)
+
+    async def _call(self, conn, statement, name: str, method: str, args: tuple):
+        if statement is None:
+            # Подготовка отключена: запрос уходит текстом
+            if method == "fetch":
+                return await conn.execute(self.queries[name], *args)
+            return await getattr(conn, method)(self.queries[name], *args)
+        return await getattr(statement, method)(*args)
+
+    async def _statement(self, conn, name: str):
+        if not self.statement_cache_size:
+            return None
+        statement = conn.prepared.get(name)
+        if statement is None:
+            statement = await conn.prepare(self.queries[name])
+            conn.prepared[name] = statement
+            self.prepares += 1
+        return statement
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает показатели пула для мониторинга"""
+        pool = self.pool
+        return {
+            "size": pool.get_size() if pool is not None else 0,
+            "idle": pool.get_idle_size() if pool is not None else 0,
+            "max_size": self.max_size,
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "acquired": self.acquired,
+            "acquire_timeouts": self.acquire_timeouts,
+            "prepares": self.prepares,
+            "query_errors": self.query_errors,
+            "wait": self.wait.stats(),
+            "hold": self.hold.stats(),
+            "queries": {name: histogram.stats() for name, histogram in sorted(self.query_latency.items())}
+        }
@@ -1,22 +1,177 @@
 import asyncpg
 import time
 import asyncio
-from typing import Dict, Any, Optional, List, Tuple
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, List, Tuple, Callable
+from config import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS, STATE_CACHE_SIZE, STATE_CACHE_TTL_SECONDS,
+    STATE_CACHE_NEGATIVE_TTL_SECONDS,
+    DB_MIGRATE_ON_START, DB_HISTORY_PARTITION_MONTHS_AHEAD,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_MAX_QUERIES, DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS,
+    DB_POOL_STATEMENT_CACHE_SIZE, DB_POOL_ACQUIRE_TIMEOUT_SECONDS
+)
+from services.db_pool import DBPool
+from services.state_cache import LatestStateCache
+from services.schema import ensure_schema, UPSERT_CHAT_METRICS_LATEST, SAVE_HISTORICAL_SUMMARY
+
+
+INSERT_CHAT_METRICS_HISTORY = """
+    INSERT INTO chat_metrics_history (
+        session_id, 
+        telegram_user_id, 
+        interlocutor_id, 
+        role,
+        compliments_delta, 
+        total_compliments, 
+        engagement_score,
+        attachment_type,
+        attachment_confidence
+    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+"""
+
+INSERT_USER_RECOMMENDATION = """
+    INSERT INTO telegram_user_recommendations
+    (session_id, telegram_user_id, interlocutor_id, recommendation_text)
+    VALUES ($1, $2, $3, $4)
+"""
+
+SELECT_HISTORICAL_SUMMARY = """
+    SELECT summary 
+    FROM historical_summary_latest 
+    WHERE session_id = $1 AND interlocutor_id = $2
+"""
+
+SELECT_LATEST_METRICS = """
+    SELECT 
+        total_compliments, 
+        engagement_score,
+        attachment_type,
+        attachment_confidence
+    FROM chat_metrics_latest 
+    WHERE session_id = $1 AND interlocutor_id = $2 AND role = $3
+"""
+
+# Запросы каждого батча: готовятся один раз на соединение пула
+HOT_QUERIES = {
+    "select_summary": SELECT_HISTORICAL_SUMMARY,
+    "select_metrics": SELECT_LATEST_METRICS,
+    "save_summary": SAVE_HISTORICAL_SUMMARY,
+    "insert_metrics": INSERT_CHAT_METRICS_HISTORY,
+    "upsert_metrics": UPSERT_CHAT_METRICS_LATEST,
+    "insert_recommendation": INSERT_USER_RECOMMENDATION
+}
+
+
+def _metrics_history_args(row: Dict[str, Any]) -> Tuple:
+    return (
+        row["session_id"],
+        row["telegram_user_id"],
+        row["interlocutor_id"],
+        row["role"],
+        row["compliments_delta"],
+        row["total_compliments"],
+        row["engagement_score"],
+        row["attachment_type"],
+        row["attachment_confidence"]
+    )
+
+
+def _metrics_latest_args(row: Dict[str, Any]) -> Tuple:
+    return (
+        str(row["session_id"]),
+        row["interlocutor_id"],
+        row["role"],
+        row["telegram_user_id"],
+        row["total_compliments"],
+        row["engagement_score"],
+        row["attachment_type"],
+        row["attachment_confidence"],
+        row.get("computed_at") or datetime.now(timezone.utc)
+    )
+
+
+class UnitOfWork:
+    """
+    Записи одного батча: саммери, строки метрик и рекомендации.
+
+    Пока батч обрабатывается, записи только накапливаются; commit() сохраняет их
+    в одной транзакции на одном соединении пула, каждую группу одним executemany
+    (asyncpg отправляет такие запросы конвейером). Результаты батча появляются
+    в БД одновременно, а при ошибке не сохраняется ничего.
+    """
+
+    def __init__(self, db: "DBService"):
+        """
+        Args:
+            db: Сервис БД, из пула которого берется соединение
+        """
+        self.db = db
+        self.summaries = []
+        self.metrics = []
+        self.recommendations = []
+        self._after_commit = []
+
+    def add_summary(self, session_id: str, interlocutor_id: int, summary: str, token_count: Optional[int] = None):
+        """Добавляет новое саммери диалога (версия назначается при сохранении)"""
+        self.summaries.append((session_id, interlocutor_id, summary, token_count))
+
+    def add_metrics(self, row: Dict[str, Any]):
+        """
+        Добавляет строку метрик участника
+
+        Args:
+            row: Словарь с ключами session_id, telegram_user_id, interlocutor_id, role,
+                 compliments_delta, total_compliments, engagement_score, attachment_type, attachment_confidence
+                 и computed_at (время расчёта, по умолчанию — время сохранения)
+        """
+        self.metrics.append(row)
+
+    def add_recommendation(self, session_id: str, telegram_user_id: int, interlocutor_id: int, recommendation_text: str):
+        """Добавляет рекомендацию по общению"""
+        self.recommendations.append((session_id, telegram_user_id, interlocutor_id, recommendation_text))
+
+    def after_commit(self, callback: Callable[[], Any]):
+        """Регистрирует действие, которое выполняется только после успешного коммита"""
+        self._after_commit.append(callback)
+
+    def __len__(self) -> int:
+        return len(self.summaries) + len(self.metrics) + len(self.recommendations)
+
+    async def commit(self) -> bool:
+        """
+        Сохраняет все накопленные записи одной транзакцией и обновляет кэш состояния
+
+        Returns:
+            True в случае успеха; при ошибке БД исключение пробрасывается, транзакция откатывается
+        """
+        if not len(self):
+            for callback in self._after_commit:
+                callback()
+            return True
+        pool = await self.db.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await pool.executemany(conn, "save_summary", [
+                    (str(session_id), interlocutor_id, summary, token_count, session_id)
+                    for session_id, interlocutor_id, summary, token_count in self.summaries
+                ])
+                await pool.executemany(conn, "insert_metrics", [_metrics_history_args(row) for row in self.metrics])
+                await pool.executemany(conn, "upsert_metrics", [_metrics_latest_args(row) for row in self.metrics])
+                await pool.executemany(conn, "insert_recommendation", self.recommendations)
+
+        for session_id, interlocutor_id, summary, _ in self.summaries:
+            self.db.state_cache.set_summary(session_id, interlocutor_id, summary)
+        self.db._cache_metrics(self.metrics)
+        for callback in self._after_commit:
+            callback()
+        return True
+
 
 class DBService:
     def __init__(self):
         self.pool = None
-        self.conn_params = {
-            "host": DB_HOST,
-            "port": DB_PORT,
-            "database": DB_NAME,
-            "user": DB_USER,
-            "password": DB_PASS
-        }
-        self.sync_connection = None
+        # Последние метрики и саммери диалогов; обновляются при каждом сохранении
+        self.state_cache = LatestStateCache(STATE_CACHE_SIZE, STATE_CACHE_TTL_SECONDS, STATE_CACHE_NEGATIVE_TTL_SECONDS)
         
         print(f"🛢️ Инициализация DBService с параметрами:")
         print(f"🛢️ - Хост: {DB_HOST}, Порт: {DB_PORT}")
@@ -31,18 +186,34 @@ class DBService:
             for attempt in range(max_attempts):
                 try:
                     start_time = time.time()
-                    self.pool = await asyncpg.create_pool(
+                    pool = DBPool(
+                        HOT_QUERIES,
+                        min_size=DB_POOL_MIN_SIZE,
+                        max_size=DB_POOL_MAX_SIZE,
+                        max_queries=DB_POOL_MAX_QUERIES,
+                        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS,
+                        statement_cache_size=DB_POOL_STATEMENT_CACHE_SIZE,
+                        acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT_SECONDS or None,
                         host=DB_HOST,
                         port=DB_PORT,
                         database=DB_NAME,
                         user=DB_USER,
                         password=DB_PASS,
-                        timeout=10.0,
-                        min_size=2, 
-                        max_size=10
+                        timeout=10.0
                     )
+                    await pool.start()
                     elapsed_time = time.time() - start_time
-                    print(f"✅ Пул соединений PostgreSQL создан за {elapsed_time:.2f} сек")
+                    print(f"✅ Пул соединений PostgreSQL создан за {elapsed_time:.2f} сек "
+                          f"(соединений {DB_POOL_MIN_SIZE}..{DB_POOL_MAX_SIZE})")
+                    # Пул становится доступен только после миграции: запросы не должны
+                    # идти в таблицы, которых ещё нет
+                    if DB_MIGRATE_ON_START:
+                        try:
+                            await self._migrate(pool)
+                        except Exception:
+                            await pool.close()
+                            raise
+                    self.pool = pool
                     break
                 except asyncpg.exceptions.PostgresError as e:
                     print(f"❌ Ошибка PostgreSQL при создании пула (попытка {attempt+1}/{max_attempts}): {e}")
@@ -66,32 +237,40 @@ class DBService:
         return self.pool
 
 
-    def connect(self):
-        """Устанавливает синхронное соединение с БД."""
-        if self.sync_connection is None or self.sync_connection.closed:
-            try:
-                print(f"🔄 Установка синхронного соединения к PostgreSQL ({DB_HOST}:{DB_PORT})...")
-                start_time = time.time()
-                self.sync_connection = psycopg2.connect(**self.conn_params)
-                elapsed_time = time.time() - start_time
-                print(f"✅ Синхронное соединение с PostgreSQL установлено за {elapsed_time:.2f} сек")
-            except psycopg2.OperationalError as e:
-                print(f"❌ Ошибка подключения к PostgreSQL: {e}")
-                raise
-        return self.sync_connection
-
-    def close(self):
-        """Закрывает синхронное соединение с БД."""
-        if self.sync_connection and not self.sync_connection.closed:
-            print(f"🔄 Закрытие синхронного соединения с PostgreSQL...")
-            self.sync_connection.close()
-            print(f"✅ Соединение закрыто")
+    async def start(self):
+        """
+        Создает пул и приводит схему к актуальной; вызывается при запуске до чтения из Kafka
+
+        Raises:
+            RuntimeError: Если пул не создан или схему не удалось обновить
+        """
+        if await self.get_pool() is None:
+            raise RuntimeError("Не удалось подключиться к PostgreSQL или обновить схему БД")
+
+    async def _migrate(self, pool: DBPool):
+        """Приводит схему к актуальной: таблицы последнего состояния, индексы, секции истории"""
+        start_time = time.time()
+        async with pool.acquire() as conn:
+            await ensure_schema(conn, DB_HISTORY_PARTITION_MONTHS_AHEAD)
+        print(f"✅ Схема БД проверена за {time.time() - start_time:.2f} сек")
 
+    async def close_pool(self):
+        """Закрывает пул соединений"""
+        if self.pool is not None:
+            print(f"📈 Пул БД при завершении: {self.pool.stats()}")
+            await self.pool.close()
+            self.pool = None
+            print(f"✅ Пул соединений PostgreSQL закрыт")
 
     async def get_historical_summary(self, session_id: str, interlocutor_id: int) -> Optional[str]:
         """
         Асинхронно получает последнее историческое саммери для указанного диалога
         """
+        found, cached_summary = self.state_cache.get_summary(session_id, interlocutor_id)
+        if found:
+            print(f"✅ Историческое саммери для сессии {session_id}, собеседника {interlocutor_id} взято из кэша")
+            return cached_summary
+        
         print(f"🔄 Получение исторического саммери для сессии {session_id}, собеседника {interlocutor_id}...")
         try:
             pool = await self.get_pool()
@@ -101,22 +280,18 @@ class DBService:
                 
             async with pool.acquire() as conn:
                 print(f"🔄 Выполнение запроса к БД для получения саммери...")
-                row = await conn.fetchrow("""
-                    SELECT summary 
-                    FROM historical_summaries 
-                    WHERE session_id = $1 AND interlocutor_id = $2
-                    ORDER BY ts DESC 
-                    LIMIT 1
-                """, session_id, interlocutor_id)
+                row = await pool.fetchrow(conn, "select_summary", str(session_id), interlocutor_id)
                 
                 if row:
                     summary = row['summary']
                     summary_preview = summary[:100] + "..." if len(summary) > 100 else summary
                     print(f"✅ Получено историческое саммери, длина: {len(summary)} символов")
                     print(f"📝 Начало саммери: {summary_preview}")
+                    self.state_cache.set_summary(session_id, interlocutor_id, summary)
                     return summary
                 else:
                     print(f"ℹ️ Историческое саммери не найдено для сессии {session_id}, собеседника {interlocutor_id}")
+                    self.state_cache.set_summary(session_id, interlocutor_id, None)
                     return None
         except Exception as e:
             print(f"❌ Ошибка при получении исторического саммери: {e}")
@@ -124,220 +299,42 @@ class DBService:
             print(f"Стек ошибки:\n{traceback.format_exc()}")
             return None
 
-    async def save_historical_summary(self, session_id: str, interlocutor_id: int, summary: str) -> bool:
-        """
-        Асинхронно сохраняет новое историческое саммери для указанного диалога
-        """
-        pool = await self.get_pool()
-        async with pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO historical_summaries (session_id, interlocutor_id, summary) 
-                VALUES ($1, $2, $3)
-            """, session_id, interlocutor_id, summary)
-            return True
+    def _cache_metrics(self, rows: List[Dict[str, Any]]):
+        """Запоминает в кэше состояния последние сохраненные метрики"""
+        for row in rows:
+            self.state_cache.set_metrics(row["session_id"], row["interlocutor_id"], row["role"], {
+                'total_compliments': row["total_compliments"],
+                'engagement_score': row["engagement_score"],
+                'attachment_type': row["attachment_type"],
+                'attachment_confidence': row["attachment_confidence"]
+            })
 
-    async def save_chat_metrics(self, 
-                             session_id: str, 
-                             telegram_user_id: int, 
-                             interlocutor_id: int,
-                             role: str,
-                             compliments_delta: int,
-                             total_compliments: int, 
-                             engagement_score: float,
-                             attachment_type: str,
-                             attachment_confidence: float) -> bool:
-        """
-        Асинхронно сохраняет метрики чата в базу данных
-        """
-        pool = await self.get_pool()
-        async with pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO chat_metrics_history (
-                    session_id, 
-                    telegram_user_id, 
-                    interlocutor_id, 
-                    role,
-                    compliments_delta, 
-                    total_compliments, 
-                    engagement_score,
-                    attachment_type,
-                    attachment_confidence
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            """, 
-                session_id, 
-                telegram_user_id, 
-                interlocutor_id, 
-                role,
-                compliments_delta, 
-                total_compliments, 
-                engagement_score,
-                attachment_type,
-                attachment_confidence
-            )
-            return True
+    def unit_of_work(self) -> UnitOfWork:
+        """Создает набор записей батча, который сохраняется одной транзакцией"""
+        return UnitOfWork(self)
 
     async def get_latest_metrics(self, session_id: str, interlocutor_id: int, role: str) -> Optional[Dict[str, Any]]:
         """
         Асинхронно получает последние метрики для указанного участника диалога
         """
+        found, cached_metrics = self.state_cache.get_metrics(session_id, interlocutor_id, role)
+        if found:
+            return cached_metrics
+        
         pool = await self.get_pool()
         async with pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT 
-                    total_compliments, 
-                    engagement_score,
-                    attachment_type,
-                    attachment_confidence
-                FROM chat_metrics_history 
-                WHERE session_id = $1 AND interlocutor_id = $2 AND role = $3
-                ORDER BY ts DESC 
-                LIMIT 1
-            """, session_id, interlocutor_id, role)
+            row = await pool.fetchrow(conn, "select_metrics", str(session_id), interlocutor_id, role)
             
+            metrics = None
             if row:
-                return {
+                metrics = {
                     'total_compliments': row['total_compliments'],
                     'engagement_score': row['engagement_score'],
                     'attachment_type': row['attachment_type'],
                     'attachment_confidence': row['attachment_confidence']
                 }
-            return None
-            
-
-    def get_historical_summary_sync(self, session_id: str, interlocutor_id: int) -> Optional[str]:
-        conn = self.connect()
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT summary 
-                    FROM historical_summaries 
-                    WHERE session_id = %s AND interlocutor_id = %s
-                    ORDER BY ts DESC 
-                    LIMIT 1
-                """, (session_id, interlocutor_id))
-                
-                result = cur.fetchone()
-                return result['summary'] if result else None
-        except Exception as e:
-            print(f"Ошибка при получении исторического саммери: {e}")
-            return None
-
-    def save_historical_summary_sync(self, session_id: str, interlocutor_id: int, summary: str) -> bool:
-        conn = self.connect()
-        try:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO historical_summaries (session_id, interlocutor_id, summary) 
-                    VALUES (%s, %s, %s)
-                """, (session_id, interlocutor_id, summary))
-                conn.commit()
-                return True
-        except Exception as e:
-            conn.rollback()
-            print(f"Ошибка при сохранении исторического саммери: {e}")
-            return False
-
-    def save_chat_metrics_sync(self, 
-                             session_id: str, 
-                             telegram_user_id: int, 
-                             interlocutor_id: int,
-                             role: str,
-                             compliments_delta: int,
-                             total_compliments: int, 
-                             engagement_score: float,
-                             attachment_type: str,
-                             attachment_confidence: float) -> bool:
-        conn = self.connect()
-        try:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO chat_metrics_history (
-                        session_id, 
-                        telegram_user_id, 
-                        interlocutor_id, 
-                        role,
-                        compliments_delta, 
-                        total_compliments, 
-                        engagement_score,
-                        attachment_type,
-                        attachment_confidence
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    session_id, 
-                    telegram_user_id, 
-                    interlocutor_id, 
-                    role,
-                    compliments_delta, 
-                    total_compliments, 
-                    engagement_score,
-                    attachment_type,
-                    attachment_confidence
-                ))
-                conn.commit()
-                return True
-        except Exception as e:
-            conn.rollback()
-            print(f"Ошибка при сохранении метрик чата: {e}")
-            return False
-
-    def get_latest_metrics_sync(self, session_id: str, interlocutor_id: int, role: str) -> Optional[Dict[str, Any]]:
-        conn = self.connect()
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT 
-                        total_compliments, 
-                        engagement_score,
-                        attachment_type,
-                        attachment_confidence
-                    FROM chat_metrics_history 
-                    WHERE session_id = %s AND interlocutor_id = %s AND role = %s
-                    ORDER BY ts DESC 
-                    LIMIT 1
-                """, (session_id, interlocutor_id, role))
-                
-                return cur.fetchone()
-        except Exception as e:
-            print(f"Ошибка при получении последних метрик: {e}")
-            return None
-
-    async def save_user_recommendation(
-        self,
-        session_id: str,
-        telegram_user_id: int,
-        interlocutor_id: int,
-        recommendation_text: str
-    ) -> bool:
-        """
-        Сохраняет рекомендацию по общению в БД
-        
-        Args:
-            session_id: ID сессии
-            telegram_user_id: ID пользователя телеграм
-            interlocutor_id: ID собеседника
-            recommendation_text: Текст рекомендации
-            
-        Returns:
-            True в случае успеха, False при ошибке
-        """
-        try:
-            conn = await self.get_pool()
-            async with conn.acquire() as conn:
-                await conn.execute(
-                    """
-                    INSERT INTO telegram_user_recommendations
-                    (session_id, telegram_user_id, interlocutor_id, recommendation_text)
-                    VALUES ($1, $2, $3, $4)
-                    """,
-                    session_id, telegram_user_id, interlocutor_id, recommendation_text
-                )
-            print(f"✅ Рекомендация для пользователя {telegram_user_id} с собеседником {interlocutor_id} сохранена в БД")
-            return True
-        except Exception as e:
-            print(f"❌ Ошибка при сохранении рекомендации в БД: {e}")
-            import traceback
-            print(f"Стек ошибки рекомендации:\n{traceback.format_exc()}")
-            return False
+            self.state_cache.set_metrics(session_id, interlocutor_id, role, metrics)
+            return metrics
 
 
 db_service = DBService() 
\ No newline at end of file
@@ -0,0 +1,296 @@
+"""
+Схема таблиц, которые ведёт анализатор.
+
+История (chat_metrics_history, historical_summaries) остаётся журналом только на добавление,
+а последние значения по диалогу лежат в таблицах *_latest и обновляются UPSERT-ом в той же
+транзакции, что и вставка в историю. Чтение последнего состояния — поиск по первичному
+ключу вместо ORDER BY ts DESC LIMIT 1 по растущему журналу.
+
+Миграция идемпотентна и выполняется при создании пула. Перевод истории на секционирование
+по времени — отдельная ручная операция:
+    python -m services.schema --partition-history
+"""
+import argparse
+import asyncio
+import time
+from datetime import date
+from typing import List, Tuple
+
+# Ключ advisory-блокировки, чтобы реплики не выполняли миграцию одновременно
+MIGRATION_LOCK_ID = 7_245_301
+# Сколько секунд ждать, пока миграцию закончит другая реплика
+MIGRATION_LOCK_TIMEOUT_SECONDS = 600
+
+HISTORY_TABLES = ("chat_metrics_history", "historical_summaries")
+
+LATEST_TABLES = {
+    "chat_metrics_latest": """
+        CREATE TABLE chat_metrics_latest (
+            session_id TEXT NOT NULL,
+            interlocutor_id BIGINT NOT NULL,
+            role TEXT NOT NULL,
+            telegram_user_id BIGINT,
+            total_compliments INTEGER,
+            engagement_score DOUBLE PRECISION,
+            attachment_type TEXT,
+            attachment_confidence DOUBLE PRECISION,
+            ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+            -- Покрывающий ключ: чтение последних метрик обходится index-only scan
+            PRIMARY KEY (session_id, interlocutor_id, role)
+                INCLUDE (total_compliments, engagement_score, attachment_type, attachment_confidence)
+        )
+    """,
+    "historical_summary_latest": """
+        CREATE TABLE historical_summary_latest (
+            session_id TEXT NOT NULL,
+            interlocutor_id BIGINT NOT NULL,
+            summary TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            token_count INTEGER,
+            ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (session_id, interlocutor_id)
+        )
+    """
+}
+
+BACKFILL = {
+    "chat_metrics_latest": """
+        INSERT INTO chat_metrics_latest (
+            session_id, interlocutor_id, role, telegram_user_id, total_compliments,
+            engagement_score, attachment_type, attachment_confidence, ts
+        )
+        SELECT DISTINCT ON (session_id, interlocutor_id, role)
+            session_id::text, interlocutor_id, role, telegram_user_id, total_compliments,
+            engagement_score, attachment_type, attachment_confidence, ts
+        FROM chat_metrics_history
+        ORDER BY session_id, interlocutor_id, role, ts DESC
+        ON CONFLICT DO NOTHING
+    """,
+    "historical_summary_latest": """
+        INSERT INTO historical_summary_latest (session_id, interlocutor_id, summary, version, token_count, ts)
+        SELECT DISTINCT ON (session_id, interlocutor_id)
+            session_id::text, interlocutor_id, summary,
+            COALESCE(version, COUNT(*) OVER (PARTITION BY session_id, interlocutor_id)),
+            token_count, ts
+        FROM historical_summaries
+        ORDER BY session_id, interlocutor_id, ts DESC
+        ON CONFLICT DO NOTHING
+    """
+}
+
+# ts ($9) — время расчёта метрик: запоздавшая запись более старого расчёта не откатывает состояние
+UPSERT_CHAT_METRICS_LATEST = """
+    INSERT INTO chat_metrics_latest (
+        session_id, interlocutor_id, role, telegram_user_id, total_compliments,
+        engagement_score, attachment_type, attachment_confidence, ts
+    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+    ON CONFLICT (session_id, interlocutor_id, role) DO UPDATE SET
+        telegram_user_id = EXCLUDED.telegram_user_id,
+        total_compliments = EXCLUDED.total_compliments,
+        engagement_score = EXCLUDED.engagement_score,
+        attachment_type = EXCLUDED.attachment_type,
+        attachment_confidence = EXCLUDED.attachment_confidence,
+        ts = EXCLUDED.ts
+    WHERE chat_metrics_latest.ts < EXCLUDED.ts
+"""
+
+# Версия саммери растёт на единицу; строка диалога блокируется до конца транзакции,
+# поэтому параллельные записи одного диалога получают разные версии
+UPSERT_HISTORICAL_SUMMARY_LATEST = """
+    INSERT INTO historical_summary_latest (session_id, interlocutor_id, summary, version, token_count, ts)
+    VALUES ($1, $2, $3, 1, $4, now())
+    ON CONFLICT (session_id, interlocutor_id) DO UPDATE SET
+        summary = EXCLUDED.summary,
+        version = historical_summary_latest.version + 1,
+        token_count = EXCLUDED.token_count,
+        ts = EXCLUDED.ts
+    RETURNING version
+"""
+
+# Саммери в историю и в *_latest одним запросом: подходит для executemany
+# ($5 — session_id в типе колонки истории)
+SAVE_HISTORICAL_SUMMARY = f"""
+    WITH latest AS ({UPSERT_HISTORICAL_SUMMARY_LATEST})
+    INSERT INTO historical_summaries (session_id, interlocutor_id, summary, version, token_count)
+    SELECT $5, $2, $3, latest.version, $4 FROM latest
+"""
+
+# Индексы истории (имя, таблица, колонки): по ним строится начальное заполнение *_latest
+# и выборки истории диалога за период
+HISTORY_INDEXES = (
+    ("chat_metrics_history_dialog_ts", "chat_metrics_history", "session_id, interlocutor_id, role, ts DESC"),
+    ("historical_summaries_dialog_ts", "historical_summaries", "session_id, interlocutor_id, ts DESC")
+)
+
+
+async def ensure_schema(conn, partition_months_ahead: int = 3):
+    """
+    Приводит схему к актуальной: колонки версии саммери, индексы истории, таблицы
+    последнего состояния с начальным заполнением из истории и секции истории
+    на ближайшие месяцы (если история секционирована)
+
+    Блокировка берётся через pg_try_advisory_lock: пока миграцию выполняет другая
+    реплика, эта не висит в pg_advisory_lock, а опрашивает блокировку между
+    короткими запросами. Иначе CREATE INDEX CONCURRENTLY у владельца блокировки ждал бы
+    завершения её ожидающего запроса, а тот — снятия блокировки. После чужой миграции
+    проверка повторяется и ничего не меняет.
+
+    Args:
+        conn: Соединение asyncpg (не внутри транзакции)
+        partition_months_ahead: На сколько месяцев вперёд создавать секции истории
+
+    Raises:
+        TimeoutError: Если другая реплика держит блокировку дольше MIGRATION_LOCK_TIMEOUT_SECONDS
+    """
+    await _acquire_migration_lock(conn)
+    try:
+        await conn.execute("""
+            ALTER TABLE historical_summaries
+                ADD COLUMN IF NOT EXISTS version INTEGER,
+                ADD COLUMN IF NOT EXISTS token_count INTEGER
+        """)
+
+        for table, ddl in LATEST_TABLES.items():
+            if await conn.fetchval("SELECT to_regclass($1)", table) is not None:
+                continue
+            async with conn.transaction():
+                await conn.execute(ddl)
+                result = await conn.execute(BACKFILL[table])
+            print(f"✅ Создана таблица {table}, перенесено из истории: {result.split()[-1]} строк")
+
+        for table in HISTORY_TABLES:
+            if await _is_partitioned(conn, table):
+                await ensure_partitions(conn, table, partition_months_ahead)
+
+        for name, table, columns in HISTORY_INDEXES:
+            await _ensure_index(conn, name, table, columns)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+
+async def _acquire_migration_lock(conn):
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT_SECONDS
+    waiting = False
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"миграцию схемы дольше {MIGRATION_LOCK_TIMEOUT_SECONDS} сек выполняет другая реплика")
+        if not waiting:
+            print("⏳ Миграцию схемы выполняет другая реплика, ждём её завершения")
+            waiting = True
+        await asyncio.sleep(1)
+
+
+async def _ensure_index(conn, name: str, table: str, columns: str):
+    """
+    Создаёт индекс истории. Индекс, оставшийся невалидным после прерванного
+    CREATE INDEX CONCURRENTLY, не используется планировщиком, но IF NOT EXISTS его
+    пропускает, поэтому такой индекс удаляется и строится заново
+    """
+    # CONCURRENTLY не блокирует запись в историю, но неприменим к секционированной таблице
+    concurrently = "" if await _is_partitioned(conn, table) else " CONCURRENTLY"
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name
+    )
+    if invalid:
+        print(f"⚠️ Индекс {name} невалиден (сборка была прервана), строим заново")
+        await conn.execute(f"DROP INDEX{concurrently} IF EXISTS {name}")
+    await conn.execute(f"CREATE INDEX{concurrently} IF NOT EXISTS {name} ON {table} ({columns})")
+
+
+async def _is_partitioned(conn, table: str) -> bool:
+    return await conn.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass($1)
+        )
+    """, table)
+
+
+def _month_start(day: date, offset: int) -> date:
+    month = day.month - 1 + offset
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def month_ranges(today: date, months_ahead: int) -> List[Tuple[date, date]]:
+    """Границы месячных секций с текущего месяца на months_ahead вперёд"""
+    return [(_month_start(today, offset), _month_start(today, offset + 1)) for offset in range(months_ahead + 1)]
+
+
+async def ensure_partitions(conn, table: str, months_ahead: int = 3):
+    """
+    Создаёт месячные секции секционированной по ts таблицы истории и секцию по умолчанию
+    для строк за пределами созданных месяцев
+
+    Args:
+        conn: Соединение asyncpg
+        table: Имя таблицы истории
+        months_ahead: На сколько месяцев вперёд создавать секции
+    """
+    for start, end in month_ranges(date.today(), months_ahead):
+        partition = f"{table}_{start:%Y_%m}"
+        if await conn.fetchval("SELECT to_regclass($1)", partition) is not None:
+            continue
+        try:
+            await conn.execute(
+                f"CREATE TABLE {partition} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+        except Exception as e:
+            # Например, в секции по умолчанию уже есть строки этого месяца
+            print(f"⚠️ Не удалось создать секцию {partition}: {e}")
+    await conn.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+
+
+async def partition_history(conn, table: str, months_ahead: int = 3):
+    """
+    Переводит таблицу истории на секционирование по месяцам (RANGE по ts).
+
+    Существующая таблица переименовывается в {table}_legacy и подключается как секция
+    со всеми строками до начала текущего месяца, новые строки идут в месячные секции.
+    Выполняется в одной транзакции; на время переименования запись в таблицу блокируется.
+
+    Args:
+        conn: Соединение asyncpg
+        table: Имя таблицы истории
+        months_ahead: На сколько месяцев вперёд создать секции
+    """
+    if await _is_partitioned(conn, table):
+        print(f"ℹ️ Таблица {table} уже секционирована")
+        return
+    boundary = _month_start(date.today(), 0).isoformat()
+    legacy = f"{table}_legacy"
+    async with conn.transaction():
+        await conn.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        # Первичный ключ и уникальные индексы не копируются: у секционированной таблицы
+        # они обязаны включать ключ секционирования
+        await conn.execute(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE (ts)"
+        )
+        # С проверенным ограничением ATTACH PARTITION не сканирует таблицу повторно
+        await conn.execute(f"ALTER TABLE {legacy} ADD CONSTRAINT {legacy}_ts_range CHECK (ts < '{boundary}')")
+        await conn.execute(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{boundary}')")
+        await ensure_partitions(conn, table, months_ahead)
+    print(f"✅ Таблица {table} секционирована по месяцам, старые строки в секции {legacy}")
+
+
+async def _main():
+    import asyncpg
+    from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--partition-history", action="store_true", help="Секционировать таблицы истории по месяцам")
+    parser.add_argument("--months-ahead", type=int, default=3)
+    args = parser.parse_args()
+
+    conn = await asyncpg.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASS)
+    try:
+        if args.partition_history:
+            for table in HISTORY_TABLES:
+                await partition_history(conn, table, args.months_ahead)
+        await ensure_schema(conn, args.months_ahead)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
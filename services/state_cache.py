@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+_MISSING = object()
+
+
+class LRUTTLCache:
+    """
+    Ограниченный по размеру LRU-кэш с временем жизни записей и счётчиками попаданий.
+    Умеет хранить и отрицательный результат (None), чтобы не ходить в БД
+    за заведомо отсутствующими строками; он живёт не дольше negative_ttl_seconds.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 600.0, negative_ttl_seconds: Optional[float] = None):
+        """
+        Args:
+            max_size: Максимальное число записей
+            ttl_seconds: Время жизни записи в секундах (0 — без ограничения)
+            negative_ttl_seconds: Время жизни отрицательного результата (None — как у остальных записей)
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = ttl_seconds if negative_ttl_seconds is None else negative_ttl_seconds
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Возвращает значение из кэша
+
+        Args:
+            key: Ключ записи
+
+        Returns:
+            Tuple из (найдено ли значение, значение)
+        """
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return False, None
+        stored_at, value = entry
+        ttl_seconds = self.negative_ttl_seconds if value is None else self.ttl_seconds
+        if ttl_seconds and time.monotonic() - stored_at > ttl_seconds:
+            del self._data[key]
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def set(self, key: Hashable, value: Any):
+        """Записывает значение и вытесняет самые старые записи при переполнении"""
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """Удаляет запись из кэша"""
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счётчики кэша"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+class LatestStateCache:
+    """
+    Кэш последнего состояния диалога: метрики по ключу (session_id, interlocutor_id, role)
+    и историческое саммери по ключу (session_id, interlocutor_id).
+    Обновляется сквозной записью при сохранении в БД. Записи верны, только пока диалоги
+    обрабатывает эта реплика, поэтому при назначении партиций кэш сбрасывается.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 600.0, negative_ttl_seconds: Optional[float] = None):
+        self.metrics = LRUTTLCache(max_size, ttl_seconds, negative_ttl_seconds)
+        self.summaries = LRUTTLCache(max_size, ttl_seconds, negative_ttl_seconds)
+
+    def get_metrics(self, session_id: str, interlocutor_id: int, role: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        found, value = self.metrics.get((session_id, interlocutor_id, role))
+        return found, dict(value) if value is not None else None
+
+    def set_metrics(self, session_id: str, interlocutor_id: int, role: str, metrics: Optional[Dict[str, Any]]):
+        self.metrics.set((session_id, interlocutor_id, role), dict(metrics) if metrics is not None else None)
+
+    def get_summary(self, session_id: str, interlocutor_id: int) -> Tuple[bool, Optional[str]]:
+        return self.summaries.get((session_id, interlocutor_id))
+
+    def set_summary(self, session_id: str, interlocutor_id: int, summary: Optional[str]):
+        self.summaries.set((session_id, interlocutor_id), summary)
+
+    def clear(self):
+        """Забывает состояние всех диалогов"""
+        self.metrics.clear()
+        self.summaries.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Возвращает счётчики обоих кэшей"""
+        return {
+            "metrics": self.metrics.stats(),
+            "summaries": self.summaries.stats()
+        }
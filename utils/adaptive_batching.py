@@ -0,0 +1,135 @@
+import math
+import time
+from typing import Any, Dict, Hashable
+
+
+class AdaptiveBatchController:
+    """
+    Подбирает размер батча и время ожидания по нагрузке.
+
+    Давление (0..1) складывается из заполненности дорожек анализа и задержки обработки
+    батча относительно целевой: при низком давлении батчи уходят быстро и небольшими,
+    при высоком — крупнее и реже, чтобы снизить число запросов к LLM. Поверх общего
+    решения учитывается темп диалога: быстрым диалогам разрешён батч больше, а для
+    медленных, которые за время ожидания не успеют прислать второе сообщение, ожидание
+    сокращается до минимума.
+    """
+
+    # Диалог без сообщений дольше этого числа максимальных ожиданий забывается
+    IDLE_WAITS_TO_FORGET = 10
+
+    def __init__(self, size_min: int, size_max: int, wait_min: float, wait_max: float,
+                 target_latency: float, update_interval: float = 1.0, smoothing: float = 0.2):
+        """
+        Args:
+            size_min: Минимальный размер батча
+            size_max: Максимальный размер батча
+            wait_min: Минимальное время ожидания батча в секундах
+            wait_max: Максимальное время ожидания батча в секундах
+            target_latency: Целевое время обработки одного батча в секундах
+            update_interval: Как часто пересчитывать решение
+            smoothing: Коэффициент сглаживания (EWMA) задержки, темпа и давления
+        """
+        self.size_min = max(1, size_min)
+        self.size_max = max(self.size_min, size_max)
+        self.wait_min = max(0.0, wait_min)
+        self.wait_max = max(self.wait_min, wait_max)
+        self.target_latency = target_latency
+        self.update_interval = update_interval
+        self.smoothing = smoothing
+
+        self.latency = None
+        self.queue_fill = 0.0
+        self.pressure = 0.0
+        self.batch_size = self.size_min
+        self.wait = self.wait_min
+        self._updated_at = 0.0
+        # Ключ диалога -> (время последнего сообщения, сообщений в секунду)
+        self._rates: Dict[Hashable, tuple] = {}
+        self.shortened = 0
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return previous + self.smoothing * (value - previous)
+
+    def observe_latency(self, seconds: float):
+        """Учитывает время обработки очередного батча"""
+        self.latency = self._smooth(self.latency, seconds)
+
+    def observe_message(self, key: Hashable, now: float):
+        """Учитывает сообщение диалога для оценки его темпа"""
+        previous = self._rates.get(key)
+        if previous is None:
+            self._rates[key] = (now, None)
+            return
+        last_at, rate = previous
+        interval = max(now - last_at, 1e-3)
+        self._rates[key] = (now, self._smooth(rate, 1.0 / interval))
+
+    def update(self, queue_depth: int, capacity: int):
+        """
+        Пересчитывает общее решение (не чаще update_interval)
+
+        Args:
+            queue_depth: Сколько батчей ждёт или идёт в обработке
+            capacity: Ёмкость очереди обработки
+        """
+        now = time.monotonic()
+        if now - self._updated_at < self.update_interval:
+            return
+        self._updated_at = now
+
+        self.queue_fill = min(1.0, queue_depth / capacity) if capacity else 0.0
+        latency_pressure = 0.0
+        if self.latency is not None and self.target_latency > 0:
+            # 0 при задержке не выше целевой, 1 при двукратном превышении
+            latency_pressure = min(1.0, max(0.0, self.latency / self.target_latency - 1.0))
+        self.pressure = self._smooth(self.pressure, max(self.queue_fill, latency_pressure))
+
+        self.batch_size = round(self.size_min + (self.size_max - self.size_min) * self.pressure)
+        self.wait = self.wait_min + (self.wait_max - self.wait_min) * self.pressure
+
+    def max_batch_size(self, key: Hashable) -> int:
+        """Размер батча для диалога: быстрый диалог может набрать больше, не дожидаясь таймаута"""
+        rate = self._rate(key)
+        if rate is None:
+            return self.batch_size
+        expected = rate * self.wait
+        if expected <= self.batch_size:
+            return self.batch_size
+        return min(self.size_max, math.ceil(expected))
+
+    def max_wait(self, key: Hashable) -> float:
+        """Время ожидания нового батча диалога: короче, если за него не придёт и второе сообщение"""
+        rate = self._rate(key)
+        if rate is None:
+            return self.wait
+        expected = rate * self.wait
+        if expected >= 2:
+            return self.wait
+        self.shortened += 1
+        # 0..1 ожидаемых сообщений — минимальное ожидание, дальше линейно до общего решения
+        return self.wait_min + (self.wait - self.wait_min) * max(0.0, expected - 1.0)
+
+    def _rate(self, key: Hashable):
+        previous = self._rates.get(key)
+        return previous[1] if previous is not None else None
+
+    def forget_idle(self, now: float):
+        """Удаляет темп диалогов, которые давно не присылали сообщений"""
+        horizon = now - self.wait_max * self.IDLE_WAITS_TO_FORGET
+        for key in [key for key, (last_at, _) in self._rates.items() if last_at < horizon]:
+            del self._rates[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущие решения контроллера для мониторинга"""
+        return {
+            "batch_size": self.batch_size,
+            "wait_seconds": round(self.wait, 2),
+            "pressure": round(self.pressure, 3),
+            "queue_fill": round(self.queue_fill, 3),
+            "latency_seconds": round(self.latency, 2) if self.latency is not None else None,
+            "tracked_dialogs": len(self._rates),
+            "shortened_waits": self.shortened
+        }
@@ -1,24 +1,388 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import sys
 import time
 
+from utils.messages import MessageRecord
+
 class SessionBatcher:
-    def __init__(self, max_batch_size=20, max_wait=30):
+    """
+    Накопитель батчей по диалогам. Готовность отслеживается без обхода всех диалогов:
+    сроки ожидания лежат в куче, а диалоги, набравшие полный батч, — в отдельном наборе,
+    поэтому get_ready_batches стоит пропорционально числу готовых батчей.
+    """
+
+    def __init__(self, max_batch_size=20, max_wait=30, controller=None):
+        """
+        Args:
+            max_batch_size: Размер батча
+            max_wait: Максимальное время накопления батча в секундах
+            controller: AdaptiveBatchController; если задан, размер и ожидание подбираются по нагрузке
+        """
         self.batches = defaultdict(list)
         self.timestamps = {}
         self.max_batch_size = max_batch_size
         self.max_wait = max_wait
+        self.controller = controller
+        # Куча (срок, порядковый номер, ключ); устаревшие записи отбрасываются при извлечении
+        self._deadlines = []
+        self._deadline_by_key = {}
+        self._sequence = itertools.count()
+        # Диалоги с полным батчем (dict как упорядоченное множество)
+        self._full = {}
 
-    def add_message(self, session_id, interlocutor_id, message):
+    def add_message(self, session_id, interlocutor_id, message, position=None):
+        """
+        Args:
+            session_id: ID сессии
+            interlocutor_id: ID собеседника
+            message: Сообщение
+            position: Пара (TopicPartition, offset) сообщения; нужна персистентному накопителю
+        """
         key = (session_id, interlocutor_id)
         self.batches[key].append(message)
-        self.timestamps.setdefault(key, time.time())
+        self._schedule(key, time.time(), observe=True)
+
+    def _schedule(self, key, received_at, observe=False):
+        """Ставит срок ожидания для нового батча и отмечает диалог с полным батчем"""
+        if observe and self.controller is not None:
+            self.controller.observe_message(key, received_at)
+        if key not in self.timestamps:
+            self.timestamps[key] = received_at
+            max_wait = self.controller.max_wait(key) if self.controller is not None else self.max_wait
+            deadline = received_at + max_wait
+            self._deadline_by_key[key] = deadline
+            heapq.heappush(self._deadlines, (deadline, next(self._sequence), key))
+        max_batch_size = self.controller.max_batch_size(key) if self.controller is not None else self.max_batch_size
+        if self.batch_size(key) >= max_batch_size:
+            self._full[key] = None
+
+    def _unschedule(self, key):
+        self.timestamps.pop(key, None)
+        self._deadline_by_key.pop(key, None)
+        self._full.pop(key, None)
+
+    def batch_size(self, key):
+        """Число накопленных сообщений диалога"""
+        return len(self.batches.get(key, ()))
 
     def get_ready_batches(self):
         now = time.time()
-        ready_batches = []
-        for key, messages in list(self.batches.items()):
-            if len(messages) >= self.max_batch_size or (now - self.timestamps[key]) > self.max_wait:
-                ready_batches.append((key, messages))
-                del self.batches[key]
-                del self.timestamps[key]
-        return ready_batches
+        ready_keys = list(self._full)
+        while self._deadlines and self._deadlines[0][0] < now:
+            deadline, _, key = heapq.heappop(self._deadlines)
+            # Запись устарела, если батч уже забран (и, возможно, начат новый)
+            if self._deadline_by_key.get(key) == deadline and key not in self._full:
+                ready_keys.append(key)
+        return [(key, self.pop_batch(key)) for key in ready_keys]
+
+    def pop_batch(self, key):
+        """Забирает накопленный батч диалога независимо от его готовности"""
+        self._unschedule(key)
+        return self.batches.pop(key, [])
+
+    def requeue(self, key, messages, positions, received_at):
+        """
+        Возвращает в буфер часть только что забранного батча с исходным сроком ожидания.
+        Сообщения не считаются новыми: срок не сдвигается, контроллер их не учитывает
+
+        Args:
+            key: Ключ диалога (session_id, interlocutor_id)
+            messages: Возвращаемые сообщения в исходном порядке
+            positions: Их позиции (TopicPartition, offset); нужны персистентному накопителю
+            received_at: Время начала накопления забранного батча
+        """
+        if not messages:
+            return
+        self._unschedule(key)
+        self.batches[key] = list(messages) + self.batches.get(key, [])
+        self._schedule(key, received_at or time.time())
+
+    def sync(self):
+        """Фиксирует накопленные изменения (для накопителя в памяти ничего не делает)"""
+
+    @property
+    def restorable(self):
+        """Есть ли буферы, сохранённые до перезапуска и ещё не восстановленные"""
+        return False
+
+    def restore(self, partitions, committed):
+        """
+        Восстанавливает буферы, сохранённые до перезапуска
+
+        Args:
+            partitions: Назначенные партиции
+            committed: Закоммиченные оффсеты группы: {TopicPartition: оффсет или None}
+
+        Returns:
+            Список (ключ диалога, (topic, partition), offset) восстановленных сообщений
+        """
+        return []
+
+    def stats(self):
+        """Возвращает показатели для мониторинга"""
+        return {
+            "backend": "memory",
+            "dialogs": len(self.timestamps),
+            "buffered_messages": sum(len(messages) for messages in self.batches.values()),
+            "memory_bytes": sum(_messages_size(messages) for messages in self.batches.values())
+        }
+
+    def close(self):
+        """Освобождает ресурсы накопителя"""
+
+
+class PersistentSessionBatcher(SessionBatcher):
+    """
+    Накопитель батчей с журналом в SQLite. Каждое сообщение сразу пишется на диск,
+    поэтому неполные батчи переживают перезапуск; в памяти держатся только недавно
+    пополнявшиеся диалоги (горячий набор), а при превышении лимита сообщений самые
+    давние диалоги вытесняются и читаются с диска, когда их батч готов.
+    """
+
+    def __init__(self, path, max_batch_size=20, max_wait=30, memory_cap_messages=50000, controller=None):
+        """
+        Args:
+            path: Путь к файлу SQLite
+            max_batch_size: Размер батча
+            max_wait: Максимальное время накопления батча в секундах
+            memory_cap_messages: Максимум сообщений, хранимых в памяти
+            controller: AdaptiveBatchController для подбора размера и ожидания
+        """
+        super().__init__(max_batch_size=max_batch_size, max_wait=max_wait, controller=controller)
+        self.path = path
+        self.memory_cap_messages = max(0, memory_cap_messages)
+        # Горячий набор в порядке последнего пополнения: первыми вытесняются самые давние диалоги
+        self.batches = OrderedDict()
+        self.counts = {}
+        self.hot_messages = 0
+        self.spilled = 0
+        self.disk_loads = 0
+        self._restored = False
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS buffered_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dialog TEXT NOT NULL,
+                topic TEXT,
+                partition INTEGER,
+                message_offset INTEGER,
+                received_at REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS buffered_messages_dialog ON buffered_messages (dialog, id)")
+        self._conn.commit()
+
+    @staticmethod
+    def _dialog(key):
+        return json.dumps(key, ensure_ascii=False)
+
+    def add_message(self, session_id, interlocutor_id, message, position=None):
+        key = (session_id, interlocutor_id)
+        now = time.time()
+        topic, partition, offset = None, None, None
+        if position is not None:
+            tp, offset = position
+            topic, partition = tp.topic, tp.partition
+        self._conn.execute(
+            "INSERT INTO buffered_messages (dialog, topic, partition, message_offset, received_at, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self._dialog(key), topic, partition, offset, now, json.dumps(message, ensure_ascii=False, default=_to_json))
+        )
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self._schedule(key, now, observe=True)
+
+        if key in self.batches:
+            self.batches[key].append(message)
+            self.batches.move_to_end(key)
+            self.hot_messages += 1
+        elif self.counts[key] == 1:
+            self.batches[key] = [message]
+            self.hot_messages += 1
+        # Сообщения вытесненного диалога остаются только на диске до готовности батча
+        self._spill()
+
+    def _spill(self):
+        while self.hot_messages > self.memory_cap_messages and self.batches:
+            _, messages = self.batches.popitem(last=False)
+            self.hot_messages -= len(messages)
+            self.spilled += 1
+
+    def batch_size(self, key):
+        return self.counts.get(key, 0)
+
+    def pop_batch(self, key):
+        self._unschedule(key)
+        if not self.counts.pop(key, 0):
+            return []
+        dialog = self._dialog(key)
+        messages = self.batches.pop(key, None)
+        if messages is None:
+            rows = self._conn.execute(
+                "SELECT payload FROM buffered_messages WHERE dialog = ? ORDER BY id", (dialog,)
+            ).fetchall()
+            messages = [MessageRecord.from_mapping(json.loads(payload)) for (payload,) in rows]
+            self.disk_loads += 1
+        else:
+            self.hot_messages -= len(messages)
+        # Если обработка не завершится, сообщения вернутся из Kafka: их оффсеты ещё не закоммичены
+        self._conn.execute("DELETE FROM buffered_messages WHERE dialog = ?", (dialog,))
+        return messages
+
+    def requeue(self, key, messages, positions, received_at):
+        if not messages:
+            return
+        received_at = received_at or time.time()
+        dialog = self._dialog(key)
+        rows = [
+            (dialog, tp.topic, tp.partition, offset, received_at, json.dumps(message, ensure_ascii=False, default=_to_json))
+            for message, (tp, offset) in zip(messages, positions)
+        ]
+        self._conn.executemany(
+            "INSERT INTO buffered_messages (dialog, topic, partition, message_offset, received_at, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        was_buffered = self.counts.get(key, 0)
+        self.counts[key] = was_buffered + len(messages)
+        self._unschedule(key)
+        self._schedule(key, received_at)
+
+        if key in self.batches:
+            self.batches[key][:0] = messages
+            self.hot_messages += len(messages)
+        elif not was_buffered:
+            self.batches[key] = list(messages)
+            self.hot_messages += len(messages)
+        self._spill()
+
+    def sync(self):
+        """Фиксирует записанные сообщения на диске (вызывается раз за цикл чтения)"""
+        self._conn.commit()
+
+    @property
+    def restorable(self):
+        return not self._restored
+
+    def restore(self, partitions, committed):
+        """
+        Восстанавливает буферы после перезапуска. Выполняется один раз, при первом
+        назначении партиций: сообщения назначенных партиций возвращаются в буферы,
+        а сообщения остальных удаляются — их прочитает новый владелец партиции.
+
+        Восстанавливается только непрерывный участок партиции, начиная с закоммиченного
+        оффсета группы. Сообщения ниже него уже обработаны. Сообщения после первого
+        пропуска удаляются: пропущенный оффсет мог принадлежать тому же диалогу (например,
+        батч был в обработке при остановке), и при повторной доставке он встал бы позади
+        более поздних. Всё удалённое выше коммита Kafka доставит заново по порядку.
+
+        Args:
+            partitions: Назначенные партиции
+            committed: Закоммиченные оффсеты группы: {TopicPartition: оффсет или None}
+
+        Returns:
+            Список (ключ диалога, (topic, partition), offset) восстановленных сообщений
+        """
+        if self._restored:
+            return []
+        self._restored = True
+        assigned = {(tp.topic, tp.partition) for tp in partitions}
+        start = {(tp.topic, tp.partition): offset for tp, offset in committed.items()}
+
+        rows = self._conn.execute(
+            "SELECT id, dialog, topic, partition, message_offset, received_at, payload "
+            "FROM buffered_messages ORDER BY id"
+        ).fetchall()
+        # По каждой партиции — последний оффсет непрерывного участка от коммита
+        contiguous = {}
+        for topic, partition, offset in sorted(
+            (row[2], row[3], row[4]) for row in rows if (row[2], row[3]) in assigned and row[4] is not None
+        ):
+            expected = contiguous.get((topic, partition), start.get((topic, partition)))
+            if expected is not None and offset == expected:
+                contiguous[(topic, partition)] = offset + 1
+
+        restored = []
+        dropped_ids = []
+        foreign = stale = gapped = 0
+        for row_id, dialog, topic, partition, offset, received_at, payload in rows:
+            if (topic, partition) not in assigned:
+                foreign += 1
+                dropped_ids.append((row_id,))
+                continue
+            committed_offset = start.get((topic, partition))
+            if offset is not None and committed_offset is not None and offset < committed_offset:
+                stale += 1
+                dropped_ids.append((row_id,))
+                continue
+            if offset is None or offset >= contiguous.get((topic, partition), -1):
+                gapped += 1
+                dropped_ids.append((row_id,))
+                continue
+            key = tuple(json.loads(dialog))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self._schedule(key, received_at)
+            # Восстановленные диалоги остаются на диске, пока не понадобятся
+            restored.append((key, (topic, partition), offset))
+        self._conn.executemany("DELETE FROM buffered_messages WHERE id = ?", dropped_ids)
+        self._conn.commit()
+        if rows:
+            print(f"♻️ Восстановлено из накопителя {len(restored)} сообщений ({len(self.counts)} диалогов), "
+                  f"отброшено: чужих партиций {foreign}, уже закоммиченных {stale}, "
+                  f"после пропуска оффсетов {gapped} (придут из Kafka заново)")
+        return restored
+
+    def stats(self):
+        try:
+            disk_bytes = sum(
+                os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path)
+            )
+        except OSError:
+            disk_bytes = 0
+        return {
+            "backend": "sqlite",
+            "dialogs": len(self.counts),
+            "buffered_messages": sum(self.counts.values()),
+            "hot_dialogs": len(self.batches),
+            "hot_messages": self.hot_messages,
+            "memory_bytes": sum(_messages_size(messages) for messages in self.batches.values()),
+            "disk_bytes": disk_bytes,
+            "spilled": self.spilled,
+            "disk_loads": self.disk_loads
+        }
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def _to_json(message):
+    """Сериализация сообщений-структур (MessageRecord, TelegramMessage) в журнал накопителя"""
+    return message.to_dict()
+
+
+def _messages_size(messages):
+    """Приблизительный объём списка сообщений в памяти (список, сообщения, ключи и значения первого уровня)"""
+    size = sys.getsizeof(messages)
+    for message in messages:
+        size += sys.getsizeof(message)
+        if isinstance(message, MessageRecord):
+            # ID отправителя и пользователя общие для всех сообщений диалога
+            size += sys.getsizeof(message.text)
+        elif isinstance(message, dict):
+            size += sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in message.items())
+        elif hasattr(message, "to_dict"):
+            # Имена полей структуры хранятся в классе, а не в каждом экземпляре
+            size += sum(sys.getsizeof(value) for value in message.to_dict().values())
+    return size
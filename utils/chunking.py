@@ -0,0 +1,70 @@
+from typing import Callable, List
+
+from utils.messages import Message
+
+
+def format_message(message: Message) -> str:
+    """Строка сообщения в том виде, в каком она попадает в промпт"""
+    return f"{message['SenderId']}: {message['MessageText']}"
+
+
+def message_token_counts(messages: List[Message], count_tokens: Callable[[str], int]) -> List[int]:
+    """
+    Считает токены каждого сообщения (плюс перевод строки между сообщениями)
+
+    Args:
+        messages: Список сообщений
+        count_tokens: Функция подсчёта токенов текущего бэкенда LLM
+
+    Returns:
+        Список с числом токенов для каждого сообщения
+    """
+    return [count_tokens(format_message(message)) + 1 for message in messages]
+
+
+def split_by_token_budget(messages: List[Message], token_counts: List[int],
+                          token_budget: int) -> List[List[Message]]:
+    """
+    Разбивает сообщения на части, заполняя каждую до бюджета токенов.
+    Порядок сообщений сохраняется; сообщение больше бюджета уходит отдельной частью.
+
+    Args:
+        messages: Список сообщений
+        token_counts: Число токенов каждого сообщения
+        token_budget: Бюджет токенов на одну часть
+
+    Returns:
+        Список частей с сообщениями
+    """
+    chunks = []
+    chunk, chunk_tokens = [], 0
+    for message, tokens in zip(messages, token_counts):
+        if chunk and chunk_tokens + tokens > token_budget:
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(message)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def tail_by_token_budget(messages: List[Message], token_counts: List[int],
+                         token_budget: int) -> List[Message]:
+    """
+    Возвращает самые свежие сообщения, которые укладываются в бюджет токенов (минимум одно)
+
+    Args:
+        messages: Список сообщений
+        token_counts: Число токенов каждого сообщения
+        token_budget: Бюджет токенов
+
+    Returns:
+        Хвост списка сообщений
+    """
+    total = 0
+    start = len(messages)
+    while start > 0 and (start == len(messages) or total + token_counts[start - 1] <= token_budget):
+        total += token_counts[start - 1]
+        start -= 1
+    return messages[start:]
@@ -0,0 +1,111 @@
+import asyncio
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class KeyedExecutor:
+    """
+    Исполнитель с N последовательными дорожками (lanes). Ключ (например, диалог
+    (session_id, interlocutor_id)) всегда попадает в одну и ту же дорожку по хэшу,
+    поэтому задачи одного ключа выполняются строго по очереди, а разные ключи —
+    параллельно в разных дорожках.
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], lanes: int = 10, lane_capacity: int = 10):
+        """
+        Args:
+            handler: Корутина, обрабатывающая одну задачу
+            lanes: Число дорожек (максимум параллельно обрабатываемых задач)
+            lane_capacity: Максимум задач в очереди одной дорожки
+        """
+        self.handler = handler
+        self.lanes = max(1, lanes)
+        self.lane_capacity = max(1, lane_capacity)
+        self._queues = [asyncio.Queue(maxsize=self.lane_capacity) for _ in range(self.lanes)]
+        self._busy = [False] * self.lanes
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        """Запускает обработчики дорожек"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run_lane(lane)) for lane in range(self.lanes)]
+
+    async def stop(self):
+        """Останавливает обработчики; задача, выполняющаяся в момент остановки, отменяется"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def lane_for(self, key: Hashable) -> int:
+        """
+        Возвращает номер дорожки для ключа. Хэш стабилен между процессами
+        (в отличие от hash() со случайной солью), чтобы номер дорожки был воспроизводим в логах.
+        """
+        return zlib.crc32(repr(key).encode("utf-8")) % self.lanes
+
+    def try_submit(self, key: Hashable, item: Any) -> bool:
+        """
+        Ставит задачу в дорожку ключа без ожидания
+
+        Args:
+            key: Ключ упорядочивания
+            item: Задача для handler
+
+        Returns:
+            False, если очередь дорожки заполнена
+        """
+        try:
+            self._queues[self.lane_for(key)].put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def submit(self, key: Hashable, item: Any):
+        """Ставит задачу в дорожку ключа, ожидая свободного места"""
+        await self._queues[self.lane_for(key)].put(item)
+
+    def lane_depths(self) -> List[int]:
+        """Число задач в каждой дорожке, включая выполняющуюся"""
+        return [queue.qsize() + int(busy) for queue, busy in zip(self._queues, self._busy)]
+
+    def total_depth(self) -> int:
+        """Общее число задач во всех дорожках"""
+        return sum(self.lane_depths())
+
+    @property
+    def capacity(self) -> int:
+        """Суммарная ёмкость очередей всех дорожек"""
+        return self.lanes * self.lane_capacity
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает показатели для мониторинга"""
+        depths = self.lane_depths()
+        return {
+            "lanes": self.lanes,
+            "depths": depths,
+            "total_depth": sum(depths),
+            "max_depth": max(depths),
+            "busy_lanes": sum(self._busy),
+            "processed": self.processed,
+            "failed": self.failed
+        }
+
+    async def _run_lane(self, lane: int):
+        queue = self._queues[lane]
+        while True:
+            item = await queue.get()
+            self._busy[lane] = True
+            try:
+                await self.handler(item)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ошибка в дорожке {lane}: {e}")
+            finally:
+                self._busy[lane] = False
+                queue.task_done()
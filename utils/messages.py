@@ -0,0 +1,81 @@
+import sys
+from typing import Any, Dict, Mapping, Union
+
+
+class MessageRecord:
+    """
+    Компактное сообщение диалога в буфере и дальше по конвейеру анализа.
+
+    Хранит только то, что нужно анализу: отправителя, текст и владельца сессии.
+    SessionId и TelegramInterlocutorId уже есть в ключе батча, поэтому не хранятся
+    в каждом сообщении. ID отправителей интернированы: у диалога два участника,
+    и все его сообщения ссылаются на одни и те же объекты строк.
+
+    Поддерживает чтение как словарь (m['SenderId'], m.get('TelegramUserId')), чтобы
+    форматирование промптов и подсчёт метрик работали и со словарями, и с записями.
+    """
+
+    __slots__ = ("sender_id", "text", "user_id")
+
+    # Имя поля исходного JSON -> атрибут записи
+    FIELDS = {"SenderId": "sender_id", "MessageText": "text", "TelegramUserId": "user_id"}
+
+    def __init__(self, sender_id: str, text: str, user_id: int = 0):
+        """
+        Args:
+            sender_id: ID отправителя (интернированная строка)
+            text: Текст сообщения
+            user_id: ID пользователя телеграм, владельца сессии
+        """
+        self.sender_id = sender_id
+        self.text = text
+        self.user_id = user_id
+
+    @classmethod
+    def from_mapping(cls, message: Mapping) -> "MessageRecord":
+        """
+        Собирает запись из декодированного сообщения (словаря или TelegramMessage)
+
+        Args:
+            message: Сообщение с полями SenderId, MessageText и TelegramUserId
+
+        Returns:
+            MessageRecord
+        """
+        return cls(
+            intern_sender(message["SenderId"]),
+            message.get("MessageText") or "",
+            intern_user(message.get("TelegramUserId", 0))
+        )
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, self.FIELDS[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def get(self, key: str, default=None):
+        attribute = self.FIELDS.get(key)
+        return getattr(self, attribute) if attribute is not None else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, attribute) for field, attribute in self.FIELDS.items()}
+
+    def __repr__(self) -> str:
+        return f"MessageRecord(sender_id={self.sender_id!r}, text={self.text!r}, user_id={self.user_id!r})"
+
+
+# Сообщение, которое принимают форматирование промптов, разбиение на части и подсчёт метрик
+Message = Union[Dict[str, Any], MessageRecord]
+
+_users: Dict[int, int] = {}
+
+
+def intern_sender(sender_id: Any) -> str:
+    """Возвращает общий для всех сообщений объект строки с ID отправителя"""
+    return sys.intern(str(sender_id))
+
+
+def intern_user(user_id: Any) -> int:
+    """Возвращает общий для всех сообщений объект ID пользователя (большие int не кэшируются Python)"""
+    return _users.setdefault(user_id, user_id)